@@ -0,0 +1,77 @@
+from utils.enum_tools import Enum
+
+
+class CountStrategy(Enum):
+    """get_by_filter 的计数策略"""
+
+    EXACT = "exact"  # 精确计数, 单独执行一次 COUNT
+    CACHED = "cached"  # 精确计数, 结果按过滤条件缓存到 redis
+    ESTIMATED = "estimated"  # 估算计数, 使用表统计信息或 EXPLAIN 的行数估算
+    HAS_MORE = "has_more"  # 不计数, 多取一条判断是否存在下一页
+
+    __enumtag__ = {
+        "EXACT": "精确计数",
+        "CACHED": "缓存计数",
+        "ESTIMATED": "估算计数",
+        "HAS_MORE": "是否存在下一页",
+    }
+
+
+class LoadStrategy(Enum):
+    """BaseModel._load_options 中关联关系的加载策略"""
+
+    SELECTIN = "selectin"  # SELECT ... WHERE fk IN (...), 一对多/多对多推荐
+    JOINED = "joined"  # LEFT OUTER JOIN, 多对一推荐
+    SUBQUERY = "subquery"  # 以原查询作为子查询关联加载
+    LAZY = "lazy"  # 访问时加载, 即不预加载
+    RAISE = "raise"  # 访问未加载的关联时报错, 用于排查N+1
+    NOLOAD = "noload"  # 不加载
+
+    __enumtag__ = {
+        "SELECTIN": "IN查询加载",
+        "JOINED": "连接加载",
+        "SUBQUERY": "子查询加载",
+        "LAZY": "延迟加载",
+        "RAISE": "禁止加载",
+        "NOLOAD": "不加载",
+    }
+
+
+class TimeBucket(Enum):
+    """BaseModel.aggregate 的时间分桶"""
+
+    DAY = "day"
+    WEEK = "week"  # 以周一作为一周的开始
+    MONTH = "month"
+
+    __enumtag__ = {
+        "DAY": "按天",
+        "WEEK": "按周",
+        "MONTH": "按月",
+    }
+
+
+class OutboxOp(Enum):
+    """outbox 中的变更类型"""
+
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"  # 软删除与硬删除, 软删除时 payload 为 {"soft": true}
+
+    __enumtag__ = {
+        "CREATE": "创建",
+        "UPDATE": "更新",
+        "DELETE": "删除",
+    }
+
+
+class ShardStrategy(Enum):
+    """ShardedBaseModel 的分片路由策略"""
+
+    MODULO = "modulo"  # 分片键为整数, 按照 分片键 % 分片数量 路由
+    HASH = "hash"  # 按照 md5(分片键) % 分片数量 路由, 适用于字符串分片键
+
+    __enumtag__ = {
+        "MODULO": "取模",
+        "HASH": "哈希",
+    }
@@ -46,6 +46,48 @@ MYSQL_PORT = conf_loader('MYSQL_PORT', 3306)
 MYSQL_DATABASE = conf_loader('MYSQL_DATABASE', "test")
 MYSQL_CHARSET = conf_loader("MYSQL_CHARSET", "utf8mb4")
 
+# 主库连接, 为空时使用上面的 MYSQL_* 拼接. 本地测试可以使用sqlite, 如 sqlite:////tmp/primary.db (需要设置 USE_DB_POOL=false)
+DATABASE_URI = conf_loader("DATABASE_URI", "")
+# 从库连接, 多个使用逗号分隔, 会以 replica_0, replica_1... 的名称加入 SQLALCHEMY_BINDS, 为空时读写都使用主库
+REPLICA_DATABASE_URIS = conf_loader("REPLICA_DATABASE_URIS", "")
+if isinstance(REPLICA_DATABASE_URIS, str):
+    REPLICA_DATABASE_URIS = [uri for uri in REPLICA_DATABASE_URIS.split(",") if uri]
+# 分片连接(ShardedBaseModel), 多个使用逗号分隔, 下标即分片编号, 会以 shard_0, shard_1... 的名称加入 SQLALCHEMY_BINDS,
+# 本地测试可以使用多个sqlite文件, 如 sqlite:////tmp/shard0.db,sqlite:////tmp/shard1.db. 分片数量确定之后不能修改
+SHARD_DATABASE_URIS = conf_loader("SHARD_DATABASE_URIS", "")
+if isinstance(SHARD_DATABASE_URIS, str):
+    SHARD_DATABASE_URIS = [uri for uri in SHARD_DATABASE_URIS.split(",") if uri]
+
+# 异步数据库(AsyncBaseModel), 需要 aiomysql, 本地测试可以使用 sqlite+aiosqlite:////tmp/test.db
+USE_ASYNC_DB = parse_args("USE_ASYNC_DB", False, bool)
+ASYNC_DATABASE_URI = conf_loader("ASYNC_DATABASE_URI", "")  # 为空时使用 MYSQL_* 拼接 mysql+aiomysql 连接
+
+# ###################################### Model配置  ####################################
+MAX_PAGE_SIZE = parse_args("MAX_PAGE_SIZE", 1000, int)  # BaseModel.get_all 的最大分页
+COUNT_CACHE_TTL = parse_args("COUNT_CACHE_TTL", 60, int)  # cached 计数策略的缓存时间, 秒
+# get_by_filter(concurrent_count=True) 计数线程池的大小, 每个计数线程额外占用一个连接, 需要小于 DB_POOL_SIZE
+COUNT_CONCURRENCY = parse_args("COUNT_CONCURRENCY", 4, int)
+FILTER_PLAN_CACHE_SIZE = parse_args("FILTER_PLAN_CACHE_SIZE", 256, int)  # 每个Model缓存的过滤字段组合与预加载策略数量
+BULK_INSERT_CHUNK_SIZE = parse_args("BULK_INSERT_CHUNK_SIZE", 1000, int)  # bulk_ingest 每条INSERT的最大行数
+BULK_UPDATE_CHUNK_SIZE = parse_args("BULK_UPDATE_CHUNK_SIZE", 500, int)  # bulk_update(set_based=True) 每条UPDATE的最大行数
+ID_LIST_CHUNK_SIZE = parse_args("ID_LIST_CHUNK_SIZE", 1000, int)  # get_by_id_list 每次 IN 查询的最大id数量
+FULLTEXT_NGRAM_TOKEN_SIZE = parse_args("FULLTEXT_NGRAM_TOKEN_SIZE", 2, int)  # 与MySQL的 ngram_token_size 一致, 更短的词退回like
+ENTITY_CACHE_NEGATIVE_TTL = parse_args("ENTITY_CACHE_NEGATIVE_TTL", 30, int)  # 实体缓存中不存在的id的缓存时间, 秒
+ARCHIVE_BATCH_SIZE = parse_args("ARCHIVE_BATCH_SIZE", 1000, int)  # 归档/清理每个事务处理的最大行数
+ARCHIVE_BATCH_SLEEP_MS = parse_args("ARCHIVE_BATCH_SLEEP_MS", 500, int)  # 归档/清理每一批之后的休眠时间, 毫秒, 避免从库复制延迟
+ARCHIVE_PURGE_DAYS = parse_args("ARCHIVE_PURGE_DAYS", 180, int)  # 归档表中的记录保留的天数
+
+# ###################################### SQL监控配置  ####################################
+SQL_MONITOR = parse_args("SQL_MONITOR", True, bool)  # 是否开启请求级别的sql统计与慢查询日志
+SQL_N_PLUS_ONE_THRESHOLD = parse_args("SQL_N_PLUS_ONE_THRESHOLD", 10, int)  # 同一形状的语句在一个请求中超过该次数时告警
+SLOW_QUERY_THRESHOLD_MS = parse_args("SLOW_QUERY_THRESHOLD_MS", 200, int)  # 慢查询阈值, 毫秒, debug模式下附带EXPLAIN
+
+# ###################################### Outbox配置  ####################################
+OUTBOX_BATCH_SIZE = parse_args("OUTBOX_BATCH_SIZE", 500, int)  # relay_outbox 每一批发布的最大事件数
+OUTBOX_STREAM_PREFIX = parse_args("OUTBOX_STREAM_PREFIX", "outbox")  # 事件发布到 <prefix>:<table> 的redis stream
+OUTBOX_STREAM_MAXLEN = parse_args("OUTBOX_STREAM_MAXLEN", 100000, int)  # 每个stream保留的大约长度
+OUTBOX_RELAY_INTERVAL_MS = parse_args("OUTBOX_RELAY_INTERVAL_MS", 1000, int)  # 持续发布时没有新事件的轮询间隔, 毫秒
+
 # ######################################## REDIS配置  ########################################
 REDIS_CONFIG = {
     "type": conf_loader('REDIS_TYPE', 'single'),   # single, sentinel, cluster
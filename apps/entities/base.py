@@ -2,6 +2,7 @@ from datetime import datetime
 
 from sqlalchemy import DateTime, Integer, Text, Boolean, JSON
 from sqlalchemy import Column
+from sqlalchemy.ext.declarative import declared_attr
 
 from initialization.sqlalchemy_process import db, session
 
@@ -20,8 +21,9 @@ class BaseEntity(db.Model):
 
     __abstract__ = True
 
-    def auto_set_attr(self, **data):
-        session.refresh(self)
+    def auto_set_attr(self, _refresh: bool = True, **data):
+        if _refresh:
+            session.refresh(self)
         for k, v in data.items():
             if hasattr(self, k) and k != "id":
                 setattr(self, k, v)
@@ -53,6 +55,23 @@ class IsDelBaseEntity(BaseEntity):
     active_query = ActiveQuery()
 
 
+class VersionBaseEntity(BaseEntity):
+    """乐观锁版本号, 由SQLAlchemy的 version_id_col 维护
+
+    ORM的UPDATE会附带 WHERE version = :加载时的版本号 并将版本号加1, 没有匹配的行时flush抛出 StaleDataError,
+    safe_commit 会将其转换为 VersionConflict. 不加载entity时使用 BaseModel.update(_id, expected_version=...).
+    子类自定义 __mapper_args__ 时需要自行设置 version_id_col.
+    """
+
+    __abstract__ = True
+
+    version = Column(Integer, nullable=False, default=1, server_default="1", comment="版本号")
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {"version_id_col": cls.version}
+
+
 class DescBaseEntity(BaseEntity):
     """备注描述"""
 
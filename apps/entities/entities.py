@@ -1,6 +1,7 @@
 """
 所有实体类
 """
+from .outbox import OutboxEntity  # noqa: F401
 
 """
 # ! 保证唯一时尽可能在业务层保证，数据层不保证唯一性
@@ -0,0 +1,19 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, BigInteger, Column, DateTime, Integer, String
+
+from .base import BaseEntity
+
+
+class OutboxEntity(BaseEntity):
+    """实体变更事件(outbox), 与业务数据在同一个事务中写入, 由 relay_outbox 发布到 redis stream 之后删除"""
+
+    __tablename__ = "outbox"
+
+    # sqlite 只有 INTEGER PRIMARY KEY 会自增
+    id = Column(BigInteger().with_variant(Integer(), "sqlite"), primary_key=True, autoincrement=True, comment="主键")
+    aggregate = Column(String(64), nullable=False, comment="实体的表名")
+    aggregate_id = Column(String(64), nullable=False, comment="实体的主键")
+    op = Column(String(16), nullable=False, comment="变更类型, 见 OutboxOp")
+    payload = Column(JSON, comment="变更的附加信息, 如更新的字段")
+    create_time = Column(DateTime, default=datetime.now, comment="变更时间")
@@ -5,6 +5,9 @@ from configs import sysconf
 
 from .logger_process import init_logger
 from .sqlalchemy_process import init_db
+from .sharding_process import init_sharding
+from .sqlalchemy_async_process import init_async_db
+from .sql_monitor_process import init_sql_monitor
 from .smorest_process import init_smorest
 from .schema_process import init_marshmallow_errorhandler
 from .request_process import init_request
@@ -25,6 +28,9 @@ def _init(app: Flask):
     init_logger(app)
     init_exception(app)
     init_db(app)
+    init_sharding(app)
+    init_async_db(app)
+    init_sql_monitor(app)
     init_sqlalchemy_models()
     init_redis(app)
     init_command(app)
@@ -97,6 +97,71 @@ def init_command(app: Flask):
         db.drop_all()
         return
 
+    @app.cli.command("create_fulltext_index", help="create FULLTEXT(ngram) indexes for Model's _fulltext_filter_keys")
+    @with_appcontext
+    def create_fulltext_index():
+        from initialization.sqlalchemy_process import session
+        from models.base import BaseModel
+        for model in list(BaseModel._entities_models.values()):
+            for index_name in model.create_fulltext_indexes():
+                click.echo(f"{model.__name__}: {index_name} CREATED")
+        session.commit()
+        click.echo("DONE!")
+
+    def archivable_models(name: str):
+        from models.base import BaseModel
+        models = BaseModel.archivable_models()
+        if name:
+            models = [model for model in models if model.__name__ == name]
+            if not models:
+                raise click.BadParameter(f"{name} is not a Model with _archive_retention_days", param_hint="--model")
+        return models
+
+    @app.cli.command("archive_deleted", help="move expired soft-deleted rows to <table>_archive")
+    @click.option("--model", "-m", "name", help="只归档指定的Model, 默认为所有开启了归档的Model")
+    @click.option("--batch-size", type=int, default=None, help="每一批的行数, 默认为 ARCHIVE_BATCH_SIZE")
+    @click.option("--sleep-ms", type=int, default=None, help="每一批之后的休眠时间, 默认为 ARCHIVE_BATCH_SLEEP_MS")
+    @click.option("--max-batches", type=int, default=None, help="每个Model最多执行的批数, 默认不限制")
+    @with_appcontext
+    def archive_deleted(name, batch_size, sleep_ms, max_batches):
+        for model in archivable_models(name):
+            archived = model.archive_deleted(batch_size=batch_size, sleep_ms=sleep_ms, max_batches=max_batches)
+            click.echo(f"{model.__name__}: {archived} rows ARCHIVED")
+        click.echo("DONE!")
+
+    @app.cli.command("purge_archive", help="delete archived rows older than _archive_purge_days from <table>_archive")
+    @click.option("--model", "-m", "name", help="只清理指定的Model, 默认为所有开启了归档的Model")
+    @click.option("--days", type=int, default=None, help="归档记录保留的天数, 默认为Model的 _archive_purge_days")
+    @click.option("--batch-size", type=int, default=None, help="每一批的行数, 默认为 ARCHIVE_BATCH_SIZE")
+    @click.option("--sleep-ms", type=int, default=None, help="每一批之后的休眠时间, 默认为 ARCHIVE_BATCH_SLEEP_MS")
+    @click.option("--max-batches", type=int, default=None, help="每个Model最多执行的批数, 默认不限制")
+    @with_appcontext
+    def purge_archive(name, days, batch_size, sleep_ms, max_batches):
+        for model in archivable_models(name):
+            purged = model.purge_archive(days=days, batch_size=batch_size, sleep_ms=sleep_ms, max_batches=max_batches)
+            click.echo(f"{model.__name__}: {purged} rows PURGED")
+        click.echo("DONE!")
+
+    @app.cli.command("create_shard_tables", help="create tables of ShardedBaseModel on every shard")
+    @with_appcontext
+    def create_shard_tables():
+        from models.sharding import ShardedBaseModel
+        for model in list(ShardedBaseModel._entities_models.values()):
+            model.create_shard_tables()
+            click.echo(f"{model.__name__}: {model._entity.__tablename__} CREATED")
+        click.echo("DONE!")
+
+    @app.cli.command("relay_outbox", help="publish entity change events in outbox to redis streams")
+    @click.option("--batch-size", type=int, default=None, help="每一批的事件数, 默认为 OUTBOX_BATCH_SIZE")
+    @click.option("--follow", "-f", is_flag=True, help="持续发布, 没有新事件时每隔 OUTBOX_RELAY_INTERVAL_MS 轮询一次")
+    @with_appcontext
+    def relay_outbox(batch_size, follow):
+        from models.outbox import follow_outbox, relay_outbox
+        if follow:
+            follow_outbox(batch_size=batch_size)
+            return
+        click.echo(f"{relay_outbox(batch_size=batch_size)} events PUBLISHED")
+
     @app.cli.command("create_resource",
                      help="""
     create Entity, Model Service and Schema for you!
@@ -1,4 +1,5 @@
 from flask import request
+from sqlalchemy.orm.exc import StaleDataError
 
 from utils.exceptions import NoAuthResponse, NoPermission, ParamResponse, TipResponse
 from utils.response import BaseResponse
@@ -19,6 +20,13 @@ def init_exception(app: Flask):
             code=error.code,
         ).asdict()
 
+    @app.errorhandler(StaleDataError)
+    def stale_data_handler(error: StaleDataError):
+        """
+        @attention: safe_commit 之外flush时的乐观锁冲突
+        """
+        return BaseResponse(message="数据已被修改, 请刷新后重试", status=409, code=409).asdict()
+
     @app.errorhandler(ParamResponse)
     def param_handler(error: ParamResponse):
         """
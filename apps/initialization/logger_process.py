@@ -34,6 +34,24 @@ def get_logging_config(logs_path: str, level: str) -> dict:
                 'when': 'midnight',
                 'backupCount': 10,
                 'encoding': 'utf-8',
+            },
+            'slow_query': {
+                'level': 'WARNING',
+                'class': 'logging.handlers.TimedRotatingFileHandler',
+                'formatter': 'default',
+                'filename': os.path.join(logs_path, 'slow_query.log'),
+                'when': 'midnight',
+                'backupCount': 10,
+                'encoding': 'utf-8',
+            }
+        },
+
+        'loggers': {
+            # 慢查询日志, 见 sql_monitor_process
+            'slow_query': {
+                'handlers': ['slow_query', "console"],
+                'level': 'WARNING',
+                'propagate': False,
             }
         },
 
@@ -1,6 +1,6 @@
 import copy
-from typing import Any
-from flask import Flask
+from typing import Any, Optional
+from flask import Flask, current_app, has_app_context
 from configs import sysconf as conf
 from databases.redisdb import SingleRedisClinet
 
@@ -15,6 +15,13 @@ class RedisExtension(object):
         return getattr(self.redis, __name)
 
 
+def get_redis_client() -> Optional[RedisExtension]:
+    """获取当前app的redis服务, 不在app上下文中或没有初始化时返回None"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("redis_client")
+
+
 def init_redis(app: Flask):
     """初始化redis服务"""
     logger = app.logger
@@ -0,0 +1,94 @@
+"""
+分片数据库连接, 供 ShardedBaseModel 使用
+
+每个分片使用单独的session, 与 db.session 一样按照线程(greenlet)隔离, 在app上下文结束时移除.
+db.session 提交或者回滚之后, 当前上下文中使用过的分片session会跟随提交或者回滚, 因此 safe_commit/@commit 可以直接使用.
+
+分片之间没有分布式事务, 提交分为两步:
+- 主库提交之前先flush分片session, 分片上的写入错误(唯一约束、版本冲突等)在主库提交之前抛出, 主库与分片一起回滚;
+- 主库提交之后再依次提交分片, 这一步是尽力而为的: 某个分片提交失败时(如连接断开),
+  已经提交的主库与其他分片不会回滚, 也没有补偿, 只记录日志并抛出异常, 需要业务自行对账或者重试.
+"""
+from functools import partial
+from typing import List
+
+from flask import Flask
+from sqlalchemy import event, orm
+
+from configs import sysconf
+from initialization.logger_process import logger
+from initialization.sqlalchemy_process import RoutingSession, db
+
+try:
+    from greenlet import getcurrent as _ident_func
+except ImportError:
+    from threading import get_ident as _ident_func
+
+SHARD_BIND_PREFIX = "shard_"
+
+shard_sessions: List[orm.scoped_session] = []
+
+
+def get_shard_binds() -> dict:
+    return {f"{SHARD_BIND_PREFIX}{i}": uri for i, uri in enumerate(sysconf.SHARD_DATABASE_URIS)}
+
+
+def shard_count() -> int:
+    return len(shard_sessions)
+
+
+def get_shard_session(shard: int) -> orm.Session:
+    """获取当前上下文中分片的session"""
+    if not shard_sessions:
+        raise RuntimeError("sharding is not initialized, SHARD_DATABASE_URIS is required by ShardedBaseModel")
+    return shard_sessions[shard]()
+
+
+def _create_shard_session(app: Flask, bind: str) -> orm.Session:
+    return orm.Session(bind=db.get_engine(app, bind=bind))
+
+
+def _active_shard_sessions() -> List[orm.Session]:
+    return [scoped() for scoped in shard_sessions if scoped.registry.has()]
+
+
+@event.listens_for(RoutingSession, "before_commit")
+def _flush_shards(sess):
+    for shard_session in _active_shard_sessions():
+        shard_session.flush()
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _commit_shards(sess):
+    error = None
+    for shard_session in _active_shard_sessions():
+        try:
+            shard_session.commit()
+        except Exception as e:
+            logger.exception(e)
+            shard_session.rollback()
+            error = error or e
+    if error is not None:
+        raise error
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _rollback_shards(sess):
+    for shard_session in _active_shard_sessions():
+        shard_session.rollback()
+
+
+def init_sharding(app: Flask):
+    if not sysconf.SHARD_DATABASE_URIS:
+        return
+
+    app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **get_shard_binds())
+    shard_sessions[:] = [
+        orm.scoped_session(partial(_create_shard_session, app, bind), scopefunc=_ident_func)
+        for bind in get_shard_binds()
+    ]
+
+    @app.teardown_appcontext
+    def remove_shard_sessions(exc):
+        for scoped in shard_sessions:
+            scoped.remove()
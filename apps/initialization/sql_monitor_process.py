@@ -0,0 +1,183 @@
+"""
+请求级别的sql监控
+
+- 统计每个请求执行的sql数量与总耗时, 通过 Server-Timing 响应头返回, 请求在其他线程中执行的sql(如并发计数)通过
+  attach_sql_stats 计入请求的统计
+- 同一形状(参数与IN列表归一化之后)的语句在一个请求中执行超过 SQL_N_PLUS_ONE_THRESHOLD 次时告警, 用于发现N+1查询
+- 耗时超过 SLOW_QUERY_THRESHOLD_MS 的语句写入慢查询日志(logs/slow_query.log), debug模式下附带 EXPLAIN 结果
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+from flask import Flask, Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from configs import sysconf
+from initialization.logger_process import logger
+
+slow_query_logger = logging.getLogger("slow_query")
+
+_STATS = "_sql_stats"
+_EXPLAIN = "_sql_explain"
+_START_TIMES = "query_start_times"
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_SPACES = re.compile(r"\s+")
+
+# 不在请求上下文中的线程, 执行的sql计入的请求统计, 见 attach_sql_stats
+_thread_stats = threading.local()
+
+
+class SqlStats(object):
+    """单个请求的sql统计"""
+
+    __slots__ = ("count", "duration", "fingerprints", "warned", "request_id", "lock")
+
+    def __init__(self, request_id: str = "-"):
+        self.count = 0
+        self.duration = 0.0  # 秒
+        self.fingerprints = Counter()
+        self.warned = set()
+        self.request_id = request_id
+        # 请求线程与 attach_sql_stats 的线程同时更新统计
+        self.lock = threading.Lock()
+
+
+def fingerprint(statement: str) -> str:
+    """语句形状: 字面量与占位符统一为?, IN列表合并为一个?, 多余的空白合并"""
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _PLACEHOLDER.sub("?", statement)
+    statement = _PLACEHOLDER_LIST.sub("(?)", statement)
+    return _SPACES.sub(" ", statement).strip()
+
+
+def get_sql_stats() -> Optional[SqlStats]:
+    """获取当前请求的sql统计, 不在请求上下文中时返回 attach_sql_stats 指定的统计, 没有时返回None"""
+    if not has_request_context():
+        return getattr(_thread_stats, "stats", None)
+    stats = g.get(_STATS)
+    if stats is None:
+        stats = g.setdefault(_STATS, SqlStats(request.request_id))
+    return stats
+
+
+@contextmanager
+def attach_sql_stats(stats: Optional[SqlStats]):
+    """在其中执行的sql计入 stats, 用于在线程池中替请求执行的查询, stats 在请求线程中通过 get_sql_stats 获取"""
+    previous = getattr(_thread_stats, "stats", None)
+    _thread_stats.stats = stats
+    try:
+        yield stats
+    finally:
+        _thread_stats.stats = previous
+
+
+def _request_id() -> str:
+    if has_request_context():
+        return request.request_id
+    stats = getattr(_thread_stats, "stats", None)
+    return stats.request_id if stats is not None else "-"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_START_TIMES, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get(_START_TIMES)
+    if not start_times:
+        return
+    duration = time.perf_counter() - start_times.pop()
+
+    stats = get_sql_stats()
+    if stats is not None:
+        shape = fingerprint(statement)
+        with stats.lock:
+            stats.count += 1
+            stats.duration += duration
+            stats.fingerprints[shape] += 1
+            warn = stats.fingerprints[shape] > sysconf.SQL_N_PLUS_ONE_THRESHOLD and shape not in stats.warned
+            if warn:
+                stats.warned.add(shape)
+        if warn:
+            logger.warning(f"request-id: <{_request_id()}> N+1 suspected, "
+                           f"statement executed more than {sysconf.SQL_N_PLUS_ONE_THRESHOLD} times: {shape[:500]}")
+
+    duration_ms = duration * 1000
+    if duration_ms >= sysconf.SLOW_QUERY_THRESHOLD_MS:
+        message = f"request-id: <{_request_id()}> {duration_ms:.1f}ms {statement} params: {parameters}"
+        explain = _explain(conn, statement, parameters, context, executemany)
+        if explain:
+            message += f"\nEXPLAIN:\n{explain}"
+        slow_query_logger.warning(message)
+
+
+def _handle_error(exception_context):
+    """语句执行失败时不会触发 after_cursor_execute, 需要弹出开始时间, 否则连接归还连接池之后后续语句的耗时会错位"""
+    conn = exception_context.connection
+    if conn is None or exception_context.execution_context is None:
+        # 还没有创建执行上下文, before_cursor_execute 没有执行
+        return
+    start_times = conn.info.get(_START_TIMES)
+    if start_times:
+        start_times.pop()
+
+
+def _explain(conn, statement, parameters, context, executemany) -> str:
+    """debug模式下使用原始的DBAPI连接获取查询语句的执行计划, 不会触发engine事件"""
+    if not (has_request_context() and g.get(_EXPLAIN)):
+        return ""
+    if executemany or not statement.lstrip()[:6].upper() == "SELECT":
+        return ""
+    if context is not None and context.execution_options.get("stream_results"):
+        # 服务端游标的结果还没有读取完, 不能在同一个连接上执行其他语句
+        return ""
+
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(str(row) for row in cursor.fetchall())
+    except Exception as e:
+        return f"explain failed: {e}"
+    finally:
+        cursor.close()
+
+
+def init_sql_monitor(app: Flask):
+    """初始化sql监控"""
+    if not sysconf.SQL_MONITOR:
+        return
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+    @app.before_request
+    def init_sql_stats():
+        g.setdefault(_STATS, SqlStats(request.request_id))
+        if app.debug:
+            setattr(g, _EXPLAIN, True)
+
+    @app.after_request
+    def sql_server_timing(response: Response):
+        """将sql统计写入 Server-Timing 响应头"""
+        stats = get_sql_stats()
+        if stats is None:
+            return response
+
+        duration_ms = stats.duration * 1000
+        response.headers.add("Server-Timing", f'db;dur={duration_ms:.1f};desc="{stats.count} queries"')
+        app.logger.info(f"request-id: <{request.request_id}> sql: {stats.count} queries, {duration_ms:.1f}ms")
+        return response
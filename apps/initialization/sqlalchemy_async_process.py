@@ -0,0 +1,123 @@
+"""
+异步数据库连接, 供 AsyncBaseModel/AsyncBaseService 使用
+
+使用 SQLAlchemy 的 asyncio 扩展以及异步驱动 aiomysql(测试可以使用 aiosqlite),
+没有开启 USE_ASYNC_DB 时不会初始化, 此时使用异步session会抛出 RuntimeError.
+
+session 按照 asyncio task 隔离, Flask2 的 async def 视图需要使用 async_session_scope 装饰, 在视图结束时关闭session:
+
+    @async_session_scope
+    async def get(self):
+        return await user_service.get_by_pk(1)
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from flask import Flask
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool
+
+from configs import sysconf
+from initialization.logger_process import logger
+from utils.exceptions import VersionConflict
+
+async_engine = None
+async_session = None
+
+# session.info 中记录 async_safe_commit 的嵌套层数
+_COMMIT_DEPTH = "async_commit_depth"
+
+
+def get_async_database_uri():
+    if sysconf.ASYNC_DATABASE_URI:
+        return sysconf.ASYNC_DATABASE_URI
+
+    return 'mysql+aiomysql://%s:%s@%s:%s/%s?charset=%s' % (
+        sysconf.MYSQL_USER, sysconf.MYSQL_PASSWD,
+        sysconf.MYSQL_HOST, sysconf.MYSQL_PORT,
+        sysconf.MYSQL_DATABASE, sysconf.MYSQL_CHARSET,
+    )
+
+
+def get_async_session() -> AsyncSession:
+    """获取当前task的异步session"""
+    if async_session is None:
+        raise RuntimeError("async db is not initialized, USE_ASYNC_DB=true is required by AsyncBaseModel")
+    return async_session()
+
+
+def async_session_scope(fn):
+    """在协程结束之后关闭当前task的异步session, 一般用于装饰 async def 视图"""
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            if async_session is not None:
+                await async_session.remove()
+
+    return wrapper
+
+
+@asynccontextmanager
+async def async_safe_commit():
+    """
+    异步的 safe_commit, 嵌套使用时只有最外层会提交, 任何一层出现异常都会回滚整个事务
+
+        async with async_safe_commit() as session:
+            user = await UserAsyncModel.create()
+    """
+    session = get_async_session()
+    info = session.sync_session.info
+    depth = info.get(_COMMIT_DEPTH, 0)
+    info[_COMMIT_DEPTH] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            await session.commit()
+    except VersionConflict:
+        # 乐观锁冲突是预期内的错误, 回滚之后交给调用方处理(如返回409)
+        await session.rollback()
+        raise
+    except StaleDataError as e:
+        await session.rollback()
+        raise VersionConflict() from e
+    except SQLAlchemyError as e:
+        await session.rollback()
+        logger.exception(e)
+        raise e
+    finally:
+        info[_COMMIT_DEPTH] = depth
+
+
+def async_commit(fn):
+    """异步的 commit 装饰器, 被装饰的协程在 async_safe_commit 中执行"""
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        async with async_safe_commit():
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+
+def init_async_db(app: Flask):
+    global async_engine, async_session
+
+    if not sysconf.USE_ASYNC_DB:
+        return
+
+    db_uri = get_async_database_uri()
+    app.logger.debug("ASYNC_CONNECT_URL: " + db_uri)
+
+    # Flask 会在单独的事件循环中执行每一个 async def 视图, 异步连接不能跨事件循环复用, 因此不使用连接池
+    async_engine = create_async_engine(db_uri, poolclass=NullPool)
+    async_session = async_scoped_session(
+        sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False),
+        scopefunc=asyncio.current_task,
+    )
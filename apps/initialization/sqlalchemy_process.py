@@ -4,18 +4,130 @@ Created on 2020年2月7日
 @author: jianzhihua
 """
 
+import random
+from contextlib import contextmanager
+
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
 from flask import Flask
 
 from configs import sysconf
 
-db = SQLAlchemy()
+# SQLALCHEMY_BINDS 中从库的key前缀
+REPLICA_BIND_PREFIX = "replica_"
+
+# session.info 中的读写分离状态
+_READ_FROM_REPLICA = "read_from_replica"
+_STICKY_PRIMARY = "sticky_primary"
+_REPLICA_BIND = "replica_bind"
+# 当前事务中是否有还没有提交的写操作
+_UNCOMMITTED_WRITES = "uncommitted_writes"
+
+
+class RoutingSession(SignallingSession):
+    """读写分离session
+
+    在 use_replica() 中执行的查询会路由到一个从库(每个session随机选择一个),
+    一旦当前session(一般就是当前请求)中发生过写操作: flush, INSERT/UPDATE/DELETE 语句或者进入 safe_commit,
+    之后所有的查询都固定在主库上, 保证读到自己的写入. 设置了 __bind_key__ 的表不参与路由.
+    """
+
+    def __init__(self, db, autocommit=False, autoflush=True, **options):
+        self.db = db
+        super().__init__(db, autocommit=autocommit, autoflush=autoflush, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if isinstance(clause, UpdateBase):
+            self.info[_STICKY_PRIMARY] = True
+            self.info[_UNCOMMITTED_WRITES] = True
+        elif self._should_use_replica(mapper):
+            replica = self._get_replica_bind()
+            if replica is not None:
+                return self.db.get_engine(self.app, bind=replica)
+        # SQLAlchemy>=1.4 会额外传入 bind 等参数, flask-sqlalchemy 2.x 的 get_bind 不接受这些参数
+        return super().get_bind(mapper, clause)
+
+    def _should_use_replica(self, mapper) -> bool:
+        if not self.info.get(_READ_FROM_REPLICA) or self.info.get(_STICKY_PRIMARY):
+            return False
+        return mapper is None or mapper.persist_selectable.info.get("bind_key") is None
+
+    def _get_replica_bind(self):
+        if _REPLICA_BIND not in self.info:
+            binds = [
+                key for key in self.app.config.get("SQLALCHEMY_BINDS") or {} if key.startswith(REPLICA_BIND_PREFIX)
+            ]
+            self.info[_REPLICA_BIND] = random.choice(binds) if binds else None
+        return self.info[_REPLICA_BIND]
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def _stick_after_flush(sess, flush_context, instances):
+    sess.info[_STICKY_PRIMARY] = True
+    sess.info[_UNCOMMITTED_WRITES] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_rollback")
+def _clear_uncommitted_writes(sess):
+    sess.info.pop(_UNCOMMITTED_WRITES, None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 session = db.session
 migrate = Migrate(compare_type=True, compare_server_default=True)
 
 
+@contextmanager
+def use_replica():
+    """在其中执行的查询路由到从库, 也可以作为装饰器使用 @use_replica()
+
+    当前session中发生过写操作之后不再生效, 没有配置从库时使用主库
+    """
+    info = session().info
+    previous = info.get(_READ_FROM_REPLICA, False)
+    info[_READ_FROM_REPLICA] = True
+    try:
+        yield
+    finally:
+        info[_READ_FROM_REPLICA] = previous
+
+
+@contextmanager
+def use_primary():
+    """在其中执行的查询使用主库, 用于外层 use_replica 中需要读取最新数据的查询(如读取之后写入缓存)"""
+    info = session().info
+    previous = info.get(_READ_FROM_REPLICA, False)
+    info[_READ_FROM_REPLICA] = False
+    try:
+        yield
+    finally:
+        info[_READ_FROM_REPLICA] = previous
+
+
+def stick_to_primary():
+    """当前session之后的所有查询都使用主库"""
+    session().info[_STICKY_PRIMARY] = True
+
+
+def has_uncommitted_writes() -> bool:
+    """当前事务中是否有还没有提交(包括还没有flush)的写操作, 此时其他连接看不到这些写入"""
+    sess = session()
+    return bool(sess.info.get(_UNCOMMITTED_WRITES) or sess.new or sess.dirty or sess.deleted)
+
+
 def get_database_uri():
+    if sysconf.DATABASE_URI:
+        return sysconf.DATABASE_URI
+
     return 'mysql+pymysql://%s:%s@%s:%s/%s?charset=%s' % (
         sysconf.MYSQL_USER, sysconf.MYSQL_PASSWD,
         sysconf.MYSQL_HOST, sysconf.MYSQL_PORT,
@@ -23,12 +135,17 @@ def get_database_uri():
     )
 
 
+def get_replica_binds() -> dict:
+    return {f"{REPLICA_BIND_PREFIX}{i}": uri for i, uri in enumerate(sysconf.REPLICA_DATABASE_URIS)}
+
+
 def init_db(app: Flask):
 
     db_uri = get_database_uri()
     app.logger.debug("MYSQL_CONNECT_URL: " + db_uri)
 
     app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
+    app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **get_replica_binds())
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
     if sysconf.USE_DB_POOL:
         app.config["SQLALCHEMY_ENGINE_OPTIONS"] = sysconf.SQLALCHEMY_ENGINE_OPTIONS
@@ -1,2 +1,3 @@
-from base import commit, safe_commit
-from models import *
+# 操作entities的方法合集, 如果entities的操作对象从sqlalchemy变为了mongodb, 只需要修改这里面的方法. 可以直接被service调用.
+from .base import commit, deferred_flush, safe_commit
+from .models import *
@@ -0,0 +1,376 @@
+"""
+异步Model, 基于 SQLAlchemy(>=1.4) 的 asyncio 扩展
+
+过滤条件的语义与 BaseModel 一致: _filter_keys/_range_filter_keys/_like_filter_keys/_fulltext_filter_keys,
+级联删除使用 _children, 关联关系的预加载使用 _load_options(异步session中不能延迟加载关联关系).
+
+    class UserAsyncModel(AsyncBaseModel[User]):
+        _like_filter_keys = ["name"]
+
+    count, users = await UserAsyncModel.get_by_filter(name="foo")
+
+AsyncBaseModel 与 BaseModel 共用 ModelMixin 中的声明与查询构建方法, 不继承 BaseModel 的同步方法,
+只提供本文件中定义的异步方法. _children 中的子表需要同样定义 AsyncBaseModel.
+实体缓存、outbox与归档依赖同步session, 定义时抛出异常.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from weakref import WeakValueDictionary
+
+from sqlalchemy import delete, func, select, update
+
+from configs.sysconf import ID_LIST_CHUNK_SIZE, MAX_PAGE_SIZE
+from initialization.logger_process import logger
+from initialization.sqlalchemy_async_process import get_async_session
+from utils.exceptions import VersionConflict
+
+from .base import _MAX_TREE_DEPTH, EntityType, ModelMixin
+
+
+class AsyncBaseModel(ModelMixin[EntityType]):
+    """异步模型基础类"""
+
+    abstract = True
+
+    # 与同步Model分开注册, 同一个Entity可以同时拥有同步与异步Model
+    _entities_models: WeakValueDictionary = WeakValueDictionary()
+
+    @classmethod
+    async def get_all(cls, active_only: bool = True) -> List[EntityType]:
+        """获取所有的entity对象, 最多返回 MAX_PAGE_SIZE 条, 见 BaseModel.get_all
+
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        """
+        _, entity_list = await cls.get_by_filter(limit=MAX_PAGE_SIZE, require_count=False, active_only=active_only)
+        if len(entity_list) >= MAX_PAGE_SIZE:
+            logger.warning(f"{cls.__name__}.get_all is truncated to MAX_PAGE_SIZE({MAX_PAGE_SIZE}) rows")
+        return entity_list
+
+    @classmethod
+    async def get_by_id(cls, _id: int, active_only: bool = True) -> Optional[EntityType]:
+        """根据id获取entity对象
+
+        :param _id: 主键值
+        :type _id: int
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        """
+        entities = await cls.get_by_id_list([_id], active_only)
+        return entities[0] if entities else None
+
+    @classmethod
+    async def get_by_id_list(cls,
+                             id_list: Iterable,
+                             active_only: bool = True,
+                             _load: Optional[Dict[str, str]] = None) -> List[EntityType]:
+        """根据主键列表获取entity列表, 按照id_list的顺序返回, 重复或者不存在的id会被忽略
+
+        :param id_list: id的列表或者集合
+        :type id_list: List
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        :param _load: 按路径覆盖Model的 _load_options, defaults to None
+        :type _load: Dict[str, str], optional
+        """
+        session = get_async_session()
+        ids = list(dict.fromkeys(id_list))
+        stmt = cls._eager_load(select(cls._entity).where(*cls._get_criteria(active_only)), _load)
+        found = {}
+        for i in range(0, len(ids), ID_LIST_CHUNK_SIZE):
+            result = await session.execute(stmt.where(cls._entity.id.in_(ids[i:i + ID_LIST_CHUNK_SIZE])))
+            found.update((str(entity.id), entity) for entity in result.unique().scalars())
+        return [found[str(_id)] for _id in ids if str(_id) in found]
+
+    @classmethod
+    async def get_all_by_filter(cls,
+                                order_by: str = "id",
+                                order_by_desc: bool = True,
+                                active_only: bool = True,
+                                _filter_keys: List = None,
+                                _range_filter_keys: List = None,
+                                _like_filter_keys: List = None,
+                                _only: Optional[Iterable[str]] = None,
+                                _load: Optional[Dict[str, str]] = None,
+                                **kwargs) -> List[EntityType]:
+        """根据过滤条件获取所有的entity，去除了LIMIT的限制，因此可能是一个危险操作, 参数同 get_by_filter"""
+        stmt = cls._get_filtered_select(active_only,
+                                        _filter_keys=_filter_keys,
+                                        _range_filter_keys=_range_filter_keys,
+                                        _like_filter_keys=_like_filter_keys,
+                                        **kwargs)
+        stmt = cls._eager_load(cls._load_only(cls._order_by(stmt, order_by, order_by_desc), _only), _load)
+        result = await get_async_session().execute(stmt)
+        return result.unique().scalars().all()
+
+    @classmethod
+    async def get_by_filter(cls,
+                            order_by: str = "id",
+                            order_by_desc: bool = True,
+                            offset: int = 0,
+                            limit: int = 10,
+                            require_count: bool = True,
+                            active_only: bool = True,
+                            _filter_keys: List = None,
+                            _range_filter_keys: List = None,
+                            _like_filter_keys: List = None,
+                            _only: Optional[Iterable[str]] = None,
+                            _load: Optional[Dict[str, str]] = None,
+                            **kwargs) -> Tuple[int, List[EntityType]]:
+        """根据条件过滤entity列表，返回 (count, entity_list), 参数与过滤条件同 BaseModel.get_by_filter
+
+        计数只支持精确计数, require_count 为 False 时 count 为0
+        """
+        session = get_async_session()
+        stmt = cls._get_filtered_select(active_only,
+                                        _filter_keys=_filter_keys,
+                                        _range_filter_keys=_range_filter_keys,
+                                        _like_filter_keys=_like_filter_keys,
+                                        **kwargs)
+        count = 0
+        if require_count:
+            count = await session.scalar(select(func.count()).select_from(stmt.subquery()))
+
+        stmt = cls._eager_load(cls._load_only(cls._order_by(stmt, order_by, order_by_desc), _only), _load)
+        result = await session.execute(stmt.limit(limit).offset(offset))
+        return count, result.unique().scalars().all()
+
+    @classmethod
+    async def create(cls, **entity) -> EntityType:
+        """创建一个Entity
+
+        :param **entity 需要传入的字段
+        """
+        session = get_async_session()
+        entity = cls._entity(**entity)
+        session.add(entity)
+        await session.flush()
+        return entity
+
+    @classmethod
+    async def bulk_create(cls, entity_list: List[Dict]) -> List[EntityType]:
+        """批量创建Entity
+
+        :param entity_list 需要创建的entity信息列表
+        """
+        session = get_async_session()
+        instances = [cls._entity(**entity) for entity in entity_list]
+        session.add_all(instances)
+        await session.flush()
+        return instances
+
+    @classmethod
+    async def update(cls,
+                     _id: int,
+                     _reload: bool = True,
+                     expected_version: Optional[int] = None,
+                     **kwargs) -> Union[int, Optional[EntityType]]:
+        """执行一条 UPDATE ... WHERE id = :id 更新传入的字段, 不存在的字段以及主键会被忽略
+
+        entity继承了 VersionBaseEntity 时同时递增版本号, 传入 expected_version 时使用乐观锁,
+        版本号不一致时抛出 VersionConflict(409), 同 BaseModel.update.
+        AsyncBaseModel 不支持实体缓存与outbox(定义时检查), 不需要 BaseModel._on_changed 中的失效与变更记录.
+
+        :param _id: entity主键
+        :type _id: int
+        :param _reload: 是否重新加载并返回更新后的entity, defaults to True
+        :type _reload: bool, optional
+        :param expected_version: 客户端读取到的版本号, defaults to None
+        :type expected_version: int, optional
+        :return: _reload为False时返回影响的行数, 否则返回更新后的entity, 不存在时返回None
+        """
+        session = get_async_session()
+        version_column = cls._entity.__mapper__.version_id_col
+        if expected_version is not None and version_column is None:
+            raise RuntimeError(f"{cls._entity.__name__} has no version_id_col, inherit VersionBaseEntity to use "
+                               f"<expected_version>")
+
+        ignored = {"id"} if version_column is None else {"id", version_column.key}
+        columns = {prop.key for prop in cls._entity.__mapper__.column_attrs}
+        values = {k: v for k, v in kwargs.items() if k in columns and k not in ignored}
+        criteria = [cls._entity.id == _id]
+        if expected_version is not None:
+            criteria.append(version_column == expected_version)
+
+        rowcount = 0
+        if values or expected_version is not None:
+            values.update(cls._next_version_values())
+            result = await session.execute(
+                update(cls._entity).where(*criteria).values(values).execution_options(synchronize_session=False))
+            rowcount = result.rowcount
+            # 只有失败时才需要区分记录不存在与版本冲突
+            if not rowcount and expected_version is not None and await session.scalar(
+                    select(select(cls._entity.id).where(cls._entity.id == _id).exists())):
+                raise VersionConflict(entity=cls._entity.__name__, _id=_id, expected_version=expected_version)
+
+        if not _reload:
+            return rowcount
+        return await session.get(cls._entity, _id, populate_existing=True)
+
+    @classmethod
+    async def delete(cls, _id: int, force_delete=False):
+        """删除entity, 级联删除 _children 中的子表
+
+        :param _id: entity的主键
+        :type _id: int
+        :param force_delete: 是否硬删除, defaults to False
+        :type force_delete: bool, optional
+        """
+        active_only = not force_delete
+        await cls._delete_children([_id], force_delete, active_only)
+        await cls._delete_rows([cls._entity.id == _id], force_delete)
+        return True
+
+    @classmethod
+    async def bulk_delete(cls, id_list: List[int], force_delete=False):
+        """根据id批量删除entity, 级联删除 _children 中的子表
+
+        :param id_list: entity主键列表
+        :type id_list: list
+        :param force_delete: 是否硬删除, defaults to False
+        :type force_delete: bool, optional
+        """
+        await cls._delete_children(id_list, force_delete, not force_delete)
+        await cls._delete_rows([cls._entity.id.in_(id_list)], force_delete)
+
+    @classmethod
+    async def bulk_delete_by_filter(cls,
+                                    force_delete=False,
+                                    active_only=True,
+                                    dry_run=False,
+                                    _filter_keys: List = None,
+                                    _range_filter_keys: List = None,
+                                    _like_filter_keys: List = None,
+                                    **kwargs) -> Dict[str, int]:
+        """根据条件进行删除, 级联删除在数据库端完成, 参数与返回值同 BaseModel.bulk_delete_by_filter"""
+        criteria = cls._get_criteria(active_only,
+                                     _filter_keys=_filter_keys,
+                                     _range_filter_keys=_range_filter_keys,
+                                     _like_filter_keys=_like_filter_keys,
+                                     **kwargs)
+        parents = select(cls._entity.id).where(*criteria)
+
+        report = await cls._delete_children(parents, force_delete, active_only, dry_run)
+        table = cls._entity.__tablename__
+        report[table] = report.get(table, 0) + await cls._delete_rows(criteria, force_delete, dry_run)
+        return report
+
+    @classmethod
+    async def _delete_children(cls,
+                               parents,
+                               force_delete=False,
+                               active_only=True,
+                               dry_run=False,
+                               _report: Dict[str, int] = None,
+                               _path: Tuple = (),
+                               _descend: bool = True) -> Dict[str, int]:
+        """级联删除子表, 父表以主键列表或者子查询的形式嵌入子表的删除语句中, 见 BaseModel._delete_children"""
+        report = {} if _report is None else _report
+        path = _path + (cls, )
+        for child, fk in cls._children or ():
+            child_model = cls._entities_models.get(child)
+            if not child_model:
+                raise RuntimeError(f"ChildEntity {child} is not found!")
+            if child_model is cls:
+                if _descend:
+                    await cls._delete_descendants(parents, fk, force_delete, active_only, dry_run, report, _path)
+                continue
+            if child_model in path:
+                raise RuntimeError(f"Circular _children found: "
+                                   f"{' -> '.join(model.__name__ for model in path + (child_model, ))}")
+
+            child_entity = child_model._entity
+            criteria = child_model._get_criteria(active_only) + [getattr(child_entity, fk).in_(parents)]
+            await child_model._delete_children(select(child_entity.id).where(*criteria),
+                                               force_delete,
+                                               active_only,
+                                               dry_run,
+                                               _report=report,
+                                               _path=path)
+
+            table = child_entity.__tablename__
+            report[table] = report.get(table, 0) + await child_model._delete_rows(criteria, force_delete, dry_run)
+        return report
+
+    @classmethod
+    async def _delete_descendants(cls,
+                                  parents,
+                                  fk: str,
+                                  force_delete=False,
+                                  active_only=True,
+                                  dry_run=False,
+                                  _report: Dict[str, int] = None,
+                                  _path: Tuple = ()) -> Dict[str, int]:
+        """逐层级联删除自关联(树形表)中 parents 的所有后代, 见 BaseModel._delete_descendants"""
+        session = get_async_session()
+        report = {} if _report is None else _report
+        levels = []
+        while True:
+            criteria = cls._get_criteria(active_only) + [
+                getattr(cls._entity, fk).in_(cls._as_derived_table(parents))
+            ]
+            parents = select(cls._entity.id).where(*criteria)
+            if not await session.scalar(select(parents.exists())):
+                break
+            if len(levels) >= _MAX_TREE_DEPTH:
+                raise RuntimeError(f"{cls.__name__}._children {cls._entity.__name__}.{fk} is deeper than "
+                                   f"{_MAX_TREE_DEPTH} levels, or the tree has a cycle")
+            levels.append(criteria)
+
+        table = cls._entity.__tablename__
+        for criteria in reversed(levels):
+            await cls._delete_children(select(cls._entity.id).where(*criteria),
+                                       force_delete,
+                                       active_only,
+                                       dry_run,
+                                       _report=report,
+                                       _path=_path,
+                                       _descend=False)
+            report[table] = report.get(table, 0) + await cls._delete_rows(criteria, force_delete, dry_run)
+        return report
+
+    @classmethod
+    async def _delete_rows(cls, criteria: List, force_delete=False, dry_run=False) -> int:
+        """删除满足条件的记录, 返回影响的行数"""
+        session = get_async_session()
+        if dry_run:
+            return await session.scalar(select(func.count()).select_from(cls._entity).where(*criteria))
+
+        if force_delete:
+            stmt = delete(cls._entity)
+        else:
+            if not hasattr(cls._entity, 'is_deleted'):
+                raise RuntimeError("There is no <is_deleted> object in this model, "
+                                   "and the <delete> func cannot be used")
+            stmt = update(cls._entity).values(is_deleted=True)
+
+        result = await session.execute(stmt.where(*criteria).execution_options(synchronize_session=False))
+        return result.rowcount
+
+    @classmethod
+    def _get_criteria(cls, active_only: bool = True, _extra_criterion=None, **kwargs) -> List:
+        """获取过滤条件列表, 各个条件之间and相连"""
+        criteria = []
+        if active_only:
+            if not hasattr(cls._entity, 'is_deleted'):
+                raise RuntimeError("There is no <is_deleted> object in this model, "
+                                   "and the <active_only> attribute cannot be used")
+            criteria.append(cls._entity.is_deleted == False)  # noqa: E712
+        if _extra_criterion is not None:
+            criteria.append(_extra_criterion)
+
+        clause = cls._build_filter(**kwargs)
+        if clause is not None:
+            criteria.append(clause)
+        return criteria
+
+    @classmethod
+    def _get_filtered_select(cls, active_only: bool = True, **kwargs):
+        """获取经过过滤的select语句"""
+        return select(cls._entity).where(*cls._get_criteria(active_only, **kwargs))
+
+    @classmethod
+    def _order_by(cls, stmt, order_by: str, order_by_desc: bool):
+        if not order_by:
+            return stmt
+        order_column = getattr(cls._entity, order_by)
+        return stmt.order_by(order_column.desc() if order_by_desc else order_column.asc())
@@ -1,16 +1,39 @@
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from functools import wraps
 from itertools import combinations
-from typing import Dict, Generic, Iterable, List, Optional, Set, Tuple, Type, TypeVar, Union
+from typing import (Callable, Dict, FrozenSet, Generic, Iterable, Iterator, List, Optional, Set, Tuple, Type, TypeVar,
+                    Union)
 from weakref import WeakValueDictionary
 
-from sqlalchemy import and_, or_
+from redis.exceptions import RedisError
+from sqlalchemy import Column, DateTime, Index, Table, and_, case, event, func, inspect, literal, or_, select, tuple_
 from sqlalchemy.exc import SQLAlchemyError
-
-from configs.sysconf import MAX_PAGE_SIZE
+from sqlalchemy.orm import Load, load_only
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.expression import ClauseElement
+
+from configs.enums_define import CountStrategy, LoadStrategy, OutboxOp
+from configs.sysconf import (ARCHIVE_BATCH_SIZE, ARCHIVE_BATCH_SLEEP_MS, ARCHIVE_PURGE_DAYS, BULK_INSERT_CHUNK_SIZE,
+                             BULK_UPDATE_CHUNK_SIZE, COUNT_CACHE_TTL, COUNT_CONCURRENCY, ENTITY_CACHE_NEGATIVE_TTL,
+                             FILTER_PLAN_CACHE_SIZE, FULLTEXT_NGRAM_TOKEN_SIZE, ID_LIST_CHUNK_SIZE, MAX_PAGE_SIZE)
 from entities.base import BaseEntity
 from initialization.logger_process import logger
-from initialization.sqlalchemy_process import session
+from initialization.redis_process import get_redis_client
+from initialization.sql_monitor_process import SqlStats, attach_sql_stats, get_sql_stats
+from initialization.sqlalchemy_process import (RoutingSession, has_uncommitted_writes, session, stick_to_primary,
+                                               use_primary, use_replica)
+from utils.common_tools import get_md5
+from utils.cursor_tools import decode_cursor, encode_cursor
+from utils.exceptions import TipResponse, VersionConflict
+from .cache import EntityCache
+from .loader import BatchLoader, Deferred, clear_loaders, get_loader
+from .outbox import record_changes
+from .sql_functions import DateBucket, Explain, Upsert
 
 
 def commit(fn):
@@ -53,6 +76,8 @@ def safe_commit():
                 do()
             raise SQLAlchemyError  # 内部的提交也不会生效
     """
+    # 事务中的读写都使用主库, 并且之后的读取也不再使用从库
+    stick_to_primary()
     try:
         session.begin(subtransactions=True)
         yield session
@@ -62,15 +87,170 @@ def safe_commit():
             session.commit()
 
         session.commit()
+    except VersionConflict:
+        # 乐观锁冲突是预期内的错误, 回滚之后交给调用方处理(如返回409)
+        session.rollback()
+        raise
+    except StaleDataError as e:
+        session.rollback()
+        raise VersionConflict() from e
     except SQLAlchemyError as e:
         session.rollback()
         logger.exception(e)
         raise e
 
 
+# session.info 中记录 deferred_flush 的嵌套层数, 以及等待flush之后通知变更的entity
+_DEFERRED_FLUSH = "deferred_flush_depth"
+_DEFERRED_CHANGES = "deferred_flush_changes"
+
+
+@contextmanager
+def deferred_flush():
+    """
+    推迟Model写入的flush, create/bulk_create/update/delete 等方法不再各自flush, 而是在退出时统一flush一次,
+    由SQLAlchemy的unit of work合并写入(相同字段的UPDATE、指定了主键的INSERT会合并为executemany).
+    一般在 safe_commit/@commit 中使用, 嵌套使用时只有最外层退出时flush:
+
+        with safe_commit(), deferred_flush():
+            for item in items:
+                ItemModel.create(**item)
+
+    新建entity的 id 在flush之后才有值, 需要使用时(例如作为其他表的外键)先调用 session.flush():
+
+        with safe_commit(), deferred_flush() as sess:
+            order = OrderModel.create(**order_info)
+            sess.flush()
+            OrderItemModel.bulk_create([dict(order_id=order.id, **item) for item in items])
+
+    顺序保证:
+        - 排队的写入在退出时、执行查询之前(autoflush)、显式调用 session.flush() 时flush
+        - 同一次flush中, 不同表按照外键依赖的顺序写入, 同一张表的 INSERT 按照调用的顺序写入
+        - bulk_ingest/bulk_upsert/bulk_update/update_by_id/delete 等直接执行sql的方法会先flush排队的写入,
+          因此总是能看到在它之前调用的写入
+        - 新建entity的批量加载器缓存与outbox变更事件在flush之后才会记录
+    """
+    info = session().info
+    depth = info.get(_DEFERRED_FLUSH, 0)
+    info[_DEFERRED_FLUSH] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.flush()
+    finally:
+        info[_DEFERRED_FLUSH] = depth
+
+
+def _is_flush_deferred() -> bool:
+    return session().info.get(_DEFERRED_FLUSH, 0) > 0
+
+
+def _flush():
+    """Model写入之后的flush, 在 deferred_flush 中推迟"""
+    if not _is_flush_deferred():
+        session.flush()
+
+
+def _flush_pending():
+    """直接执行sql之前flush deferred_flush 中排队的写入, 保证语句的执行顺序与调用顺序一致"""
+    if _is_flush_deferred():
+        session.flush()
+
+
+@event.listens_for(RoutingSession, "after_flush_postexec")
+def _notify_deferred_changes(sess, flush_context):
+    """deferred_flush 中新建的entity在flush之后才有id, 此时再通知变更"""
+    changes = sess.info.get(_DEFERRED_CHANGES)
+    if not changes:
+        return
+
+    pending = []
+    for model, entities, op in changes:
+        ids = [entity.id for entity in entities if entity.id is not None]
+        if len(ids) < len(entities):
+            pending.append((model, [entity for entity in entities if entity.id is None], op))
+        if ids:
+            model._on_changed(ids, op)
+    sess.info[_DEFERRED_CHANGES] = pending
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _clear_deferred_changes(sess):
+    sess.info.pop(_DEFERRED_CHANGES, None)
+
+
+# redis不可用时计数缓存每隔一段时间只记录一次警告, 避免每个请求都打印异常堆栈
+_COUNT_CACHE_WARNING_INTERVAL = 60
+_count_cache_warned_at = None
+
+
+def _warn_count_cache_unavailable(e: RedisError):
+    global _count_cache_warned_at
+    now = time.monotonic()
+    if _count_cache_warned_at is not None and now - _count_cache_warned_at < _COUNT_CACHE_WARNING_INTERVAL:
+        return
+    _count_cache_warned_at = now
+    logger.warning(f"count cache is unavailable, fall back to exact count: {e!r}")
+
+
+class Count(int):
+    """带有计数策略的合计值, 行为与int一致
+
+    strategy: 产生该值的计数策略, 见 CountStrategy
+    has_more: 计数策略为 has_more 时, 代表是否存在下一页, 其他策略为None
+    """
+
+    def __new__(cls, value: int, strategy: Optional[str] = None, has_more: Optional[bool] = None):
+        obj = super().__new__(cls, value)
+        obj.strategy = strategy
+        obj.has_more = has_more
+        return obj
+
+
+# 并发计数的线程池, 第一次使用时创建
+_count_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_count_executor() -> ThreadPoolExecutor:
+    global _count_executor
+    if _count_executor is None:
+        _count_executor = ThreadPoolExecutor(max_workers=COUNT_CONCURRENCY, thread_name_prefix="count")
+    return _count_executor
+
+
+def _execute_scalar(bind, statement, stats: Optional[SqlStats] = None):
+    """在 bind 的新连接上执行, 执行的sql计入请求的统计 stats"""
+    with attach_sql_stats(stats), bind.connect() as conn:
+        return conn.execute(statement).scalar()
+
+
+def _match_column_type(column, value) -> bool:
+    """value 的类型是否与字段一致, 用于校验来自客户端的游标值"""
+    if value is None or isinstance(value, (dict, list)):
+        return False
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return True
+
+    if isinstance(value, bool) or python_type is bool:
+        return isinstance(value, bool) and python_type is bool
+    if python_type in (float, Decimal):
+        return isinstance(value, (int, float, Decimal))
+    if python_type is date:
+        return isinstance(value, date) and not isinstance(value, datetime)
+    return isinstance(value, python_type)
+
+
+# 自关联 _children 级联删除的最大层数, 每一层会嵌套两层子查询(mysql 最多嵌套63层)
+_MAX_TREE_DEPTH = 30
+
 # 可变映射，值是对象的弱引用
 _entities_models = WeakValueDictionary()
 
+# 依赖同步session的功能, 只能在 BaseModel 中开启
+_SYNC_ONLY_FEATURES = ("_cache_ttl", "_outbox", "_archive_retention_days")
+
 EntityType = TypeVar("EntityType", bound=BaseEntity)
 
 
@@ -94,7 +274,7 @@ class ModelMetaClass(type):
 
         if not attrs.get("_entity"):  # 如果 _entity 没有设置，可以去寻找 Model[Entity] 中的值
             orig_bases = attrs.get("__orig_bases__") or []
-            base = [b for i in orig_bases for b in i.__args__ if issubclass(b, BaseEntity)]
+            base = [b for i in orig_bases for b in getattr(i, "__args__", ()) if issubclass(b, BaseEntity)]
             if len(base) < 1:
                 raise AttributeError("class {} should set these class attributes: _entity or define Model "
                                      "class yourModel(BaseModel[yourEntity])".format(name))
@@ -128,7 +308,8 @@ class ModelMetaClass(type):
             attrs['_filter_keys'] = filters
 
         cls = type.__new__(mcs, name, bases, attrs)
-        cls._entities_models = _entities_models
+        cls._filter_keys_cache = {}
+        cls._load_options_cache = {}
 
         entity = attrs["_entity"]
         does_not_exists = (filters | ranges | likes) - set(entity.__table__.columns.keys())
@@ -138,27 +319,515 @@ class ModelMetaClass(type):
 
         cls._overlap_detect(filters, ranges, likes)
 
+        fulltexts = set(attrs.get("_fulltext_filter_keys") or [])
+        if fulltexts - likes:
+            raise AttributeError(f"class {name}'s _fulltext_filter_keys {fulltexts - likes} "
+                                 f"should be in _like_filter_keys")
+        cls._fulltext_filter_keys = fulltexts
+        # 绑定到表上, create_all 建表时一并创建, 已经存在的表使用 create_fulltext_indexes 补充
+        table_indexes = {index.name: index for index in entity.__table__.indexes}
+        cls._fulltext_indexes = []
+        for key in sorted(fulltexts):
+            index_name = f"ft_{entity.__tablename__}_{key}"
+            index = table_indexes.get(index_name) or Index(
+                index_name, entity.__table__.c[key], mysql_prefix="FULLTEXT", mysql_with_parser="ngram")
+            cls._fulltext_indexes.append(index)
+
+        if hasattr(cls, "_shard_key"):
+            shard_key = cls._shard_key
+            if not shard_key or shard_key not in entity.__table__.columns:
+                raise AttributeError(f"class {entity.__name__} does not have shard key <{shard_key}>")
+            # 这些功能依赖主库上的关联查询或者同一个事务, 分片Model不支持
+            unsupported = [
+                key for key in ("_children", "_load_options", *_SYNC_ONLY_FEATURES) if getattr(cls, key, None)
+            ]
+            if unsupported:
+                raise AttributeError(f"sharded class {name} does not support {unsupported}")
+
+        if issubclass(cls, BaseModel):
+            cls._entity_cache = EntityCache(entity, cls._cache_ttl, cls._cache_negative_ttl) if cls._cache_ttl else None
+            cls._archive_table = mcs._build_archive_table(cls) if cls._archive_retention_days else None
+        else:
+            # 实体缓存、outbox与归档都在同步session上执行, 只有 BaseModel 支持
+            unsupported = [key for key in _SYNC_ONLY_FEATURES if getattr(cls, key, None)]
+            if unsupported:
+                raise AttributeError(f"class {name} does not support {unsupported}, they require BaseModel")
+
         cls._entities_models[entity.__name__] = cls
 
         return cls
 
+    @staticmethod
+    def _build_archive_table(cls) -> Table:
+        """创建 <table>_archive 镜像表, 字段与原表一致(不包含索引与约束), 增加 archived_at 记录归档时间"""
+        entity = cls._entity
+        for key in ("is_deleted", cls._archive_time_column):
+            if key not in entity.__table__.c:
+                raise AttributeError(f"class {entity.__name__} should have column <{key}> to be archived")
+
+        name = f"{entity.__tablename__}_archive"
+        metadata = entity.__table__.metadata
+        if name in metadata.tables:
+            return metadata.tables[name]
+
+        columns = [
+            Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+            for column in entity.__table__.columns
+        ]
+        columns.append(Column("archived_at", DateTime, nullable=False, index=True, comment="归档时间"))
+        return Table(name, metadata, *columns, comment=f"{entity.__tablename__} 的归档表")
+
+
+class ModelMixin(Generic[EntityType], metaclass=ModelMetaClass):
+    """同步与异步Model共用的部分: entity与过滤条件、级联、预加载的声明, 以及与session无关的查询构建方法
+
+    子类需要提供自己的 _entities_models 注册表
+    """
 
-class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
-    """模型基础类"""
-
-    # 如果希望自己定义增强的 BaseModel 可以设置 abstract 为 True
     abstract = True
 
     _entity: Type[EntityType]
 
+    # Entity名称到Model的注册表, 用于 _children 级联, 由ModelMetaClass注册
+    _entities_models: WeakValueDictionary
+
     # filters
     _filter_keys: Union[List, Set] = []
     _range_filter_keys: Union[List, Set] = []
     _like_filter_keys: Union[List, Set] = []
+    # 使用 MySQL FULLTEXT(ngram) 索引代替 like 的字段, 必须同时在 _like_filter_keys 中
+    _fulltext_filter_keys: Union[List, Set] = []
+    _fulltext_indexes: List[Index] = []
+
+    # 过滤条件缓存, 由ModelMetaClass为每个Model单独创建
+    _filter_keys_cache: Dict[Tuple, Tuple[FrozenSet, FrozenSet, FrozenSet]]
+
+    # 关联关系的预加载策略, 关联路径使用.连接, 策略见 LoadStrategy, 如
+    # _load_options = {"tags": "selectin", "author": "joined", "author.company": "selectin"}
+    # get_by_filter/get_all_by_filter/get_by_id_list 自动使用, 可以通过 _load 参数按路径覆盖
+    _load_options: Dict[str, str] = {}
+    _load_options_cache: Dict[Tuple, List]
 
     # children
     _children: Union[List, Set] = []
 
+    @classmethod
+    def _build_filter(cls, **kwargs) -> Optional[ClauseElement]:
+        """根据Model允许的过滤条件构建filter对象, 各个条件之间and相连, 没有任何过滤条件时返回None
+
+        值都会作为绑定参数, SQLAlchemy 会按照语句的结构缓存编译结果, 这里不需要再缓存表达式
+        """
+        filter_keys, like_filter_keys, range_filter_keys = cls._custom_filter_once(**kwargs)
+
+        and_list = []
+        like_filters = []
+        for key, value in kwargs.items():
+            # FIXME: 这个可能不能过滤None的查询
+            if value is None:
+                continue
+
+            if key in filter_keys:
+                column = getattr(cls._entity, key)
+                if isinstance(value, (list, tuple, set)):
+                    and_list.append(column.in_(list(value)))
+                else:
+                    and_list.append(column == value)
+
+            elif key in range_filter_keys:
+                column = getattr(cls._entity, key)
+                start, end = value or (None, None)
+                if start:
+                    and_list.append(column >= start)
+                if end:
+                    and_list.append(column <= end)
+
+            elif key in like_filter_keys:
+                column = getattr(cls._entity, key)
+                # 相对于之前的like方法可以支持同一个属性多个筛选条件，条件之间通过|来区分
+                like_values = value.split('|')
+                if key in cls._fulltext_filter_keys and \
+                        all(len(like_value) >= FULLTEXT_NGRAM_TOKEN_SIZE for like_value in like_values):
+                    # MySQL: MATCH (column) AGAINST (:value IN BOOLEAN MODE),
+                    # boolean mode 下没有 +/- 修饰的短语之间是或的关系, 与 | 的语义一致
+                    like_filters.append(column.match(" ".join('"{}"'.format(v.replace('"', " ")) for v in like_values)))
+                else:
+                    # 短于 ngram_token_size 的词无法命中全文索引, 退回like
+                    like_filters.extend(column.like(f"%{like_value}%") for like_value in like_values)
+
+        if like_filters:
+            and_list.append(or_(*like_filters))
+        if not and_list:
+            return None
+        return and_(*and_list)
+
+    @classmethod
+    def _custom_filter_once(cls, **kwargs) -> Tuple[Set, Set, Set]:
+        """针对本次查询的过滤条件, 结果按本次传入的 _filter_keys 等参数缓存在Model中"""
+        once_keys = (
+            frozenset(kwargs.get("_filter_keys") or []),
+            frozenset(kwargs.get("_range_filter_keys") or []),
+            frozenset(kwargs.get("_like_filter_keys") or []),
+        )
+        try:
+            return cls._filter_keys_cache[once_keys]
+        except KeyError:
+            pass
+
+        filter_keys = set(cls._filter_keys)
+        range_filter_keys = set(cls._range_filter_keys)
+        like_filter_keys = set(cls._like_filter_keys)
+
+        once_filter_keys, once_range_filter_keys, once_like_filter_keys = once_keys
+
+        # 检查重复
+        if any((once_filter_keys, once_like_filter_keys, once_range_filter_keys)):
+            cls._overlap_detect(once_filter_keys, once_like_filter_keys, once_range_filter_keys)
+            # 获取新的过滤
+            filter_keys = (filter_keys | once_filter_keys) - (once_range_filter_keys | once_like_filter_keys)
+            like_filter_keys = (like_filter_keys | once_like_filter_keys) - (once_range_filter_keys | once_filter_keys)
+            range_filter_keys = (range_filter_keys | once_range_filter_keys) - \
+                (once_like_filter_keys | once_filter_keys)
+
+        result = (frozenset(filter_keys), frozenset(like_filter_keys), frozenset(range_filter_keys))
+        if len(cls._filter_keys_cache) >= FILTER_PLAN_CACHE_SIZE:
+            cls._filter_keys_cache.clear()
+        cls._filter_keys_cache[once_keys] = result
+        return result
+
+    @classmethod
+    def _eager_load(cls, query, load: Optional[Dict[str, str]] = None):
+        """为query添加关联关系的加载策略, load 按路径覆盖Model的 _load_options"""
+        plan = dict(cls._load_options, **load) if load else cls._load_options
+        if not plan:
+            return query
+
+        key = tuple(sorted(plan.items()))
+        try:
+            options = cls._load_options_cache[key]
+        except KeyError:
+            options = cls._build_load_options(plan)
+            if len(cls._load_options_cache) >= FILTER_PLAN_CACHE_SIZE:
+                cls._load_options_cache.clear()
+            cls._load_options_cache[key] = options
+        return query.options(*options)
+
+    @classmethod
+    def _build_load_options(cls, plan: Dict[str, str]) -> List:
+        """将 {关联路径: 策略} 转化为 loader option, 路径中的上级关联保持自身的策略"""
+        loaders = {
+            LoadStrategy.SELECTIN.value: "selectinload",
+            LoadStrategy.JOINED.value: "joinedload",
+            LoadStrategy.SUBQUERY.value: "subqueryload",
+            LoadStrategy.LAZY.value: "lazyload",
+            LoadStrategy.RAISE.value: "raiseload",
+            LoadStrategy.NOLOAD.value: "noload",
+        }
+        options = []
+        for path, strategy in plan.items():
+            if strategy not in loaders:
+                raise ValueError(f"load strategy should be one of {LoadStrategy.values()}, got {strategy}")
+
+            mapper = cls._entity.__mapper__
+            attrs = []
+            for name in path.split("."):
+                if name not in mapper.relationships:
+                    raise AttributeError(f"{mapper.class_.__name__} has no relationship {name} in path {path}")
+                attrs.append(getattr(mapper.class_, name))
+                mapper = mapper.relationships[name].mapper
+
+            option = Load(cls._entity)
+            for attr in attrs[:-1]:
+                option = option.defaultload(attr)
+            options.append(getattr(option, loaders[strategy])(attrs[-1]))
+        return options
+
+    @classmethod
+    def _load_only(cls, query, only: Optional[Iterable[str]]):
+        """只查询 only 中的数据库字段, 主键总是会被查询"""
+        if not only:
+            return query
+        columns = {prop.key for prop in cls._entity.__mapper__.column_attrs}
+        keys = [key for key in dict.fromkeys(only) if key in columns]
+        return query.options(load_only(*keys)) if keys else query
+
+    @classmethod
+    def _next_version_values(cls) -> Dict:
+        """不经过ORM的UPDATE需要自行递增版本号"""
+        version_column = cls._entity.__mapper__.version_id_col
+        if version_column is None:
+            return {}
+        return {version_column.key: version_column + 1}
+
+    @staticmethod
+    def _as_derived_table(parents):
+        """将父表的子查询包装为派生表: mysql 不允许 UPDATE/DELETE 的子查询中引用被修改的表(1093), 派生表会先物化"""
+        if not isinstance(parents, ClauseElement):
+            return parents
+        derived = parents.alias()
+        return select([list(derived.c)[0]]).select_from(derived)
+
+
+class SyncModelMixin(ModelMixin[EntityType]):
+    """BaseModel 与 ShardedBaseModel 共用的同步写入方法, 在传入的session(默认为 session)上执行
+
+    实体缓存、outbox等变更通知由子类覆盖 _on_changed 实现
+    """
+
+    abstract = True
+
+    @classmethod
+    def _on_changed(cls, ids: Optional[Iterable], op: Optional[str] = None, payload: Optional[Dict] = None):
+        """数据发生变更之后调用, 见 BaseModel._on_changed, 默认不需要通知"""
+
+    @classmethod
+    def _tracks_changed_ids(cls) -> bool:
+        """_on_changed 是否需要变更的id, 为False时可以省去查询id的语句"""
+        return False
+
+    @classmethod
+    def _get_base_query(cls, active_only: bool = True):
+        """获取BaseQuery对象, active_only为True时过滤软删除的记录"""
+        if not active_only:
+            return cls._entity.query
+
+        if not hasattr(cls._entity, 'active_query'):
+            raise RuntimeError("There is no <active_query> object in this model, "
+                               "and the <active_only> attribute cannot be used")
+        return cls._entity.active_query
+
+    @classmethod
+    def _get_filtered_query(cls, active_only, _extra_criterion: Optional[ClauseElement] = None, **kwargs):
+        """获取经过过滤的BaseQuery对象, _extra_criterion 为额外的过滤条件(如关联表的子查询), 与其他条件and相连"""
+        q = cls._get_base_query(active_only)
+        if _extra_criterion is not None:
+            q = q.filter(_extra_criterion)
+        # handle filter_keys
+        clause = cls._build_filter(**kwargs)
+        if clause is not None:
+            q = q.filter(clause)
+        return q
+
+    @classmethod
+    def _fill_insert_defaults(cls, entity_list: List[Dict]) -> List[Dict]:
+        """补全批量写入的字段, 所有行使用相同的字段, 字段默认值在每次调用时只计算一次"""
+        defaults = {}
+        for column in cls._entity.__table__.columns:
+            default = column.default
+            if default is None or default.is_sequence:
+                continue
+            defaults[column.key] = default.arg(None) if default.is_callable else default.arg
+
+        keys = set(defaults)
+        for entity in entity_list:
+            keys.update(entity)
+
+        return [{key: entity[key] if key in entity else defaults.get(key) for key in keys} for entity in entity_list]
+
+    @classmethod
+    def _bulk_upsert(cls,
+                     sess,
+                     entity_list: List[Dict],
+                     conflict_keys: List[str],
+                     update_columns: Optional[List[str]] = None,
+                     chunk_size: Optional[int] = None) -> Dict[str, int]:
+        """在 sess 上执行 bulk_upsert"""
+        report = {"inserted": 0, "updated": 0, "unchanged": 0}
+        if not entity_list:
+            return report
+
+        table = cls._entity.__table__
+        if not conflict_keys or any(key not in table.c for key in conflict_keys):
+            raise ValueError(f"conflict_keys should be columns of {table.name}, got {conflict_keys}")
+
+        # 按照冲突字段去重, 后面的行覆盖前面的行
+        entity_list = list({tuple(entity.get(key) for key in conflict_keys): entity for entity in entity_list}.values())
+        # 字段不同的行分开写入, 避免缺少的字段在更新时被覆盖为NULL
+        groups: Dict[FrozenSet[str], List[Dict]] = {}
+        for entity in entity_list:
+            groups.setdefault(frozenset(entity), []).append(entity)
+
+        key_columns = [table.c[key] for key in conflict_keys]
+        chunk_size = chunk_size or BULK_INSERT_CHUNK_SIZE
+        changed_ids = []
+        version_values = cls._next_version_values()
+        for keys, group in groups.items():
+            columns = keys - {*conflict_keys, "id", "create_time"} if update_columns is None else update_columns
+            set_ = {key: None for key in columns if key in table.c and key not in version_values}
+            if set_:
+                for column in table.columns:
+                    if column.onupdate is not None and column.key not in set_:
+                        onupdate = column.onupdate
+                        value = onupdate.arg(None) if onupdate.is_callable else onupdate.arg
+                        set_[column.key] = literal(value, type_=column.type)
+                # 更新已有记录时递增版本号, 使持有旧版本号的乐观锁更新失败
+                set_.update(version_values)
+
+            rows = cls._fill_insert_defaults(group)
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                values = [tuple(row[key] for key in conflict_keys) for row in chunk]
+                key_filter = key_columns[0].in_([value[0] for value in values]) if len(key_columns) == 1 else \
+                    tuple_(*key_columns).in_(values)
+                existing_ids = [row[0] for row in sess.execute(select([table.c.id]).where(key_filter))]
+
+                sess.execute(Upsert(table, chunk, conflict_keys, set_))
+                report["inserted"] += len(chunk) - len(existing_ids)
+                if not set_:
+                    # 没有需要更新的字段时冲突的行保持不变
+                    report["unchanged"] += len(existing_ids)
+                    existing_ids = []
+                report["updated"] += len(existing_ids)
+                changed_ids.extend(existing_ids)
+                if cls._tracks_changed_ids():
+                    cls._on_changed(existing_ids, OutboxOp.UPDATE.value)
+                    created_ids = [row[0] for row in sess.execute(
+                        select([table.c.id]).where(and_(key_filter, table.c.id.notin_(existing_ids))))]
+                    cls._on_changed(created_ids, OutboxOp.CREATE.value)
+                changed_ids.extend(row["id"] for row in chunk if row.get("id") is not None)
+
+        cls._expire_identities(changed_ids, sess)
+        cls._on_changed(changed_ids)
+        return report
+
+    @classmethod
+    def _update_if_version(cls, _id: int, expected_version: int, _session=None, **kwargs) -> Optional[EntityType]:
+        """版本号一致时才更新, 见 update, _session 默认为 session"""
+        sess = session if _session is None else _session
+        version_column = cls._entity.__mapper__.version_id_col
+        if version_column is None:
+            raise RuntimeError(f"{cls._entity.__name__} has no version_id_col, inherit VersionBaseEntity to use "
+                               f"<expected_version>")
+
+        columns = {prop.key for prop in cls._entity.__mapper__.column_attrs}
+        values = {k: v for k, v in kwargs.items() if k in columns and k not in ("id", version_column.key)}
+        values.update(cls._next_version_values())
+
+        rowcount = sess.query(cls._entity).filter(cls._entity.id == _id, version_column == expected_version).update(
+            values, synchronize_session=False)
+        if not rowcount:
+            # 只有失败时才需要区分记录不存在与版本冲突
+            if not sess.query(sess.query(cls._entity).filter(cls._entity.id == _id).exists()).scalar():
+                return None
+            raise VersionConflict(entity=cls._entity.__name__, _id=_id, expected_version=expected_version)
+
+        cls._expire_identities([_id], sess)
+        cls._on_changed([_id], OutboxOp.UPDATE.value, {"fields": ",".join(sorted(values))})
+        return sess.query(cls._entity).get(_id)
+
+    @classmethod
+    def _bulk_update(cls,
+                     sess,
+                     entity_list: List[Dict],
+                     set_based: bool = False,
+                     chunk_size: Optional[int] = None) -> int:
+        """在 sess 上执行 bulk_update, set_based 为False时需要调用方flush"""
+        if set_based:
+            return cls._bulk_update_by_case(entity_list, chunk_size or BULK_UPDATE_CHUNK_SIZE, sess)
+
+        version_column = cls._entity.__mapper__.version_id_col
+        if version_column is not None and any(version_column.key not in entity for entity in entity_list):
+            raise ValueError(f"every row of {cls._entity.__name__} should contain <{version_column.key}> "
+                             f"for optimistic locking, or use set_based=True")
+        sess.bulk_update_mappings(cls._entity, entity_list)
+        return len(entity_list)
+
+    @classmethod
+    def _bulk_update_by_case(cls, entity_list: List[Dict], chunk_size: int, _session=None) -> int:
+        """按照需要更新的字段分组, 分块执行 CASE 更新, 同一个id出现多次时以最后一次为准, _session 默认为 session"""
+        sess = session if _session is None else _session
+        table = cls._entity.__table__
+        id_column = table.c.id
+        version_values = cls._next_version_values()
+
+        groups: Dict[Tuple[str, ...], Dict] = {}
+        for entity in entity_list:
+            columns = tuple(sorted(key for key in entity if key != "id" and key not in version_values))
+            if columns:
+                groups.setdefault(columns, {})[entity["id"]] = entity
+
+        affected = 0
+        for columns, rows in groups.items():
+            rows = list(rows.values())
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                values = {
+                    column: case(
+                        [(row["id"], literal(row[column], type_=table.c[column].type)) for row in chunk],
+                        value=id_column,
+                        else_=table.c[column],
+                    )
+                    for column in columns
+                }
+                values.update(version_values)
+                result = sess.execute(table.update().where(id_column.in_([row["id"] for row in chunk])).values(values))
+                affected += result.rowcount
+
+        cls._expire_identities((entity["id"] for entity in entity_list), sess)
+        return affected
+
+    @classmethod
+    def _expire_identities(cls, ids: Iterable, _session=None):
+        """使用Core语句更新之后, 过期session(默认为 session)中对应的entity, 下次访问时重新加载"""
+        sess = session if _session is None else _session
+        mapper = cls._entity.__mapper__
+        for _id in ids:
+            instance = sess.identity_map.get(mapper.identity_key_from_primary_key([_id]))
+            if instance is not None:
+                sess.expire(instance)
+
+    @classmethod
+    def _delete_rows(cls, query, force_delete=False, dry_run=False, ids: Optional[Iterable] = None) -> int:
+        """删除query选中的记录, 返回影响的行数
+
+        没有传入ids时, 只有 _on_changed 需要变更的id(如启用了实体缓存或者outbox)才会查询被删除的主键
+        """
+        if dry_run:
+            return query.order_by(None).count()
+
+        if not force_delete and not hasattr(cls._entity, 'is_deleted'):
+            raise RuntimeError("There is no <is_deleted> object in this model, "
+                               "and the <delete> func cannot be used")
+
+        if ids is None and cls._tracks_changed_ids():
+            ids = [row.id for row in query.with_entities(cls._entity.id)]
+
+        if force_delete:
+            rowcount = query.delete(synchronize_session=False)
+        else:
+            rowcount = query.update({"is_deleted": True}, synchronize_session=False)
+        cls._on_changed(ids, OutboxOp.DELETE.value, None if force_delete else {"soft": True})
+        return rowcount
+
+
+class BaseModel(SyncModelMixin[EntityType]):
+    """模型基础类"""
+
+    # 如果希望自己定义增强的 BaseModel 可以设置 abstract 为 True
+    abstract = True
+
+    _entities_models: WeakValueDictionary = _entities_models
+
+    # 实体缓存, _cache_ttl 大于0时开启, 由ModelMetaClass创建 _entity_cache
+    _cache_ttl: int = 0
+    _cache_negative_ttl: int = ENTITY_CACHE_NEGATIVE_TTL
+    _entity_cache: Optional[EntityCache] = None
+
+    # 归档, _archive_retention_days 大于0时开启, 由ModelMetaClass创建 <table>_archive 镜像表 _archive_table,
+    # 软删除并且 _archive_time_column 早于保留天数的记录可以通过 archive_deleted 移动到归档表
+    _archive_retention_days: int = 0
+    _archive_time_column: str = "update_time"
+    _archive_purge_days: int = ARCHIVE_PURGE_DAYS
+    _archive_table: Optional[Table] = None
+
+    # 是否在写入时向 outbox 表追加变更事件, 见 models/outbox.py
+    _outbox: bool = False
+
+    # count, 见 CountStrategy
+    _count_strategy: str = CountStrategy.EXACT.value
+    # 是否在另一个连接上与分页查询并发执行精确计数, 见 get_by_filter 的 concurrent_count
+    _concurrent_count: bool = False
+    _count_cache_ttl: int = COUNT_CACHE_TTL
+
     @classmethod
     def get_all(cls, active_only: bool = True) -> List[EntityType]:
         """
@@ -169,49 +838,127 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         :type active_only: bool, optional
         :return: 查询的entity对象列表
         """
-        _, entity_list = cls.get_by_filter(limit=MAX_PAGE_SIZE, active_only=active_only)
+        _, entity_list = cls.get_by_filter(limit=MAX_PAGE_SIZE, require_count=False, active_only=active_only)
+        if len(entity_list) >= MAX_PAGE_SIZE:
+            logger.warning(f"{cls.__name__}.get_all is truncated to MAX_PAGE_SIZE({MAX_PAGE_SIZE}) rows, "
+                           f"use iter_by_filter to walk the whole table")
         return entity_list
 
     @classmethod
+    @use_replica()
     def get_by_id(cls, _id: int, active_only: bool = True) -> Optional[EntityType]:
         """根据id获取entity对象
 
+        在请求中会使用请求级别的批量加载器, 与之前通过 load 登记的id合并为一次查询, 结果在请求内缓存;
+        设置了 _cache_ttl 的Model会优先从redis缓存中获取
+
         :param _id: 主键值
         :type _id: int
         :param active_only: 是否包含软删除的记录, defaults to False
         :type active_only: bool, optional
         """
+        loader = get_loader(cls, active_only)
+        if loader is not None:
+            return loader.load(_id).get()
 
-        q = cls._entity.query
-        if active_only:
-            if not hasattr(cls._entity, 'active_query'):
-                raise RuntimeError("There is no <active_query> object in this model, "
-                                   "and the <active_only> attribute cannot be used")
-            q = cls._entity.active_query
-
-        q = q.filter(cls._entity.id == _id)
-        return q.first()
+        entities = cls._fetch_by_id_list([_id], active_only)
+        return entities[0] if entities else None
 
     @classmethod
-    def get_by_id_list(cls, id_list: Iterable, active_only: bool = True) -> List[EntityType]:
-        """根据主键列表获取entity列表
+    @use_replica()
+    def get_by_id_list(cls,
+                       id_list: Iterable,
+                       active_only: bool = True,
+                       _load: Optional[Dict[str, str]] = None) -> List[EntityType]:
+        """根据主键列表获取entity列表, 按照id_list的顺序返回, 重复或者不存在的id会被忽略
+
+        在请求中会使用请求级别的批量加载器, 结果在请求内缓存;
+        设置了 _cache_ttl 的Model会优先从redis缓存中获取, 从缓存中获取的entity不会预加载关联关系
 
         :param id_list: id的列表或者集合
         :type id_list: List
         :param active_only: 是否包含软删除的记录, defaults to False
         :type active_only: bool, optional
+        :param _load: 按路径覆盖Model的 _load_options, 传入时不使用请求级别的批量加载器, defaults to None
+        :type _load: Dict[str, str], optional
         """
-        q = cls._entity.query
-        if active_only:
-            if not hasattr(cls._entity, 'active_query'):
-                raise RuntimeError("There is no <active_query> object in this model, "
-                                   "and the <active_only> attribute cannot be used")
-            q = cls._entity.active_query
+        loader = get_loader(cls, active_only)
+        if loader is not None and _load is None:
+            return loader.load_many(id_list)
+
+        return cls._fetch_by_id_list(id_list, active_only, _load)
+
+    @classmethod
+    def load(cls, _id: int, active_only: bool = True) -> Deferred:
+        """登记需要获取的id, 返回一个延迟获取的对象, 调用其 get 方法时, 当前请求中所有登记过的id会通过一次查询获取
+
+            deferred_list = [UserModel.load(_id) for _id in user_ids]
+            users = [deferred.get() for deferred in deferred_list]
+
+        :param _id: 主键值
+        :type _id: int
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        """
+        loader = get_loader(cls, active_only) or BatchLoader(cls, active_only)
+        return loader.load(_id)
+
+    @classmethod
+    def _fetch_by_id_list(cls,
+                          id_list: Iterable,
+                          active_only: bool = True,
+                          load: Optional[Dict[str, str]] = None) -> List[EntityType]:
+        """根据主键列表获取entity列表, 按照id_list的顺序返回"""
+        ids = list(dict.fromkeys(str(_id) for _id in id_list))
+        if cls._entity_cache is not None:
+            return cls._get_by_id_list_cached(ids, active_only, load)
+
+        found = cls._query_by_id_list(ids, active_only, load)
+        return [found[_id] for _id in ids if _id in found]
+
+    @classmethod
+    def _query_by_id_list(cls,
+                          ids: List[str],
+                          active_only: bool = True,
+                          load: Optional[Dict[str, str]] = None) -> Dict[str, EntityType]:
+        """将id列表切分为不超过 ID_LIST_CHUNK_SIZE 的块进行 IN 查询, 返回 str(id) 到entity的字典"""
+        q = cls._eager_load(cls._get_base_query(active_only), load)
+        found = {}
+        for i in range(0, len(ids), ID_LIST_CHUNK_SIZE):
+            chunk = ids[i:i + ID_LIST_CHUNK_SIZE]
+            found.update((str(entity.id), entity) for entity in q.filter(cls._entity.id.in_(chunk)).all())
+        return found
+
+    @classmethod
+    def _get_by_id_list_cached(cls,
+                               ids: List[str],
+                               active_only: bool = True,
+                               load: Optional[Dict[str, str]] = None) -> List[EntityType]:
+        """读穿缓存: 使用 MGET 批量获取缓存, 未命中的id从主库中获取并写入缓存, 不存在的id写入负缓存
+
+        缓存中保存的是包含软删除记录的原始数据, active_only 在获取之后进行过滤
+        """
+        if active_only and not hasattr(cls._entity, 'active_query'):
+            raise RuntimeError("There is no <active_query> object in this model, "
+                               "and the <active_only> attribute cannot be used")
 
-        q = q.filter(cls._entity.id.in_(id_list))
-        return q.all()
+        found, missing = cls._entity_cache.get_many(ids)
+
+        misses = [_id for _id in ids if _id not in found and _id not in missing]
+        if misses:
+            # 读取的结果会写入缓存, 从库的复制延迟会让旧数据一直保留到缓存过期, 因此未命中的id从主库读取
+            with use_primary():
+                loaded = cls._query_by_id_list(misses, active_only=False, load=load)
+            found.update(loaded)
+            cls._entity_cache.set_many(loaded.values(), [_id for _id in misses if _id not in loaded])
+
+        entities = [found[_id] for _id in ids if _id in found]
+        if active_only:
+            entities = [entity for entity in entities if entity.is_deleted is False]
+        return entities
 
     @classmethod
+    @use_replica()
     def get_all_by_filter(
         cls,
         order_by: str = "id",
@@ -220,11 +967,16 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         _filter_keys: List = None,
         _range_filter_keys: List = None,
         _like_filter_keys: List = None,
+        _only: Optional[Iterable[str]] = None,
+        _load: Optional[Dict[str, str]] = None,
         **kwargs,
     ) -> List[EntityType]:
         """
         根据过滤条件获取所有的entity，去除了LIMIT的限制，
         因此可能是一个危险操作
+
+        _only: 只查询的字段, 同 get_by_filter
+        _load: 按路径覆盖Model的 _load_options, 同 get_by_filter
         """
         query = cls._get_full_query(order_by,
                                     order_by_desc,
@@ -233,9 +985,80 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
                                     _filter_keys=_filter_keys,
                                     _range_filter_keys=_range_filter_keys,
                                     _like_filter_keys=_like_filter_keys)
-        return query.all()
+        return cls._eager_load(cls._load_only(query, _only), _load).all()
+
+    @classmethod
+    def iter_by_filter(cls,
+                       order_by: str = "id",
+                       order_by_desc: bool = False,
+                       active_only: bool = True,
+                       batch_size: int = 1000,
+                       as_batches: bool = False,
+                       expunge: bool = True,
+                       _filter_keys: List = None,
+                       _range_filter_keys: List = None,
+                       _like_filter_keys: List = None,
+                       **kwargs) -> Iterator[Union[EntityType, List[EntityType]]]:
+        """流式遍历过滤之后的所有entity, 适用于导出, 回填, 重建索引等需要遍历全表的任务
+
+        使用服务端游标(PyMySQL 的 SSCursor, 即 stream_results)配合 yield_per 分批获取,
+        每一批处理完之后将entity从session中移除, 内存占用与表的大小无关.
+
+        注意事项:
+        1. 服务端游标会占用当前连接直到遍历结束, 遍历过程中不能在同一个session中执行其他sql,
+           需要写入的数据可以先收集起来, 遍历结束后再写入, 或者使用其他session
+        2. expunge=True 时, 对entity的修改不会被flush, 需要修改时请设置为False
+
+        :param order_by: 排序字段, defaults to "id"
+        :type order_by: str, optional
+        :param order_by_desc: 是否倒序, defaults to False
+        :type order_by_desc: bool, optional
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        :param batch_size: 每一批从数据库获取的行数, defaults to 1000
+        :type batch_size: int, optional
+        :param as_batches: 为True时每次产出一批entity的列表, 否则逐个产出entity, defaults to False
+        :type as_batches: bool, optional
+        :param expunge: 每一批处理完之后是否从session中移除, defaults to True
+        :type expunge: bool, optional
+        :param **kwargs: 过滤条件, 同 get_by_filter
+        """
+        query = cls._get_full_query(
+            order_by,
+            order_by_desc,
+            active_only,
+            _filter_keys=_filter_keys,
+            _range_filter_keys=_range_filter_keys,
+            _like_filter_keys=_like_filter_keys,
+            **kwargs,
+        ).execution_options(stream_results=True).yield_per(batch_size)
+
+        batch = []
+        for entity in query:
+            batch.append(entity)
+            if len(batch) < batch_size:
+                continue
+
+            yield from cls._yield_batch(batch, as_batches, expunge)
+            batch = []
+
+        if batch:
+            yield from cls._yield_batch(batch, as_batches, expunge)
+
+    @staticmethod
+    def _yield_batch(batch: List, as_batches: bool, expunge: bool):
+        """产出一批entity, 处理完之后从session中移除"""
+        if as_batches:
+            yield batch
+        else:
+            yield from batch
+
+        if expunge:
+            for entity in batch:
+                session.expunge(entity)
 
     @classmethod
+    @use_replica()
     def get_by_filter(cls,
                       order_by: str = "id",
                       order_by_desc: bool = True,
@@ -243,9 +1066,13 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
                       limit: int = 10,
                       require_count: bool = True,
                       active_only: bool = True,
+                      count_strategy: Optional[str] = None,
+                      concurrent_count: Optional[bool] = None,
                       _filter_keys: List = None,
                       _range_filter_keys: List = None,
                       _like_filter_keys: List = None,
+                      _only: Optional[Iterable[str]] = None,
+                      _load: Optional[Dict[str, str]] = None,
                       **kwargs) -> Tuple[int, List[EntityType]]:
         """根据条件过滤entity列表，该方法返回一个两个元素的元组
             第一个值为count，代表经过过滤之后总共获取的entity个数
@@ -265,6 +1092,28 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         :type require_count: bool, optional
         :param active_only: 是否包含软删除的记录, defaults to True
         :type active_only: bool, optional
+        :param count_strategy: 计数策略, 见 CountStrategy, 默认使用Model的 _count_strategy
+                               exact:     精确计数, 单独执行一次 COUNT
+                               cached:    精确计数, 结果按过滤条件缓存到 redis, 缓存时间为 _count_cache_ttl
+                               estimated: 估算计数, 没有过滤条件时使用表统计信息, 否则使用 EXPLAIN 的行数估算
+                               has_more:  不计数, 多取一条判断是否存在下一页, count 为 offset + 当前页数量
+                               返回的 count 为 Count 对象, count.strategy 为产生该值的策略
+        :type count_strategy: str, optional
+        :param concurrent_count: 精确计数(exact)时, 是否在线程池中使用连接池的另一个连接执行COUNT, 与分页查询并发执行,
+                                 耗时约为两者的最大值而不是之和. 计数使用相同的过滤条件与相同的库(主库或者从库),
+                                 计数的sql计入请求的sql统计(Server-Timing).
+                                 当前事务中有未提交的写操作时另一个连接看不到这些写入, 此时退化为顺序执行.
+                                 事务中已经执行过查询时(如请求开始时查询了当前用户), mysql 的分页查询读取事务开始时的快照,
+                                 而计数读取最新的提交, 与不在事务中时先后执行两条语句一样, 两者之间的提交可能使计数与分页不一致.
+                                 每个并发计数的请求同时占用两个连接, 等待计数的请求持有一个连接而计数线程还需要一个,
+                                 连接池(DB_POOL_SIZE, 默认5)需要大于 COUNT_CONCURRENCY 与并发请求数之和, 否则计数线程
+                                 会等待空闲连接直到超时, defaults to Model的 _concurrent_count
+        :type concurrent_count: bool, optional
+        :param _only: 只查询的字段(load_only), 主键总是会被查询, 不是数据库字段的名称会被忽略, 一般来自 SparseFieldsMixin.
+                      访问没有查询的字段会再次发送sql, defaults to None 查询全部字段
+        :type _only: Iterable[str], optional
+        :param _load: 关联关系的加载策略, 按路径覆盖Model的 _load_options, 如 {"tags": "raise"}, defaults to None
+        :type _load: Dict[str, str], optional
         :param **kwargs:
             过滤条件以关键字的形式传入，关键字过滤的方式在以下几个类属性中设置。
                 _filter_keys: List：            使用 == 过滤,   and 相连；
@@ -283,10 +1132,231 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
             _like_filter_keys=_like_filter_keys,
             **kwargs,
         )
-        count = query.count() if require_count else 0
+        query = cls._load_only(query, _only)
+        # 预加载只作用于分页查询, 不影响计数
+        page_query = cls._eager_load(query, _load)
+        if not require_count:
+            return 0, page_query.limit(limit).offset(offset).all()
+
+        strategy = count_strategy or cls._count_strategy
+        if strategy == CountStrategy.HAS_MORE.value:
+            entities = page_query.limit(limit + 1).offset(offset).all()
+            has_more = len(entities) > limit
+            entities = entities[:limit]
+            return Count(offset + len(entities), strategy, has_more), entities
+
+        return cls._count_with_page(
+            query,
+            lambda: page_query.limit(limit).offset(offset).all(),
+            strategy,
+            concurrent_count,
+            active_only,
+            _filter_keys=_filter_keys,
+            _range_filter_keys=_range_filter_keys,
+            _like_filter_keys=_like_filter_keys,
+            **kwargs,
+        )
+
+    @classmethod
+    @use_replica()
+    def get_by_cursor(cls,
+                      order_by: str = "id",
+                      order_by_desc: bool = True,
+                      after: Optional[str] = None,
+                      limit: int = 10,
+                      require_count: bool = False,
+                      active_only: bool = True,
+                      count_strategy: Optional[str] = None,
+                      concurrent_count: Optional[bool] = None,
+                      _filter_keys: List = None,
+                      _range_filter_keys: List = None,
+                      _like_filter_keys: List = None,
+                      _only: Optional[Iterable[str]] = None,
+                      **kwargs) -> Tuple[int, List[EntityType], Optional[str]]:
+        """游标(keyset)分页, 该方法返回一个三个元素的元组
+            第一个值为count，代表经过过滤之后总共获取的entity个数
+            第二个值为list，为当前页的entity列表
+            第三个值为next_cursor，下一页的游标，没有下一页时为None
+
+        与 get_by_filter 的 offset 分页不同, 游标分页通过 (order_by, id) 定位上一页的最后一条记录,
+        数据库无需扫描并丢弃 offset 之前的行, 深分页的耗时不会随页码增长.
+        order_by 字段应当是非空字段, 并且最好与 id 建立联合索引.
+
+        :param order_by: 排序字段, defaults to "id"
+        :type order_by: str, optional
+        :param order_by_desc: 是否倒序, defaults to True
+        :type order_by_desc: bool, optional
+        :param after: 上一页返回的 next_cursor, 为空时获取第一页, defaults to None
+        :type after: str, optional
+        :param limit: limit, defaults to 10
+        :type limit: int, optional
+        :param require_count: 是否返回经过条件过滤之后的合计值, defaults to False
+        :type require_count: bool, optional
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        :param count_strategy: 计数策略, 同 get_by_filter, has_more 时 count 为当前页数量, defaults to Model的 _count_strategy
+        :type count_strategy: str, optional
+        :param concurrent_count: 精确计数时是否与分页查询并发执行, 同 get_by_filter, defaults to Model的 _concurrent_count
+        :type concurrent_count: bool, optional
+        :param _only: 只查询的字段, 同 get_by_filter, order_by 字段总是会被查询用于生成游标
+        :type _only: Iterable[str], optional
+        :param **kwargs: 过滤条件, 同 get_by_filter
+
+        :return: count, entity_list, next_cursor
+        """
+        query = cls._get_filtered_query(
+            active_only,
+            _filter_keys=_filter_keys,
+            _range_filter_keys=_range_filter_keys,
+            _like_filter_keys=_like_filter_keys,
+            **kwargs,
+        )
+
+        order_column = getattr(cls._entity, order_by)
+        id_column = cls._entity.id
+        # 计数使用不带游标条件的 query
+        page_query = query
+        if after:
+            page_query = page_query.filter(cls._get_cursor_filter(after, order_by, order_by_desc))
 
-        q = query.limit(limit).offset(offset)
-        return count, q.all()
+        if order_by == "id":
+            order_stmts = [id_column.desc() if order_by_desc else id_column.asc()]
+        else:
+            order_stmts = [
+                order_column.desc() if order_by_desc else order_column.asc(),
+                id_column.desc() if order_by_desc else id_column.asc(),
+            ]
+
+        if _only:
+            page_query = cls._load_only(page_query, [*_only, order_by])
+
+        # 多取一条用于判断是否存在下一页
+        def fetch_page():
+            return page_query.order_by(*order_stmts).limit(limit + 1).all()
+
+        strategy = count_strategy or cls._count_strategy
+        if not require_count or strategy == CountStrategy.HAS_MORE.value:
+            count, entities = 0, fetch_page()
+        else:
+            count, entities = cls._count_with_page(
+                query,
+                fetch_page,
+                strategy,
+                concurrent_count,
+                active_only,
+                _filter_keys=_filter_keys,
+                _range_filter_keys=_range_filter_keys,
+                _like_filter_keys=_like_filter_keys,
+                **kwargs,
+            )
+
+        next_cursor = None
+        if len(entities) > limit:
+            entities = entities[:limit]
+            last = entities[-1]
+            values = [order_by, last.id] if order_by == "id" else [order_by, getattr(last, order_by), last.id]
+            next_cursor = encode_cursor(values)
+
+        if require_count and strategy == CountStrategy.HAS_MORE.value:
+            count = Count(len(entities), strategy, next_cursor is not None)
+        return count, entities, next_cursor
+
+    @classmethod
+    @use_replica()
+    def aggregate(cls,
+                  group_by: Optional[List[str]] = None,
+                  metrics: Optional[Dict[str, Union[str, Tuple[str, str]]]] = None,
+                  bucket: Optional[str] = None,
+                  bucket_column: str = "create_time",
+                  order_by: Optional[str] = None,
+                  order_by_desc: bool = False,
+                  limit: Optional[int] = None,
+                  active_only: bool = True,
+                  _filter_keys: List = None,
+                  _range_filter_keys: List = None,
+                  _like_filter_keys: List = None,
+                  **kwargs) -> List[Dict]:
+        """分组聚合, 过滤条件同 get_by_filter, 分组与聚合都在数据库中通过一次 GROUP BY 查询完成
+
+            UserModel.aggregate(group_by=["status"], metrics={"cnt": "count", "total": ("sum", "amount")})
+            # [{"status": 1, "cnt": 10, "total": 100}, ...]
+
+            UserModel.aggregate(metrics={"cnt": "count"}, bucket="day", create_time=(start, None))
+            # [{"bucket": "2021-01-01", "cnt": 3}, ...]
+
+        :param group_by: 分组字段列表, defaults to None
+        :type group_by: List[str], optional
+        :param metrics: 聚合指标, {结果名称: 聚合函数} 或 {结果名称: (聚合函数, 字段)}, 只有函数名时聚合所有行(仅count),
+            聚合函数可选 count/count_distinct/sum/avg/min/max, defaults to {"count": "count"}
+        :type metrics: Dict[str, Union[str, Tuple[str, str]]], optional
+        :param bucket: 时间分桶 day/week/month, 结果中以 bucket 为key, 见 TimeBucket, defaults to None
+        :type bucket: str, optional
+        :param bucket_column: 分桶使用的时间字段, defaults to "create_time"
+        :type bucket_column: str, optional
+        :param order_by: 排序字段, 可以是分组字段或者指标名称, 默认按照分桶与分组字段排序, defaults to None
+        :type order_by: str, optional
+        :param order_by_desc: 是否倒序, defaults to False
+        :type order_by_desc: bool, optional
+        :param limit: 只返回前limit个分组, 用于 top N, defaults to None
+        :type limit: int, optional
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        :param **kwargs: 过滤条件, 同 get_by_filter
+
+        :return: 每个分组一个字典, 包含分桶、分组字段以及各个指标
+        """
+        group_by = list(group_by or [])
+        metrics = metrics or {"count": "count"}
+        labels = set(group_by) | set(metrics)
+        if bucket and "bucket" in labels:
+            raise ValueError("<bucket> is reserved for the time bucket")
+        if len(labels) != len(group_by) + len(metrics):
+            raise ValueError("metric names should not be the same as group_by keys")
+
+        group_columns = [getattr(cls._entity, key).label(key) for key in group_by]
+        if bucket:
+            group_columns.insert(0, DateBucket(getattr(cls._entity, bucket_column), bucket).label("bucket"))
+        metric_columns = {name: cls._get_metric_column(metric).label(name) for name, metric in metrics.items()}
+
+        query = cls._get_filtered_query(
+            active_only,
+            _filter_keys=_filter_keys,
+            _range_filter_keys=_range_filter_keys,
+            _like_filter_keys=_like_filter_keys,
+            **kwargs,
+        ).with_entities(*group_columns, *metric_columns.values())
+        if group_columns:
+            # 分组使用表达式本身而不是别名, 兼容 ONLY_FULL_GROUP_BY
+            query = query.group_by(*(column.element for column in group_columns))
+
+        if order_by:
+            columns = {column.name: column for column in group_columns}
+            columns.update(metric_columns)
+            if order_by not in columns:
+                raise ValueError(f"order_by should be one of {list(columns)}, got {order_by}")
+            query = query.order_by(columns[order_by].desc() if order_by_desc else columns[order_by].asc())
+        elif group_columns:
+            query = query.order_by(*(column.desc() if order_by_desc else column.asc() for column in group_columns))
+
+        if limit is not None:
+            query = query.limit(limit)
+        return [row._asdict() for row in query.all()]
+
+    @classmethod
+    def _get_metric_column(cls, metric: Union[str, Tuple[str, str]]):
+        """将聚合指标转换为sql表达式"""
+        func_name, key = (metric, None) if isinstance(metric, str) else metric
+        if key is None:
+            if func_name != "count":
+                raise ValueError(f"a column is required by aggregate function <{func_name}>")
+            return func.count()
+
+        column = getattr(cls._entity, key)
+        if func_name == "count_distinct":
+            return func.count(column.distinct())
+        if func_name not in ("count", "sum", "avg", "min", "max"):
+            raise ValueError(f"unsupported aggregate function <{func_name}>")
+        return getattr(func, func_name)(column)
 
     @classmethod
     def create(cls, **entity) -> EntityType:
@@ -297,7 +1367,12 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         """
         entity = cls._entity(**entity)
         session.add(entity)
+        if _is_flush_deferred():
+            cls._defer_changes([entity], OutboxOp.CREATE.value)
+            return entity
+
         session.flush()
+        cls._on_changed([entity.id], OutboxOp.CREATE.value)
         return entity
 
     @classmethod
@@ -307,10 +1382,104 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         :param entity_list 需要创建的entity信息列表
         """
         instaces_list = [cls._entity(**entity) for entity in entity_list]
+        if _is_flush_deferred():
+            session.add_all(instaces_list)
+            cls._defer_changes(instaces_list, OutboxOp.CREATE.value)
+            return instaces_list
+
         session.bulk_save_objects(instaces_list, return_defaults=True)
         session.flush()
+        cls._on_changed([instance.id for instance in instaces_list], OutboxOp.CREATE.value)
         return instaces_list
 
+    @classmethod
+    def bulk_ingest(cls,
+                    entity_list: List[Dict],
+                    chunk_size: Optional[int] = None,
+                    return_ids: bool = False) -> List[int]:
+        """高吞吐的批量写入, 不创建ORM对象, 直接使用Core分块发送多行 INSERT
+
+        bulk_create 使用 bulk_save_objects(return_defaults=True), 为了获取主键每一行都会单独执行一次INSERT,
+        大批量写入时请使用本方法. 字段的默认值(如 TimeBaseEntity 的 create_time/update_time)在每次调用时只计算一次,
+        缺少的字段会被设置为字段的默认值或NULL.
+
+        return_ids=True 时每一块中没有指定id的行使用一条多行INSERT, 通过 LAST_INSERT_ID() 和影响的行数推算自增id,
+        这要求同一条INSERT分配的自增id是连续的(mysql innodb_autoinc_lock_mode 为 0 或 1),
+        否则请不要使用 return_ids, 或者在 entity_list 中指定id. 指定了id的行单独写入, 不参与推算.
+        return_ids=False 时使用 executemany, 由驱动合并为多行INSERT.
+
+        :param entity_list: 需要创建的entity信息列表
+        :type entity_list: List[Dict]
+        :param chunk_size: 每一块的行数, defaults to BULK_INSERT_CHUNK_SIZE
+        :type chunk_size: int, optional
+        :param return_ids: 是否返回创建的id列表, defaults to False
+        :type return_ids: bool, optional
+        :return: return_ids 为True时返回与 entity_list 顺序一致的id列表, 否则返回空列表
+        """
+        if not entity_list:
+            return []
+
+        # 开启 outbox 时需要创建的id用于记录变更
+        need_ids = return_ids or cls._outbox
+        _flush_pending()
+
+        table = cls._entity.__table__
+        rows = cls._fill_insert_defaults(entity_list)
+        chunk_size = chunk_size or BULK_INSERT_CHUNK_SIZE
+        # mysql 的 LAST_INSERT_ID() 为多行INSERT的第一个id, sqlite 的 lastrowid 为最后一个id
+        lastrowid_is_first = session.get_bind(mapper=cls._entity.__mapper__).dialect.name == "mysql"
+
+        ids = []
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            if not need_ids:
+                session.execute(table.insert(), chunk)
+                continue
+
+            # 指定了id的行混在多行INSERT中时, 自增id不再连续(mysql的 LAST_INSERT_ID() 也会跳过这些行), 需要分开写入
+            explicit = [row for row in chunk if row.get("id") is not None]
+            auto = [{key: value for key, value in row.items() if key != "id"} for row in chunk if row.get("id") is None]
+            if explicit:
+                session.execute(table.insert(), explicit)
+            auto_ids = iter(())
+            if auto:
+                result = session.execute(table.insert().values(auto))
+                first_id = result.lastrowid if lastrowid_is_first else result.lastrowid - result.rowcount + 1
+                auto_ids = iter(range(first_id, first_id + result.rowcount))
+            ids.extend(row["id"] if row.get("id") is not None else next(auto_ids) for row in chunk)
+
+        cls._on_changed(ids, OutboxOp.CREATE.value)
+        return ids if return_ids else []
+
+    @classmethod
+    def bulk_upsert(cls,
+                    entity_list: List[Dict],
+                    conflict_keys: List[str],
+                    update_columns: Optional[List[str]] = None,
+                    chunk_size: Optional[int] = None) -> Dict[str, int]:
+        """批量写入, 与已有记录冲突时更新, 每一块只需要两次查询, 代替逐条的 get_by_filter + create/update
+
+        mysql 使用 INSERT ... ON DUPLICATE KEY UPDATE, sqlite 使用 INSERT ... ON CONFLICT DO UPDATE,
+        conflict_keys 上必须存在主键或者唯一索引(mysql根据表上的任意唯一索引判断冲突).
+        插入时补全字段默认值(同 bulk_ingest), 更新时 update_time 等带有 onupdate 的字段会自动更新.
+        同一批数据中 conflict_keys 重复的行只保留最后一行, 字段不同的行分开写入.
+
+        插入与更新的行数在写入之前通过一次查询已存在的记录得到, 并发写入相同的记录时可能不准确.
+        继承了 VersionBaseEntity 的entity, 更新时版本号加1, 传入的 version 会被忽略.
+
+        :param entity_list: 需要写入的entity信息列表
+        :type entity_list: List[Dict]
+        :param conflict_keys: 判断记录是否已经存在的字段
+        :type conflict_keys: List[str]
+        :param update_columns: 冲突时更新的字段, 默认为每一行传入的除 conflict_keys, id, create_time 之外的字段
+        :type update_columns: List[str], optional
+        :param chunk_size: 每一块的行数, defaults to BULK_INSERT_CHUNK_SIZE
+        :type chunk_size: int, optional
+        :return: {"inserted": 插入的行数, "updated": 更新的行数, "unchanged": 没有需要更新的字段而保持不变的已有行数}
+        """
+        _flush_pending()
+        return cls._bulk_upsert(session, entity_list, conflict_keys, update_columns, chunk_size)
+
     @classmethod
     def delete(cls, _id: int, force_delete=False):
         """删除entity
@@ -327,30 +1496,28 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
 
         cls._delete_children([_id], force_delete, active_only=active_only)
         q = session.query(cls._entity).filter(cls._entity.id == _id)
-
-        if force_delete:
-            q.delete(synchronize_session=False)
-        else:
-            if not hasattr(cls._entity, 'is_deleted'):
-                raise RuntimeError("There is no <is_deleted> object in this model, "
-                                   "and the <delete> func cannot be used")
-            delete_dict = {"is_deleted": True}
-            q.update(delete_dict, synchronize_session=False)
-        session.flush()
+        cls._delete_rows(q, force_delete, ids=[_id])
+        _flush()
         return True
 
     @classmethod
     def bulk_delete_by_filter(cls,
                               force_delete=False,
                               active_only=True,
+                              dry_run=False,
                               _filter_keys: List = None,
                               _range_filter_keys: List = None,
                               _like_filter_keys: List = None,
-                              **kwargs):
+                              **kwargs) -> Dict[str, int]:
         """根据条件进行删除，这个一般来说会在级联删除中比较有用
 
         active_only: 需要注意内部是否存在active_query, 如果不存在将只能使用active_only=False
 
+        级联删除在数据库端完成, 本表的过滤条件以子查询的形式嵌入子表的删除语句中, 不会把主键加载到python中.
+
+        :param dry_run: 只统计每张表将要影响的行数, 不执行删除, defaults to False
+        :type dry_run: bool, optional
+        :return: 每张表影响的行数, 如 {"parent": 1, "child": 10}
         """
         kwargs.update(
             dict(
@@ -360,17 +1527,14 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
             ))
 
         query = cls._get_filtered_query(active_only=active_only, **kwargs)
-        parent_ids = [res.id for res in session.query(cls._entity.id).filter(cls._get_filter(**kwargs)).all()]
+        parents = query.with_entities(cls._entity.id).statement
 
-        cls._delete_children(parent_ids, force_delete, active_only=active_only)
-
-        session.query(cls._entity.id).filter(query)
-        if force_delete:
-            query.delete(synchronize_session=False)
-        else:
-            delete_dict = {"is_deleted": False}
-            query.update(delete_dict, synchronize_session=False)
-        session.flush()
+        report = cls._delete_children(parents, force_delete, active_only=active_only, dry_run=dry_run)
+        report[cls._entity.__tablename__] = report.get(cls._entity.__tablename__, 0) + \
+            cls._delete_rows(query, force_delete, dry_run)
+        if not dry_run:
+            _flush()
+        return report
 
     @classmethod
     def bulk_delete(cls, id_list: List[int], force_delete=False):
@@ -378,100 +1542,264 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
 
         :param id_list: entity主键列表
         :type id_list: list
-        :param force_delete: 是否硬删除, defaults to False
+        :param force_delete: 是否硬删除, 硬删除时子表中已经软删除的记录也会被删除, defaults to False
         :type force_delete: bool, optional
         """
-        cls._delete_children(id_list, force_delete)
+        cls._delete_children(id_list, force_delete, active_only=not force_delete)
 
         q = session.query(cls._entity).filter(cls._entity.id.in_(id_list))
-        if force_delete:
-            q.delete(synchronize_session=False)
-        else:
-            delete_dict = {"is_deleted": True}
-            q.update(delete_dict, synchronize_session=False)
-        session.flush()
+        cls._delete_rows(q, force_delete, ids=id_list)
+        _flush()
 
     @classmethod
-    def update(cls, _id: int, **kwargs) -> Optional[EntityType]:
+    def update(cls, _id: int, expected_version: Optional[int] = None, **kwargs) -> Optional[EntityType]:
         """更新entity, 需要更新的key-value通过不定关键字参数传入
 
+        传入 expected_version 时使用乐观锁(entity需要继承 VersionBaseEntity), 不加载entity,
+        直接执行一条 UPDATE ... SET version = version + 1 WHERE id = :id AND version = :expected_version,
+        版本号不一致时抛出 VersionConflict(409), 不会等待行锁.
+
         :param _id: entity主键
         :type _id: int
+        :param expected_version: 客户端读取到的版本号, defaults to None
+        :type expected_version: int, optional
+        :return: 更新后的entity, 不存在时返回None
         """
+        if expected_version is not None:
+            return cls._update_if_version(_id, expected_version, **kwargs)
+
         entity = cls._entity.query.get(_id)
         if not entity:
             return
 
-        entity.auto_set_attr(**kwargs)
+        deferred = _is_flush_deferred()
+        # 推迟flush时entity可能还有未写入的修改, 不能refresh
+        entity.auto_set_attr(_refresh=not deferred, **kwargs)
 
-        session.flush()
-        session.refresh(entity)
+        if not deferred:
+            session.flush()
+            session.refresh(entity)
+        cls._on_changed([_id], OutboxOp.UPDATE.value, {"fields": ",".join(sorted(kwargs))})
         return entity
 
     @classmethod
-    def bulk_update(cls, entity_list: List[Dict]):
+    def update_by_id(cls, _id: int, _reload: bool = False, **kwargs) -> Union[int, Optional[EntityType]]:
+        """不加载entity, 直接执行一条 UPDATE ... WHERE id = :id 更新传入的字段, onupdate字段(如update_time)由数据库语句自动更新
+
+        不存在的字段以及主键会被忽略, 与 update 保持一致
+
+        :param _id: entity主键
+        :type _id: int
+        :param _reload: 是否重新加载并返回更新后的entity, defaults to False
+        :type _reload: bool, optional
+        :return: _reload为False时返回影响的行数, 否则返回更新后的entity, 不存在时返回None
+        """
+        columns = {prop.key for prop in cls._entity.__mapper__.column_attrs}
+        values = {k: v for k, v in kwargs.items() if k in columns and k != "id"}
+
+        rowcount = 0
+        if values:
+            values.update(cls._next_version_values())
+            rowcount = session.query(cls._entity).filter(cls._entity.id == _id).update(
+                values, synchronize_session=False)
+            cls._expire_identities([_id])
+            cls._on_changed([_id], OutboxOp.UPDATE.value, {"fields": ",".join(sorted(values))})
+
+        if not _reload:
+            return rowcount
+        return cls._entity.query.get(_id)
+
+    @classmethod
+    def bulk_update(cls, entity_list: List[Dict], set_based: bool = False, chunk_size: Optional[int] = None) -> int:
         """批量更新entity。
         entity_list中必须包含entity的主键键值对，一般是id，即[dict(id=1, foo="foo", bar="bar")]
 
+        默认使用 bulk_update_mappings, 每一行都会执行一次UPDATE.
+        set_based=True 时按照需要更新的字段分组, 每组分块编译为
+            UPDATE ... SET col = CASE id WHEN ... THEN ... END WHERE id IN (...)
+        每一块只需要一次往返, 适用于大批量更新.
+
+        继承了 VersionBaseEntity 的entity:
+            默认方式中每一行都必须包含客户端读取到的 version, 作为乐观锁的条件, 版本号不一致时抛出 VersionConflict(409)
+            set_based=True 时不检查版本号, 所有更新的行版本号加1, 传入的 version 会被忽略
+
         :param entity_list: 需要更新的entity字典列表，必须包含entity的主键键值对
         :type entity_list: List[Dict]
+        :param set_based: 是否使用 CASE 语句批量更新, defaults to False
+        :type set_based: bool, optional
+        :param chunk_size: set_based 时每条UPDATE的最大行数, defaults to BULK_UPDATE_CHUNK_SIZE
+        :type chunk_size: int, optional
+        :return: 影响的行数
         """
-        session.bulk_update_mappings(cls._entity, entity_list)
-        session.flush()
+        _flush_pending()
+        affected = cls._bulk_update(session, entity_list, set_based, chunk_size)
+        if not set_based:
+            _flush()
+
+        cls._on_changed([entity["id"] for entity in entity_list], OutboxOp.UPDATE.value)
+        return affected
 
     @classmethod
-    def _get_filtered_query(cls, active_only, **kwargs):
-        """获取经过过滤的BaseQuery对象"""
-        q = cls._entity.query
-        if active_only:
-            if not hasattr(cls._entity, 'active_query'):
-                raise RuntimeError("There is no <active_query> object in this model, "
-                                   "and the <active_only> attribute cannot be used")
-            q = cls._entity.active_query
-        # handle filter_keys
-        f = cls._get_filter(**kwargs)
-        return q.filter(f)
+    def _defer_changes(cls, entities: List[EntityType], op: str):
+        """deferred_flush 中新建的entity还没有id, 在flush之后(after_flush_postexec)再调用 _on_changed"""
+        session().info.setdefault(_DEFERRED_CHANGES, []).append((cls, entities, op))
+
+    @classmethod
+    def _tracks_changed_ids(cls) -> bool:
+        """实体缓存失效与outbox需要变更的id"""
+        return cls._entity_cache is not None or cls._outbox
+
+    @classmethod
+    def _on_changed(cls, ids: Optional[Iterable], op: Optional[str] = None, payload: Optional[Dict] = None):
+        """数据发生变更之后调用, 清除请求内批量加载器的缓存, 并在事务结束之后失效这些id的实体缓存,
+        开启了 _outbox 并且传入了变更类型 op(见 OutboxOp) 时, 在当前事务中追加变更事件
+
+        ids为None时表示变更的范围未知, 清除加载器的全部缓存
+        """
+        ids = None if ids is None else list(ids)
+        clear_loaders(cls, ids)
+        if ids and cls._entity_cache is not None:
+            cls._entity_cache.invalidate_on_commit(ids)
+        if ids and op and cls._outbox:
+            record_changes(cls._entity.__tablename__, ids, op, payload)
 
     @classmethod
     def _get_filter(cls, **kwargs):
         """根据Model允许的过滤条件获取filter对象"""
-        and_list = list()
-        filter_keys, like_filter_keys, range_filter_keys = cls._custom_filter_once(**kwargs)
+        clause = cls._build_filter(**kwargs)
+        return and_() if clause is None else clause
 
-        for key in filter_keys:
-            if key in kwargs and kwargs[key] is not None:  # FIXME: 这个可能不能过滤None的查询
-                value = kwargs[key]
-                if isinstance(value, (list, tuple, set)) and not isinstance(value, (str, bytes)):
-                    and_list.append(getattr(cls._entity, key).in_(value))
-                else:
-                    and_list.append(getattr(cls._entity, key) == value)
-
-        # handle range_filter_keys
-        for key in range_filter_keys:
-            start, end = kwargs.get(key) or (None, None)
-            if start:
-                and_list.append(getattr(cls._entity, key) >= start)
-            if end:
-                and_list.append(getattr(cls._entity, key) <= end)
-
-        # handle like_filter_keys
-        # 相对于之前的like方法可以支持同一个属性多个筛选条件，条件之间通过|来区分
-        like_filters = []
-        for key in like_filter_keys:
-            like_value = kwargs.get(key)
-            # FIXME: 这个可能不能过滤None的查询
-            if like_value is None:
+    @classmethod
+    def _count(cls, query, strategy: str, active_only: bool, **kwargs) -> "Count":
+        """根据计数策略获取 query 的合计值"""
+        if strategy == CountStrategy.EXACT.value:
+            return Count(query.count(), strategy)
+
+        if strategy == CountStrategy.CACHED.value:
+            return Count(cls._cached_count(query, active_only, **kwargs), strategy)
+
+        if strategy == CountStrategy.ESTIMATED.value:
+            has_filter = active_only or kwargs.get("_extra_criterion") is not None
+            has_filter = has_filter or cls._build_filter(**kwargs) is not None
+            return Count(cls._estimated_count(query, has_filter), strategy)
+
+        raise ValueError(f"count strategy should be one of {CountStrategy.values()}, got {strategy}")
+
+    @classmethod
+    def _count_with_page(cls, query, fetch_page: Callable[[], List[EntityType]], strategy: str,
+                         concurrent_count: Optional[bool], active_only: bool,
+                         **kwargs) -> Tuple["Count", List[EntityType]]:
+        """计数并获取当前页, 精确计数并且开启了 concurrent_count 时两者并发执行, 见 get_by_filter"""
+        if concurrent_count is None:
+            concurrent_count = cls._concurrent_count
+        if concurrent_count and strategy == CountStrategy.EXACT.value:
+            if not has_uncommitted_writes():
+                future = cls._submit_count(session.get_bind(mapper=cls._entity.__mapper__), query)
+                entities = fetch_page()
+                return Count(future.result(), strategy), entities
+
+        return cls._count(query, strategy, active_only, **kwargs), fetch_page()
+
+    @classmethod
+    def _submit_count(cls, bind, query) -> Future:
+        """在线程池中使用 bind 的另一个连接执行 COUNT, 语句与 query.count() 一致"""
+        statement = select([func.count()]).select_from(query.order_by(None).statement.alias("count_subquery"))
+        return _get_count_executor().submit(_execute_scalar, bind, statement, get_sql_stats())
+
+    @classmethod
+    def _cached_count(cls, query, active_only: bool, **kwargs) -> int:
+        """精确计数, 结果以规范化之后的过滤条件作为签名缓存在redis中, redis不可用时退化为精确计数"""
+        redis_client = get_redis_client()
+        if redis_client is None:
+            return query.count()
+
+        key = f"count:{cls._entity.__tablename__}:{cls._count_signature(active_only, **kwargs)}"
+        try:
+            cached = redis_client.get(key)
+        except RedisError as e:
+            _warn_count_cache_unavailable(e)
+            return query.count()
+        if cached is not None:
+            return int(cached)
+
+        count = query.count()
+        try:
+            redis_client.set(key, count, ex=cls._count_cache_ttl)
+        except RedisError as e:
+            _warn_count_cache_unavailable(e)
+        return count
+
+    @staticmethod
+    def _count_signature(active_only: bool, **kwargs) -> str:
+        """规范化过滤条件, 生成计数缓存的签名, 条件的顺序以及列表值的顺序不影响签名"""
+        normalized = {}
+        for key, value in kwargs.items():
+            if value is None:
                 continue
-            like_values = like_value.split('|')
-            for value in like_values:
-                like_filters.append(getattr(cls._entity, key).like(f"%{value}%"))
+            if isinstance(value, (list, tuple, set)):
+                value = sorted(value, key=str)
+            elif isinstance(value, ClauseElement):
+                value = str(value.compile(compile_kwargs={"literal_binds": True}))
+            normalized[key] = value
+        return get_md5(json.dumps([active_only, normalized], sort_keys=True, default=str))
 
-        # like_filters = [
-        #     getattr(cls._entity, key).like(f"%{kwargs[key]}%") for key in like_filter_keys
-        #     if kwargs.get(key) is not None
-        # ]  # FIXME: 这个可能不能过滤None的查询
+    @classmethod
+    def _estimated_count(cls, query, has_filter: bool) -> int:
+        """估算计数, 仅支持mysql, 其他数据库退化为精确计数
 
-        return and_(*and_list, or_(*like_filters))
+        没有过滤条件时读取 information_schema 中的表统计信息,
+        否则使用 EXPLAIN 中驱动表的 rows * filtered 估算
+        """
+        bind = session.get_bind(mapper=cls._entity.__mapper__)
+        if bind.dialect.name != "mysql":
+            return query.count()
+
+        if not has_filter:
+            table_rows = session.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name",
+                {"table_name": cls._entity.__tablename__},
+            ).scalar()
+            return int(table_rows or 0)
+
+        plan = session.execute(Explain(query.order_by(None).statement)).first()
+        if plan is None:
+            return 0
+        rows = plan["rows"] or 0
+        filtered = plan["filtered"] if "filtered" in plan.keys() else 100
+        return int(rows * (filtered or 100) / 100)
+
+    @classmethod
+    def _get_cursor_filter(cls, after: str, order_by: str, order_by_desc: bool):
+        """根据游标获取 keyset 过滤条件
+
+        倒序: order_by < value or (order_by == value and id < last_id)
+        正序: order_by > value or (order_by == value and id > last_id)
+        """
+        try:
+            values = decode_cursor(after)
+        except ValueError:
+            raise TipResponse(f"无效的分页游标 <after: {after}>")
+
+        expect_length = 2 if order_by == "id" else 3
+        if len(values) != expect_length or values[0] != order_by:
+            raise TipResponse(f"分页游标与排序字段 <{order_by}> 不匹配")
+
+        id_column = cls._entity.id
+        order_column = getattr(cls._entity, order_by)
+        # 游标来自客户端, 类型与字段不一致的值会导致数据库报错
+        columns = [id_column] if order_by == "id" else [order_column, id_column]
+        if not all(_match_column_type(column, value) for column, value in zip(columns, values[1:])):
+            raise TipResponse(f"无效的分页游标 <after: {after}>")
+
+        if order_by == "id":
+            last_id = values[1]
+            return id_column < last_id if order_by_desc else id_column > last_id
+
+        _, value, last_id = values
+        if order_by_desc:
+            return or_(order_column < value, and_(order_column == value, id_column < last_id))
+        return or_(order_column > value, and_(order_column == value, id_column > last_id))
 
     @classmethod
     def _get_full_query(cls, order_by: str = "id", order_by_desc: bool = True, active_only: bool = True, **kwargs):
@@ -484,51 +1812,247 @@ class BaseModel(Generic[EntityType], metaclass=ModelMetaClass):
         return query
 
     @classmethod
-    def _delete_children(cls, parent_ids, force_delete=False, **kwargs):
+    def archivable_models(cls) -> List[Type["BaseModel"]]:
+        """开启了归档的Model列表, _children 中的子表排在父表之前"""
+        ordered, visiting = [], set()
+
+        def visit(model):
+            if model in ordered or model in visiting:
+                return
+            visiting.add(model)
+            for child, _ in model._children or ():
+                child_model = cls._entities_models.get(child)
+                if child_model is not None:
+                    visit(child_model)
+            if model._archive_table is not None:
+                ordered.append(model)
+
+        for model in list(cls._entities_models.values()):
+            visit(model)
+        return ordered
+
+    @classmethod
+    def create_fulltext_indexes(cls) -> List[str]:
+        """为已经存在的表补充 _fulltext_filter_keys 对应的 FULLTEXT 索引, 已存在的索引会被跳过, 仅支持MySQL
+
+        :return: 新创建的索引名称列表
         """
-        支持级联软删除子表中的数据
-        需要在父表的Model中设置子表的 classname 和 外键名称如
-        class ParentModel(BaseModel):
-            _children = ["ChildrenEntity.parent_id"]
+        if not cls._fulltext_indexes:
+            return []
+
+        bind = session.get_bind(mapper=cls._entity.__mapper__)
+        exists = {index["name"] for index in inspect(bind).get_indexes(cls._entity.__tablename__)}
+        created = []
+        for index in cls._fulltext_indexes:
+            if index.name not in exists:
+                index.create(bind)
+                created.append(index.name)
+        return created
+
+    @classmethod
+    def archive_deleted(cls,
+                        batch_size: Optional[int] = None,
+                        sleep_ms: Optional[int] = None,
+                        max_batches: Optional[int] = None) -> int:
+        """将软删除并且超过保留天数的记录移动到归档表, 每一批在单独的事务中 INSERT ... SELECT 之后 DELETE,
+        每一批之后休眠 sleep_ms 毫秒, 避免从库复制延迟. 需要设置 _archive_retention_days.
+
+        存在数据库外键约束时, 应当先归档 _children 中的子表(archive_deleted 命令会按照该顺序执行).
+
+        :param batch_size: 每一批的行数, defaults to ARCHIVE_BATCH_SIZE
+        :type batch_size: int, optional
+        :param sleep_ms: 每一批之后的休眠时间, 毫秒, defaults to ARCHIVE_BATCH_SLEEP_MS
+        :type sleep_ms: int, optional
+        :param max_batches: 最多执行的批数, 为None时处理完所有满足条件的记录, defaults to None
+        :type max_batches: int, optional
+        :return: 归档的行数
         """
-        active_only = kwargs.get('active_only', True)
-        if cls._children:
-            for child, fk in cls._children:
-                child_model = cls._entities_models.get(child)
-                if not child_model:
-                    raise RuntimeError(f"ChildEntity {child} is not found!")
+        if cls._archive_table is None:
+            raise RuntimeError(f"{cls.__name__}._archive_retention_days is not set, and it cannot be archived")
+
+        table = cls._entity.__table__
+        archive = cls._archive_table
+        archive.create(session.get_bind(mapper=cls._entity.__mapper__), checkfirst=True)
+
+        cutoff = datetime.now() - timedelta(days=cls._archive_retention_days)
+        expired = and_(table.c.is_deleted == True, table.c[cls._archive_time_column] < cutoff)  # noqa: E712
+        candidates = select([table.c.id]).where(expired)
+        columns = [column.name for column in table.columns]
+
+        def move(ids: List) -> int:
+            # 获取id之后记录可能被恢复(is_deleted = False), 按照主键锁定仍然满足归档条件的记录,
+            # 之后的恢复需要等待本批提交, 保证写入归档表与删除的是同一批记录
+            locked = [
+                row[0] for row in session.execute(
+                    select([table.c.id]).where(and_(table.c.id.in_(ids), expired)).with_for_update())
+            ]
+            if not locked:
+                return 0
+
+            now = literal(datetime.now(), type_=archive.c.archived_at.type)
+            session.execute(archive.insert().from_select(
+                [*columns, "archived_at"],
+                select([*table.columns, now]).where(table.c.id.in_(locked)),
+            ))
+            return session.execute(table.delete().where(table.c.id.in_(locked))).rowcount
 
-                if fk not in child_model._filter_keys:
-                    logger.warning(f"Child Model {child_model.__name__}'s filters doesn't contain foreign key {fk}")
-                child_model.bulk_delete_by_filter(force_delete, active_only, **{fk: parent_ids})
+        archived = cls._run_in_batches(candidates, table.c.id, move, batch_size, sleep_ms, max_batches)
+        logger.info(f"{cls.__name__}: {archived} rows archived to {archive.name}")
+        return archived
 
     @classmethod
-    def _custom_filter_once(cls, **kwargs) -> Tuple[Set, Set, Set]:
-        """针对本次查询的过滤条件"""
-        filter_keys = set(cls._filter_keys)
-        range_filter_keys = set(cls._range_filter_keys)
-        like_filter_keys = set(cls._like_filter_keys)
+    def purge_archive(cls,
+                      days: Optional[int] = None,
+                      batch_size: Optional[int] = None,
+                      sleep_ms: Optional[int] = None,
+                      max_batches: Optional[int] = None) -> int:
+        """分批删除归档表中归档时间超过 days 天的记录, 参数同 archive_deleted
+
+        :param days: 归档记录保留的天数, defaults to _archive_purge_days
+        :type days: int, optional
+        :return: 删除的行数
+        """
+        if cls._archive_table is None:
+            raise RuntimeError(f"{cls.__name__}._archive_retention_days is not set, and it has no archive table")
 
-        once_filter_keys = set(kwargs.get("_filter_keys") or [])
-        once_range_filter_keys = set(kwargs.get("_range_filter_keys") or [])
-        once_like_filter_keys = set(kwargs.get("_like_filter_keys") or [])
+        archive = cls._archive_table
+        cutoff = datetime.now() - timedelta(days=cls._archive_purge_days if days is None else days)
+        candidates = select([archive.c.id]).where(archive.c.archived_at < cutoff)
 
-        # 检查重复
-        if any((once_filter_keys, once_like_filter_keys, once_range_filter_keys)):
-            cls._overlap_detect(once_filter_keys, once_like_filter_keys, once_range_filter_keys)
-            # 获取新的过滤
-            filter_keys = (filter_keys | once_filter_keys) - (once_range_filter_keys | once_like_filter_keys)
-            like_filter_keys = (like_filter_keys | once_like_filter_keys) - (once_range_filter_keys | once_filter_keys)
-            range_filter_keys = (range_filter_keys | once_range_filter_keys) - \
-                (once_like_filter_keys | once_filter_keys)
+        def purge(ids: List) -> int:
+            return session.execute(archive.delete().where(archive.c.id.in_(ids))).rowcount
 
-        return filter_keys, like_filter_keys, range_filter_keys
+        purged = cls._run_in_batches(candidates, archive.c.id, purge, batch_size, sleep_ms, max_batches, notify=False)
+        logger.info(f"{cls.__name__}: {purged} rows purged from {archive.name}")
+        return purged
+
+    @classmethod
+    def _run_in_batches(cls,
+                        candidates,
+                        id_column,
+                        handler,
+                        batch_size: Optional[int] = None,
+                        sleep_ms: Optional[int] = None,
+                        max_batches: Optional[int] = None,
+                        notify: bool = True) -> int:
+        """按照主键顺序分批获取 candidates 的id并交给 handler 处理, 每一批一个事务, 返回处理的行数"""
+        batch_size = batch_size or ARCHIVE_BATCH_SIZE
+        sleep_ms = ARCHIVE_BATCH_SLEEP_MS if sleep_ms is None else sleep_ms
+
+        total, batches, last_id = 0, 0, None
+        while max_batches is None or batches < max_batches:
+            query = candidates if last_id is None else candidates.where(id_column > last_id)
+            with safe_commit():
+                ids = [row[0] for row in session.execute(query.order_by(id_column).limit(batch_size))]
+                if not ids:
+                    break
+                total += handler(ids)
+                if notify:
+                    cls._on_changed(ids)
+
+            batches += 1
+            last_id = ids[-1]
+            if len(ids) < batch_size:
+                break
+            if sleep_ms:
+                time.sleep(sleep_ms / 1000)
+        return total
+
+    @classmethod
+    def _delete_children(cls,
+                         parents,
+                         force_delete=False,
+                         active_only=True,
+                         dry_run=False,
+                         _report: Dict[str, int] = None,
+                         _path: Tuple = (),
+                         _descend: bool = True) -> Dict[str, int]:
+        """
+        支持级联删除子表中的数据
+        需要在父表的Model中设置子表的 classname 和 外键名称如
+        class ParentModel(BaseModel):
+            _children = ["ChildrenEntity.parent_id"]
+
+        parents 可以是父表主键列表, 也可以是查询父表主键的select, 后者会直接嵌入子表的删除语句中:
+            UPDATE child SET is_deleted=1 WHERE child.parent_id IN (SELECT parent.id FROM parent WHERE ...)
+        先递归删除孙表再删除子表(软删除之后子表的记录将不再被active_query选中), 每张子表只执行一条语句.
+        指向自身的子表(树形表, 如 NodeModel._children = ["Node.parent_id"])见 _delete_descendants.
+
+        :return: 每张子表影响的行数
+        """
+        report = {} if _report is None else _report
+        path = _path + (cls, )
+        for child, fk in cls._children or ():
+            child_model = cls._entities_models.get(child)
+            if not child_model:
+                raise RuntimeError(f"ChildEntity {child} is not found!")
+            if child_model is cls:
+                if _descend:
+                    cls._delete_descendants(parents, fk, force_delete, active_only, dry_run, report, _path)
+                continue
+            if child_model in path:
+                raise RuntimeError(f"Circular _children found: "
+                                   f"{' -> '.join(model.__name__ for model in path + (child_model, ))}")
+
+            child_entity = child_model._entity
+            query = child_model._get_base_query(active_only).filter(getattr(child_entity, fk).in_(parents))
+            child_model._delete_children(query.with_entities(child_entity.id).statement,
+                                         force_delete,
+                                         active_only,
+                                         dry_run,
+                                         _report=report,
+                                         _path=path)
+
+            table = child_entity.__tablename__
+            report[table] = report.get(table, 0) + child_model._delete_rows(query, force_delete, dry_run)
+        return report
+
+    @classmethod
+    def _delete_descendants(cls,
+                            parents,
+                            fk: str,
+                            force_delete=False,
+                            active_only=True,
+                            dry_run=False,
+                            _report: Dict[str, int] = None,
+                            _path: Tuple = ()) -> Dict[str, int]:
+        """级联删除自关联(树形表)中 parents 的所有后代
+
+        第k层为 fk 在第k-1层中的记录, 每一层都是嵌套了上一层的子查询. 先逐层查询直到某一层没有记录,
+        再从最深的一层开始删除(删除时上层的记录还在, 子查询仍然能选中这一层, 也满足外键约束),
+        每一层先级联删除其他子表, 再执行一条删除语句.
+        """
+        report = {} if _report is None else _report
+        levels = []
+        while True:
+            query = cls._get_base_query(active_only).filter(
+                getattr(cls._entity, fk).in_(cls._as_derived_table(parents)))
+            if not session.query(query.exists()).scalar():
+                break
+            if len(levels) >= _MAX_TREE_DEPTH:
+                raise RuntimeError(f"{cls.__name__}._children {cls._entity.__name__}.{fk} is deeper than "
+                                   f"{_MAX_TREE_DEPTH} levels, or the tree has a cycle")
+            levels.append(query)
+            parents = query.with_entities(cls._entity.id).statement
+
+        table = cls._entity.__tablename__
+        for query in reversed(levels):
+            cls._delete_children(query.with_entities(cls._entity.id).statement,
+                                 force_delete,
+                                 active_only,
+                                 dry_run,
+                                 _report=report,
+                                 _path=_path,
+                                 _descend=False)
+            report[table] = report.get(table, 0) + cls._delete_rows(query, force_delete, dry_run)
+        return report
 
 
 class MiddleBaseModel(object):
     """中间表功能增强"""
 
     @classmethod
+    @use_replica()
     def get_many2many_filter(cls,
                              object_model: "BaseModel",
                              subject_attr: str,
@@ -563,12 +2087,11 @@ class MiddleBaseModel(object):
         _range_filter_keys: List = None,
         _like_filter_keys: List = None,
         """
-        middles = cls._entity.query.filter(getattr(cls._entity, subject_attr) == kwargs.pop(subject_attr)).all()
-        object_ids = [getattr(middle, object_attr) for middle in middles]
-
-        filter_keys = [object_relation_field]
-        if _filter_keys:
-            filter_keys = _filter_keys + filter_keys
+        # 中间表以子查询的形式嵌入主体表的查询中, 过滤, 排序, 计数与分页都在数据库中完成:
+        # WHERE object.id IN (SELECT middle.object_attr FROM middle WHERE middle.subject_attr = :value)
+        middles = session.query(getattr(cls._entity, object_attr)) \
+            .filter(getattr(cls._entity, subject_attr) == kwargs.pop(subject_attr))
+        object_column = getattr(object_model._entity, object_relation_field)
 
         kwargs.update({
             "order_by": order_by,
@@ -577,10 +2100,10 @@ class MiddleBaseModel(object):
             "limit": limit,
             "require_count": require_count,
             "active_only": active_only,
-            "_filter_keys": filter_keys,
+            "_filter_keys": _filter_keys,
             "_range_filter_keys": _range_filter_keys,
             "_like_filter_keys": _like_filter_keys,
-            object_relation_field: object_ids
+            "_extra_criterion": object_column.in_(middles.statement),
         })
 
         count, objects = object_model.get_by_filter(**kwargs)
@@ -0,0 +1,150 @@
+"""
+Model 的 redis 实体缓存
+
+缓存的值为entity的列字典, 使用json序列化, 不存在的id会缓存一个占位符(负缓存).
+数据变更时只记录需要失效的key, 在事务提交或者回滚之后统一删除, 保证缓存中不会留下未提交的数据.
+"""
+import datetime
+import json
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Set, Tuple, Type
+
+from redis.exceptions import RedisError
+from sqlalchemy import Date, DateTime, Numeric, Time, event
+from sqlalchemy.orm import make_transient_to_detached
+
+from entities.base import BaseEntity
+from initialization.logger_process import logger
+from initialization.redis_process import get_redis_client
+from initialization.sqlalchemy_process import session
+
+# session.info 中记录需要在事务结束后失效的key
+_INVALIDATE_KEYS = "entity_cache_invalidate_keys"
+
+# 负缓存占位符
+_MISSING = "-"
+
+
+def _json_default(obj: Any):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+class EntityCache(object):
+    """单个Model的实体缓存"""
+
+    def __init__(self, entity: Type[BaseEntity], ttl: int, negative_ttl: int):
+        self.entity = entity
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = f"entity:{entity.__tablename__}:"
+
+        # 反序列化时需要转换类型的列
+        self._converters = {}
+        for prop in entity.__mapper__.column_attrs:
+            column_type = prop.columns[0].type
+            if isinstance(column_type, DateTime):
+                self._converters[prop.key] = datetime.datetime.fromisoformat
+            elif isinstance(column_type, Date):
+                self._converters[prop.key] = datetime.date.fromisoformat
+            elif isinstance(column_type, Time):
+                self._converters[prop.key] = datetime.time.fromisoformat
+            elif isinstance(column_type, Numeric) and column_type.asdecimal:
+                self._converters[prop.key] = Decimal
+
+    def key(self, _id) -> str:
+        return f"{self.prefix}{_id}"
+
+    def dumps(self, entity: BaseEntity) -> str:
+        data = {prop.key: getattr(entity, prop.key) for prop in self.entity.__mapper__.column_attrs}
+        return json.dumps(data, default=_json_default, ensure_ascii=False)
+
+    def loads(self, value: str) -> BaseEntity:
+        """反序列化为entity, 并且以不加载的方式合并到当前session中
+
+        session中已经存在同一个主键的entity时直接返回它, 不能用缓存中的旧值覆盖session中的修改
+        """
+        data = json.loads(value)
+        identity = session.identity_map.get(self.entity.__mapper__.identity_key_from_primary_key([data["id"]]))
+        if identity is not None:
+            return identity
+
+        for key, converter in self._converters.items():
+            if data.get(key) is not None:
+                data[key] = converter(data[key])
+
+        entity = self.entity(**data)
+        make_transient_to_detached(entity)
+        return session.merge(entity, load=False)
+
+    def get_many(self, ids: Iterable) -> Tuple[Dict[str, BaseEntity], Set[str]]:
+        """批量获取缓存, 返回 (命中的entity字典, 负缓存的id集合), 字典与集合的key均为 str(id)
+
+        当前事务中发生过变更(等待失效)的id不读取缓存, 视为未命中, 保证读到自己的写入
+        """
+        found, missing = {}, set()
+        redis_client = get_redis_client()
+        pending = session().info.get(_INVALIDATE_KEYS) or set()
+        ids = [str(_id) for _id in ids if self.key(_id) not in pending]
+        if redis_client is None or not ids:
+            return found, missing
+
+        try:
+            values = redis_client.mget([self.key(_id) for _id in ids])
+        except RedisError as e:
+            logger.exception(e)
+            return found, missing
+
+        for _id, value in zip(ids, values):
+            if value is None:
+                continue
+            if value == _MISSING:
+                missing.add(_id)
+            else:
+                found[_id] = self.loads(value)
+        return found, missing
+
+    def set_many(self, entities: List[BaseEntity], missing_ids: Iterable = ()):
+        """批量写入缓存, 当前事务中发生过变更的id不写入, 避免缓存未提交的数据"""
+        redis_client = get_redis_client()
+        if redis_client is None:
+            return
+
+        pending = session().info.get(_INVALIDATE_KEYS) or set()
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for entity in entities:
+                key = self.key(entity.id)
+                if key not in pending:
+                    pipe.set(key, self.dumps(entity), ex=self.ttl)
+            for _id in missing_ids:
+                key = self.key(_id)
+                if key not in pending:
+                    pipe.set(key, _MISSING, ex=self.negative_ttl)
+            pipe.execute()
+        except RedisError as e:
+            logger.exception(e)
+
+    def invalidate_on_commit(self, ids: Iterable):
+        """记录需要失效的id, 在事务提交或者回滚之后删除"""
+        keys = session().info.setdefault(_INVALIDATE_KEYS, set())
+        keys.update(self.key(_id) for _id in ids)
+
+
+@event.listens_for(session, "after_commit")
+@event.listens_for(session, "after_rollback")
+def _invalidate_after_transaction(sess):
+    keys = sess.info.pop(_INVALIDATE_KEYS, None)
+    if not keys:
+        return
+
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(*keys)
+    except RedisError as e:
+        logger.exception(e)
@@ -0,0 +1,102 @@
+"""
+请求级别的批量加载器(DataLoader)
+
+同一个请求中通过 BaseModel.load 登记的id会被收集起来, 在第一次取值时通过一次 id IN (...) 查询全部获取,
+结果在请求结束之前缓存在 flask.g 中, 之后的 get_by_id/get_by_id_list 直接使用缓存.
+
+    deferred_list = [UserModel.load(_id) for _id in user_ids]  # 不会发送sql
+    users = [deferred.get() for deferred in deferred_list]     # 只发送一次sql
+"""
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from flask import g, has_request_context
+
+if TYPE_CHECKING:
+    from .base import BaseModel
+
+_LOADERS = "_batch_loaders"
+
+
+class Deferred(object):
+    """延迟获取的entity, 调用 get 时才会真正查询"""
+
+    __slots__ = ("loader", "key")
+
+    def __init__(self, loader: "BatchLoader", key: str):
+        self.loader = loader
+        self.key = key
+
+    def get(self):
+        return self.loader.get(self.key)
+
+
+class BatchLoader(object):
+    """单个Model的批量加载器"""
+
+    def __init__(self, model: "BaseModel", active_only: bool = True):
+        self.model = model
+        self.active_only = active_only
+        self._pending: Dict[str, object] = {}
+        self._cache: Dict[str, object] = {}
+
+    def load(self, _id) -> Deferred:
+        """登记需要获取的id, 不会立即查询"""
+        key = str(_id)
+        if key not in self._cache:
+            self._pending.setdefault(key, _id)
+        return Deferred(self, key)
+
+    def load_many(self, id_list: Iterable) -> List:
+        """获取多个entity, 按照传入的顺序返回, 重复或者不存在的id会被忽略"""
+        keys = list(dict.fromkeys(self.load(_id).key for _id in id_list))
+        self.dispatch()
+        return [self._cache[key] for key in keys if self._cache.get(key) is not None]
+
+    def get(self, key: str):
+        if key not in self._cache:
+            self.dispatch()
+        return self._cache.get(key)
+
+    def dispatch(self):
+        """使用一次查询获取所有登记过的id"""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        for entity in self.model._fetch_by_id_list(pending.values(), self.active_only):
+            self._cache[str(entity.id)] = entity
+        for key in pending:
+            self._cache.setdefault(key, None)
+
+    def clear(self, ids: Optional[Iterable] = None):
+        """清除缓存, ids为None时清除全部"""
+        if ids is None:
+            self._cache.clear()
+            return
+        for _id in ids:
+            self._cache.pop(str(_id), None)
+
+
+def get_loader(model: "BaseModel", active_only: bool = True) -> Optional[BatchLoader]:
+    """获取当前请求中Model的批量加载器, 不在请求上下文中时返回None"""
+    if not has_request_context():
+        return None
+
+    loaders: Dict[Tuple[str, bool], BatchLoader] = g.setdefault(_LOADERS, {})
+    key = (model.__name__, active_only)
+    loader = loaders.get(key)
+    if loader is None:
+        loader = loaders[key] = BatchLoader(model, active_only)
+    return loader
+
+
+def clear_loaders(model: "BaseModel", ids: Optional[Iterable] = None):
+    """数据发生变更之后清除当前请求中Model的缓存"""
+    if not has_request_context():
+        return
+
+    loaders: Dict[Tuple[str, bool], BatchLoader] = g.get(_LOADERS) or {}
+    for active_only in (True, False):
+        loader = loaders.get((model.__name__, active_only))
+        if loader is not None:
+            loader.clear(ids)
@@ -0,0 +1,149 @@
+"""
+实体变更事件的 outbox
+
+开启了 _outbox 的Model在 create/update/delete 等写入时, 会在同一个事务中向 outbox 表追加变更记录,
+事务回滚时变更记录一起回滚. relay_outbox 按照写入顺序分批将记录发布到 redis stream <OUTBOX_STREAM_PREFIX>:<table>,
+发布成功之后删除, 消费者通过 XREAD/XREADGROUP 增量处理变更. 发布与删除之间失败时会重复发布(至少一次),
+消费者需要根据消息中的 outbox_id 去重.
+
+同一时间只能有一个relay发布: 多个relay并行发布时, 同一个实体的变更可能乱序到达stream.
+relay 使用 SELECT ... FOR UPDATE 锁定一批记录, 同时启动的其他relay会等待该批提交, 因此多余的进程只能作为备用.
+
+    class UserModel(BaseModel[User]):
+        _outbox = True
+
+    flask relay_outbox --follow
+"""
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from configs.sysconf import OUTBOX_BATCH_SIZE, OUTBOX_RELAY_INTERVAL_MS, OUTBOX_STREAM_MAXLEN, OUTBOX_STREAM_PREFIX
+from entities.outbox import OutboxEntity
+from initialization.redis_process import get_redis_client
+from initialization.sqlalchemy_process import session, stick_to_primary
+
+
+class StreamPublisher(ABC):
+    """将事件发布到stream"""
+
+    @abstractmethod
+    def publish(self, stream: str, messages: List[Dict[str, str]]):
+        """按照顺序发布同一个stream的一批消息"""
+
+
+class RedisStreamPublisher(StreamPublisher):
+    """使用 XADD 发布到 redis stream, 同一批事件通过一次pipeline发送"""
+
+    def __init__(self, redis_client=None, maxlen: int = OUTBOX_STREAM_MAXLEN):
+        self.redis_client = redis_client
+        self.maxlen = maxlen
+
+    def publish(self, stream: str, messages: List[Dict[str, str]]):
+        redis_client = self.redis_client or get_redis_client()
+        if redis_client is None:
+            raise RuntimeError("redis is not initialized, and the outbox cannot be relayed")
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for message in messages:
+            pipeline.xadd(stream, message, maxlen=self.maxlen, approximate=True)
+        pipeline.execute()
+
+
+class MemoryStreamPublisher(StreamPublisher):
+    """发布到内存中的stream, 用于测试"""
+
+    def __init__(self):
+        self.streams: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+
+    def publish(self, stream: str, messages: List[Dict[str, str]]):
+        self.streams[stream].extend(messages)
+
+
+def record_changes(aggregate: str, ids: Iterable, op: str, payload: Optional[Dict] = None):
+    """在当前事务中追加变更记录"""
+    now = datetime.now()
+    rows = [
+        dict(aggregate=aggregate, aggregate_id=str(_id), op=op, payload=payload, create_time=now)
+        for _id in dict.fromkeys(ids)
+    ]
+    if rows:
+        session.execute(OutboxEntity.__table__.insert(), rows)
+
+
+def stream_name(aggregate: str) -> str:
+    return f"{OUTBOX_STREAM_PREFIX}:{aggregate}"
+
+
+def to_message(entity: OutboxEntity) -> Dict[str, str]:
+    """stream 消息的字段只能是字符串"""
+    message = {
+        "outbox_id": str(entity.id),
+        "table": entity.aggregate,
+        "id": entity.aggregate_id,
+        "op": entity.op,
+        "time": entity.create_time.isoformat() if entity.create_time else "",
+    }
+    if entity.payload:
+        message.update({key: str(value) for key, value in entity.payload.items()})
+    return message
+
+
+def relay_outbox(publisher: Optional[StreamPublisher] = None,
+                 batch_size: Optional[int] = None,
+                 max_batches: Optional[int] = None) -> int:
+    """按照写入顺序分批发布outbox中的事件, 发布成功之后删除, 没有更多事件时返回
+
+    每一批记录使用 SELECT ... FOR UPDATE 锁定到删除之后提交, 同时运行的relay在锁上等待, 按批次依次发布.
+    不能使用 SKIP LOCKED: 跳过被锁定的批次会使同一个实体较新的变更先于旧的变更发布.
+
+    :param publisher: 事件发布者, defaults to RedisStreamPublisher
+    :type publisher: StreamPublisher, optional
+    :param batch_size: 每一批的事件数, defaults to OUTBOX_BATCH_SIZE
+    :type batch_size: int, optional
+    :param max_batches: 最多发布的批数, 为None时发布所有事件, defaults to None
+    :type max_batches: int, optional
+    :return: 发布的事件数
+    """
+    publisher = publisher or RedisStreamPublisher()
+    batch_size = batch_size or OUTBOX_BATCH_SIZE
+    table = OutboxEntity.__table__
+
+    stick_to_primary()
+    total, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        try:
+            entities = session.query(OutboxEntity).order_by(OutboxEntity.id).limit(batch_size).with_for_update().all()
+            if not entities:
+                session.commit()
+                break
+
+            streams: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+            for entity in entities:
+                streams[stream_name(entity.aggregate)].append(to_message(entity))
+            for stream, messages in streams.items():
+                publisher.publish(stream, messages)
+
+            session.execute(table.delete().where(table.c.id.in_([entity.id for entity in entities])))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        total += len(entities)
+        batches += 1
+        if len(entities) < batch_size:
+            break
+    return total
+
+
+def follow_outbox(publisher: Optional[StreamPublisher] = None,
+                  batch_size: Optional[int] = None,
+                  interval_ms: int = OUTBOX_RELAY_INTERVAL_MS):
+    """持续发布outbox中的事件, 没有新事件时休眠 interval_ms 毫秒"""
+    publisher = publisher or RedisStreamPublisher()
+    while True:
+        if not relay_outbox(publisher, batch_size):
+            time.sleep(interval_ms / 1000)
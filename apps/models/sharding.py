@@ -0,0 +1,396 @@
+"""
+水平分片Model, 将同一张表的数据按照分片键分布到 SHARD_DATABASE_URIS 中的多个数据库
+
+    class OrderModel(ShardedBaseModel[Order]):
+        _shard_key = "tenant_id"
+
+    OrderModel.create(tenant_id=1, amount=10)           # 写入 tenant_id 所在的分片
+    OrderModel.get_by_filter(tenant_id=1)               # 只查询一个分片
+    OrderModel.get_by_filter(order_by="create_time")    # 查询所有分片并归并排序
+
+- 过滤条件中分片键为等值或者IN条件(_filter_keys)时只查询对应的分片, 否则查询所有分片(scatter-gather),
+  每个分片取前 offset + limit 条, 在内存中按照 (order_by, id) 归并之后再切片,
+  因此排序字段不能为NULL, 字符串排序需要与数据库的排序规则一致.
+- 各个分片的自增id是独立的, 没有分片键时 get_by_id 返回第一个找到的记录. 需要全局唯一的id时,
+  请为每个分片设置 auto_increment_increment = 分片数量, auto_increment_offset = 分片编号 + 1, 或者由业务生成id.
+- 按照id写入的方法(update/update_by_id/delete/bulk_delete/bulk_update)可以传入 shard_value 直接定位分片,
+  否则先在所有分片中查找id所在的分片, 同一个id存在于多个分片时抛出 ValueError. 不支持修改分片键把记录移动到其他分片.
+- 返回的entity属于分片的session, 修改之后随 safe_commit 提交. 分片之间没有分布式事务, 主库提交之前会先flush分片,
+  提交阶段的失败不会回滚已经提交的主库与其他分片, 见 initialization/sharding_process.py.
+- ShardedBaseModel 不继承 BaseModel, 只提供本文件中定义的方法: 没有 load/iter_by_filter/get_by_cursor/aggregate/
+  bulk_ingest/归档等方法, get_by_filter 不支持 count_strategy/concurrent_count/_load(传入时抛出 NotImplementedError).
+  _children、_load_options、实体缓存、outbox与归档不支持分片Model(定义时抛出异常).
+- 分片上的表需要通过 create_shard_tables 命令创建.
+"""
+import heapq
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from weakref import WeakValueDictionary
+
+from configs.enums_define import ShardStrategy
+from configs.sysconf import ID_LIST_CHUNK_SIZE
+from initialization.sharding_process import get_shard_session, shard_count
+from utils.common_tools import get_md5
+
+from .base import EntityType, SyncModelMixin
+
+# BaseModel 查询方法中分片Model不支持的参数
+_UNSUPPORTED_OPTIONS = ("count_strategy", "concurrent_count", "_load")
+
+
+class ShardedBaseModel(SyncModelMixin[EntityType]):
+    """分片模型基础类"""
+
+    abstract = True
+
+    # 与主库上的Model分开注册, create_shard_tables 命令遍历该注册表
+    _entities_models: WeakValueDictionary = WeakValueDictionary()
+
+    # 分片键, 必须是entity的字段
+    _shard_key: str = ""
+    # 路由策略, 见 ShardStrategy
+    _shard_strategy: str = ShardStrategy.MODULO.value
+
+    @classmethod
+    def shard_for(cls, value) -> int:
+        """分片键的值所在的分片编号"""
+        if value is None:
+            raise ValueError(f"shard key <{cls._shard_key}> of {cls.__name__} should not be None")
+        if cls._shard_strategy == ShardStrategy.MODULO.value:
+            return int(value) % shard_count()
+        if cls._shard_strategy == ShardStrategy.HASH.value:
+            return int(get_md5(str(value)), 16) % shard_count()
+        raise ValueError(f"shard strategy should be one of {ShardStrategy.values()}, got {cls._shard_strategy}")
+
+    @classmethod
+    def get_by_id(cls, _id: int, active_only: bool = True, shard_value=None) -> Optional[EntityType]:
+        """根据id获取entity对象, 没有传入分片键的值时依次查询所有分片
+
+        :param _id: 主键值
+        :type _id: int
+        :param active_only: 是否包含软删除的记录, defaults to True
+        :type active_only: bool, optional
+        :param shard_value: 分片键的值, defaults to None
+        """
+        shards = range(shard_count()) if shard_value is None else [cls.shard_for(shard_value)]
+        for shard in shards:
+            entity = cls._shard_query(shard, active_only).filter(cls._entity.id == _id).first()
+            if entity is not None:
+                return entity
+        return None
+
+    @classmethod
+    def get_by_id_list(cls, id_list: Iterable, active_only: bool = True, shard_value=None) -> List[EntityType]:
+        """根据主键列表获取entity列表, 按照id_list的顺序返回, 重复或者不存在的id会被忽略, 参数同 get_by_id"""
+        ids = list(dict.fromkeys(id_list))
+        if not ids:
+            return []
+
+        shards = range(shard_count()) if shard_value is None else [cls.shard_for(shard_value)]
+        found = {}
+        for shard in shards:
+            for entity in cls._shard_query(shard, active_only).filter(cls._entity.id.in_(ids)):
+                found.setdefault(str(entity.id), entity)
+        return [found[str(_id)] for _id in ids if str(_id) in found]
+
+    @classmethod
+    def get_all_by_filter(cls,
+                          order_by: str = "id",
+                          order_by_desc: bool = True,
+                          active_only: bool = True,
+                          _filter_keys: List = None,
+                          _range_filter_keys: List = None,
+                          _like_filter_keys: List = None,
+                          _only: Optional[Iterable[str]] = None,
+                          **kwargs) -> List[EntityType]:
+        """根据过滤条件获取所有的entity, 参数同 get_by_filter"""
+        cls._reject_options("get_all_by_filter", kwargs)
+        kwargs.update(_filter_keys=_filter_keys,
+                      _range_filter_keys=_range_filter_keys,
+                      _like_filter_keys=_like_filter_keys)
+        results = [
+            cls._order_by(cls._shard_query(shard, active_only, _only=_only, **kwargs), order_by, order_by_desc).all()
+            for shard in cls._shards_for_filter(kwargs)
+        ]
+        return list(cls._merge(results, order_by, order_by_desc))
+
+    @classmethod
+    def get_by_filter(cls,
+                      order_by: str = "id",
+                      order_by_desc: bool = True,
+                      offset: int = 0,
+                      limit: int = 10,
+                      require_count: bool = True,
+                      active_only: bool = True,
+                      _filter_keys: List = None,
+                      _range_filter_keys: List = None,
+                      _like_filter_keys: List = None,
+                      _only: Optional[Iterable[str]] = None,
+                      **kwargs) -> Tuple[int, List[EntityType]]:
+        """根据条件过滤entity列表, 返回 (count, entity_list), 参数与过滤条件同 BaseModel.get_by_filter
+
+        过滤条件中有分片键时只查询对应的分片, 否则每个分片取前 offset + limit 条之后归并, count 为各个分片的精确计数之和,
+        不支持 count_strategy/concurrent_count/_load
+        """
+        cls._reject_options("get_by_filter", kwargs)
+        kwargs.update(_filter_keys=_filter_keys,
+                      _range_filter_keys=_range_filter_keys,
+                      _like_filter_keys=_like_filter_keys)
+        shards = cls._shards_for_filter(kwargs)
+
+        count = 0
+        results = []
+        for shard in shards:
+            query = cls._shard_query(shard, active_only, **kwargs)
+            if require_count:
+                count += query.order_by(None).count()
+            query = cls._order_by(cls._load_only(query, _only and [*_only, order_by]), order_by, order_by_desc)
+            if len(shards) == 1:
+                return count, query.limit(limit).offset(offset).all()
+            results.append(query.limit(offset + limit).all())
+
+        return count, list(islice(cls._merge(results, order_by, order_by_desc), offset, offset + limit))
+
+    @classmethod
+    def create(cls, **entity) -> EntityType:
+        """在分片键所在的分片中创建一个Entity
+
+        :param **entity 需要传入的字段, 必须包含分片键
+        """
+        entity = cls._entity(**entity)
+        shard_session = get_shard_session(cls.shard_for(getattr(entity, cls._shard_key)))
+        shard_session.add(entity)
+        shard_session.flush()
+        return entity
+
+    @classmethod
+    def bulk_create(cls, entity_list: List[Dict]) -> List[EntityType]:
+        """批量创建Entity, 按照分片分组之后每个分片flush一次, 按照 entity_list 的顺序返回
+
+        :param entity_list 需要创建的entity信息列表, 每一项都必须包含分片键
+        """
+        instances = [cls._entity(**entity) for entity in entity_list]
+        groups: Dict[int, List[EntityType]] = {}
+        for instance in instances:
+            groups.setdefault(cls.shard_for(getattr(instance, cls._shard_key)), []).append(instance)
+
+        for shard, group in groups.items():
+            shard_session = get_shard_session(shard)
+            shard_session.add_all(group)
+            shard_session.flush()
+        return instances
+
+    @classmethod
+    def update(cls,
+               _id: int,
+               expected_version: Optional[int] = None,
+               shard_value=None,
+               **kwargs) -> Optional[EntityType]:
+        """在id所在的分片中更新entity, 参数同 BaseModel.update
+
+        :param shard_value: 分片键的值, 为None时在所有分片中查找id, defaults to None
+        """
+        shard = cls._locate_one(_id, shard_value)
+        if shard is None:
+            return None
+        cls._check_shard_moves(shard, kwargs)
+        shard_session = get_shard_session(shard)
+        if expected_version is not None:
+            return cls._update_if_version(_id, expected_version, _session=shard_session, **kwargs)
+
+        entity = shard_session.query(cls._entity).get(_id)
+        if entity is None:
+            return None
+        shard_session.refresh(entity)
+        entity.auto_set_attr(_refresh=False, **kwargs)
+        shard_session.flush()
+        shard_session.refresh(entity)
+        return entity
+
+    @classmethod
+    def update_by_id(cls,
+                     _id: int,
+                     _reload: bool = False,
+                     shard_value=None,
+                     **kwargs) -> Union[int, Optional[EntityType]]:
+        """在id所在的分片中执行 UPDATE ... WHERE id = :id, 参数同 BaseModel.update_by_id 与 update"""
+        shard = cls._locate_one(_id, shard_value)
+        if shard is None:
+            return None if _reload else 0
+        cls._check_shard_moves(shard, kwargs)
+        shard_session = get_shard_session(shard)
+
+        columns = {prop.key for prop in cls._entity.__mapper__.column_attrs}
+        values = {k: v for k, v in kwargs.items() if k in columns and k != "id"}
+        rowcount = 0
+        if values:
+            values.update(cls._next_version_values())
+            rowcount = shard_session.query(cls._entity).filter(cls._entity.id == _id).update(
+                values, synchronize_session=False)
+            cls._expire_identities([_id], shard_session)
+
+        if not _reload:
+            return rowcount
+        return shard_session.query(cls._entity).get(_id)
+
+    @classmethod
+    def bulk_update(cls,
+                    entity_list: List[Dict],
+                    set_based: bool = False,
+                    chunk_size: Optional[int] = None,
+                    shard_value=None) -> int:
+        """按照id所在的分片分组之后批量更新, 不存在的id会被忽略, 参数同 BaseModel.bulk_update 与 update"""
+        located = cls._locate([entity["id"] for entity in entity_list], shard_value)
+        shard_of = {str(_id): shard for shard, ids in located.items() for _id in ids}
+        groups: Dict[int, List[Dict]] = {}
+        for entity in entity_list:
+            shard = shard_of.get(str(entity["id"]))
+            if shard is not None:
+                cls._check_shard_moves(shard, entity)
+                groups.setdefault(shard, []).append(entity)
+
+        affected = 0
+        for shard, group in groups.items():
+            shard_session = get_shard_session(shard)
+            affected += cls._bulk_update(shard_session, group, set_based, chunk_size)
+            if not set_based:
+                shard_session.flush()
+        return affected
+
+    @classmethod
+    def bulk_upsert(cls,
+                    entity_list: List[Dict],
+                    conflict_keys: List[str],
+                    update_columns: Optional[List[str]] = None,
+                    chunk_size: Optional[int] = None) -> Dict[str, int]:
+        """按照分片键分组之后在每个分片中执行 bulk_upsert, 每一行都必须包含分片键, 参数同 BaseModel.bulk_upsert"""
+        report = {"inserted": 0, "updated": 0, "unchanged": 0}
+        for shard, group in cls._group_by_shard(entity_list).items():
+            result = cls._bulk_upsert(get_shard_session(shard), group, conflict_keys, update_columns, chunk_size)
+            report = {key: report[key] + result[key] for key in report}
+        return report
+
+    @classmethod
+    def delete(cls, _id: int, force_delete=False, shard_value=None):
+        """在id所在的分片中删除entity, 参数同 BaseModel.delete 与 update"""
+        cls.bulk_delete([_id], force_delete, shard_value)
+        return True
+
+    @classmethod
+    def bulk_delete(cls, id_list: List[int], force_delete=False, shard_value=None):
+        """在id所在的分片中批量删除entity, 参数同 BaseModel.bulk_delete 与 update"""
+        for shard, ids in cls._locate(id_list, shard_value).items():
+            query = get_shard_session(shard).query(cls._entity).filter(cls._entity.id.in_(ids))
+            cls._delete_rows(query, force_delete, ids=ids)
+
+    @classmethod
+    def bulk_delete_by_filter(cls,
+                              force_delete=False,
+                              active_only=True,
+                              dry_run=False,
+                              _filter_keys: List = None,
+                              _range_filter_keys: List = None,
+                              _like_filter_keys: List = None,
+                              **kwargs) -> Dict[str, int]:
+        """在过滤条件对应的分片(没有分片键时为所有分片)中删除, 参数与返回值同 BaseModel.bulk_delete_by_filter"""
+        kwargs.update(_filter_keys=_filter_keys,
+                      _range_filter_keys=_range_filter_keys,
+                      _like_filter_keys=_like_filter_keys)
+        count = sum(
+            cls._delete_rows(cls._shard_query(shard, active_only, **kwargs), force_delete, dry_run)
+            for shard in cls._shards_for_filter(kwargs))
+        return {cls._entity.__tablename__: count}
+
+    @classmethod
+    def create_shard_tables(cls) -> List[int]:
+        """在每个分片上创建entity的表, 已经存在的表会被跳过, 返回分片编号列表"""
+        table = cls._entity.__table__
+        for shard in range(shard_count()):
+            table.create(get_shard_session(shard).get_bind(), checkfirst=True)
+        return list(range(shard_count()))
+
+    @classmethod
+    def _reject_options(cls, method: str, kwargs: Dict):
+        """BaseModel 中分片Model不支持的参数会落入 kwargs 被当作过滤条件忽略, 传入时抛出 NotImplementedError"""
+        unsupported = [key for key in _UNSUPPORTED_OPTIONS if key in kwargs]
+        if unsupported:
+            raise NotImplementedError(f"{cls.__name__}.{method} does not support {unsupported}")
+
+    @classmethod
+    def _locate(cls, id_list: Iterable, shard_value=None) -> Dict[int, List]:
+        """id所在的分片, 返回 {分片编号: id列表}, 不存在的id会被忽略
+
+        传入分片键的值时直接使用对应的分片, 否则在所有分片中查找, 同一个id存在于多个分片时抛出 ValueError
+        """
+        ids = list(dict.fromkeys(id_list))
+        if not ids:
+            return {}
+        if shard_value is not None:
+            return {cls.shard_for(shard_value): ids}
+
+        located: Dict[int, List] = {}
+        owners: Dict[str, int] = {}
+        for shard in range(shard_count()):
+            query = get_shard_session(shard).query(cls._entity.id)
+            for i in range(0, len(ids), ID_LIST_CHUNK_SIZE):
+                for (_id, ) in query.filter(cls._entity.id.in_(ids[i:i + ID_LIST_CHUNK_SIZE])):
+                    if str(_id) in owners:
+                        raise ValueError(f"id {_id} of {cls.__name__} exists on shard {owners[str(_id)]} and {shard}, "
+                                         f"shard_value is required")
+                    owners[str(_id)] = shard
+                    located.setdefault(shard, []).append(_id)
+        return located
+
+    @classmethod
+    def _locate_one(cls, _id: int, shard_value=None) -> Optional[int]:
+        """id所在的分片编号, 不存在时返回None"""
+        located = cls._locate([_id], shard_value)
+        return next(iter(located), None)
+
+    @classmethod
+    def _check_shard_moves(cls, shard: int, values: Dict):
+        """更新分片键时, 新的值必须仍然在原来的分片中"""
+        value = values.get(cls._shard_key)
+        if value is not None and cls.shard_for(value) != shard:
+            raise ValueError(f"changing {cls._shard_key} of {cls.__name__} to {value} moves the row from shard "
+                             f"{shard} to {cls.shard_for(value)}, which is not supported")
+
+    @classmethod
+    def _group_by_shard(cls, entity_list: List[Dict]) -> Dict[int, List[Dict]]:
+        """按照分片键的值分组, 每一行都必须包含分片键"""
+        groups: Dict[int, List[Dict]] = {}
+        for entity in entity_list:
+            groups.setdefault(cls.shard_for(entity.get(cls._shard_key)), []).append(entity)
+        return groups
+
+    @classmethod
+    def _shards_for_filter(cls, kwargs: Dict) -> List[int]:
+        """过滤条件中分片键的等值或者IN条件对应的分片, 分片键没有作为 _filter_keys 过滤时为所有分片"""
+        filter_keys, _, _ = cls._custom_filter_once(**kwargs)
+        value = kwargs.get(cls._shard_key)
+        if value is None or cls._shard_key not in filter_keys:
+            return list(range(shard_count()))
+        if isinstance(value, (list, tuple, set)):
+            return sorted({cls.shard_for(v) for v in value})
+        return [cls.shard_for(value)]
+
+    @classmethod
+    def _shard_query(cls, shard: int, active_only: bool = True, _only: Optional[Iterable[str]] = None, **kwargs):
+        """分片上经过过滤的query, _only 为只查询的字段"""
+        query = cls._get_filtered_query(active_only, **kwargs).with_session(get_shard_session(shard))
+        return cls._load_only(query, _only)
+
+    @classmethod
+    def _order_by(cls, query, order_by: str, order_by_desc: bool):
+        """按照 (order_by, id) 排序, 与 _merge 的顺序一致"""
+        columns = [getattr(cls._entity, order_by)]
+        if order_by != "id":
+            columns.append(cls._entity.id)
+        return query.order_by(*(column.desc() if order_by_desc else column.asc() for column in columns))
+
+    @classmethod
+    def _merge(cls, results: List[List[EntityType]], order_by: str, order_by_desc: bool):
+        """归并各个分片已经排好序的结果"""
+        if len(results) == 1:
+            return iter(results[0])
+        return heapq.merge(*results, key=lambda entity: (getattr(entity, order_by), entity.id), reverse=order_by_desc)
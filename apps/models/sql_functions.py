@@ -0,0 +1,120 @@
+"""
+自定义的sql结构, 通过 @compiles 为不同的数据库生成对应的sql
+"""
+from typing import Dict, List
+
+from sqlalchemy import String, Table
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable, FunctionElement
+
+from configs.enums_define import TimeBucket
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN <statement>, 参数的绑定与原语句一致"""
+
+    # SQLAlchemy>=1.4 的语句缓存无法为自定义结构生成缓存键, 不缓存
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element: Explain, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+class Upsert(Executable, ClauseElement):
+    """多行 INSERT, 与已有记录冲突时更新 set_ 中的字段
+
+    set_ 的值为None时使用待插入行中的值, 否则使用给定的sql表达式
+    """
+
+    # 内部的 INSERT 编译时会把编译器标记为insert语句, 编译器会读取这些属性
+    _returning = None
+    _inline = False
+    # 每次的 rows 都不同, 不使用 SQLAlchemy>=1.4 的语句缓存
+    inherit_cache = False
+
+    def __init__(self, table: Table, rows: List[Dict], conflict_keys: List[str], set_: Dict[str, ClauseElement]):
+        self.table = table
+        self.rows = rows
+        self.conflict_keys = conflict_keys
+        self.set_ = set_
+
+
+def _compile_upsert_set(element: Upsert, compiler, inserted: str, **kw) -> str:
+    clauses = []
+    for key, value in element.set_.items():
+        column = compiler.preparer.quote(element.table.c[key].name)
+        value = inserted.format(column) if value is None else compiler.process(value, **kw)
+        clauses.append(f"{column} = {value}")
+    return ", ".join(clauses)
+
+
+@compiles(Upsert)
+def _compile_upsert(element: Upsert, compiler, **kw):
+    """sqlite(>=3.24)/postgresql: INSERT ... ON CONFLICT (...) DO UPDATE SET"""
+    insert = compiler.process(element.table.insert().values(element.rows), **kw)
+    keys = ", ".join(compiler.preparer.quote(element.table.c[key].name) for key in element.conflict_keys)
+    if not element.set_:
+        return f"{insert} ON CONFLICT ({keys}) DO NOTHING"
+    return f"{insert} ON CONFLICT ({keys}) DO UPDATE SET {_compile_upsert_set(element, compiler, 'excluded.{}', **kw)}"
+
+
+@compiles(Upsert, "mysql")
+def _compile_upsert_mysql(element: Upsert, compiler, **kw):
+    """mysql: INSERT ... ON DUPLICATE KEY UPDATE, 冲突由表上的任意主键/唯一索引判断"""
+    insert = compiler.process(element.table.insert().values(element.rows), **kw)
+    if not element.set_:
+        # 没有需要更新的字段时将第一个冲突字段更新为自身, 等同于忽略冲突
+        key = compiler.preparer.quote(element.table.c[element.conflict_keys[0]].name)
+        return f"{insert} ON DUPLICATE KEY UPDATE {key} = {key}"
+    return f"{insert} ON DUPLICATE KEY UPDATE {_compile_upsert_set(element, compiler, 'VALUES({})', **kw)}"
+
+
+class DateBucket(FunctionElement):
+    """将时间截断到天/周/月, 见 TimeBucket, 结果为字符串: day/week 为 %Y-%m-%d(week为当周的周一), month 为 %Y-%m"""
+
+    type = String()
+    name = "date_bucket"
+    # unit 不在缓存键中, 不能使用 SQLAlchemy>=1.4 的语句缓存
+    inherit_cache = False
+
+    def __init__(self, column, unit: str):
+        if unit not in TimeBucket.values():
+            raise ValueError(f"time bucket should be one of {TimeBucket.values()}, got {unit}")
+        self.unit = unit
+        super().__init__(column)
+
+
+def _escape_percent(compiler, text: str) -> str:
+    """format/pyformat 参数风格的驱动(如pymysql)需要转义sql中的%"""
+    return text.replace("%", "%%") if compiler.dialect.paramstyle in ("format", "pyformat") else text
+
+
+@compiles(DateBucket)
+def _compile_date_bucket(element: DateBucket, compiler, **kw):
+    raise CompileError(f"date_bucket is not supported by dialect {compiler.dialect.name}")
+
+
+@compiles(DateBucket, "mysql")
+def _compile_date_bucket_mysql(element: DateBucket, compiler, **kw):
+    column = compiler.process(list(element.clauses)[0], **kw)
+    if element.unit == TimeBucket.WEEK.value:
+        column = f"({column} - INTERVAL WEEKDAY({column}) DAY)"
+    fmt = "%Y-%m" if element.unit == TimeBucket.MONTH.value else "%Y-%m-%d"
+    return _escape_percent(compiler, f"DATE_FORMAT({column}, '{fmt}')")
+
+
+@compiles(DateBucket, "sqlite")
+def _compile_date_bucket_sqlite(element: DateBucket, compiler, **kw):
+    column = compiler.process(list(element.clauses)[0], **kw)
+    if element.unit == TimeBucket.MONTH.value:
+        return _escape_percent(compiler, f"strftime('%Y-%m', {column})")
+    if element.unit == TimeBucket.WEEK.value:
+        # 先移动到当周的周日(周日不变), 再回退6天得到周一
+        return _escape_percent(compiler, f"strftime('%Y-%m-%d', {column}, 'weekday 0', '-6 days')")
+    return _escape_percent(compiler, f"strftime('%Y-%m-%d', {column})")
@@ -1,6 +1,6 @@
 from typing import Tuple
 
-from marshmallow import EXCLUDE, Schema, fields, pre_load, post_load
+from marshmallow import EXCLUDE, Schema, ValidationError, fields, pre_load, post_load
 from marshmallow_sqlalchemy import ModelConverter as _ModelConverter
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 from marshmallow_sqlalchemy.convert import _set_meta_kwarg
@@ -80,6 +80,59 @@ class PageMixin:
         return limit, offset
 
 
+class CursorPageMixin:
+    """游标分页, 配合 BaseModel.get_by_cursor 使用
+
+    class SomeSchema(BaseSchema, CursorPageMixin):
+        ...
+
+    data = SomeSchema.load(dict(after="xxx", per_page=10))
+    print(data['after'], data['limit'])
+    """
+
+    after = fields.Str(missing=None, load_only=True, description="上一页返回的next_cursor, 为空时获取第一页")
+    per_page = fields.Int(missing=10, validate=lambda x: x > 0, load_only=True)
+
+    @post_load
+    def load_cursor_limit(self, data, **kwargs):
+        """将 per_page 转化为 limit"""
+        data["limit"] = data["per_page"]
+        return data
+
+
+class SparseFieldsMixin:
+    """稀疏字段集, ?fields=a,b,c 只查询并返回指定的字段, 配合 BaseModel.get_by_filter(_only=...) 与 SparseNested 使用
+
+    class SomeQuerySchema(RawBaseSchema, PageMixin, SparseFieldsMixin):
+        _sparse_schema = SomeSchema  # 列表中每一项的schema, 传入的字段需要是它的字段
+
+    data = SomeQuerySchema().load(dict(fields="id,name"))
+    print(data['only_fields'])  # ('id', 'name'), 没有传入时为None
+    """
+    _sparse_schema = None
+    _delimiter = ","
+
+    only_fields = fields.Str(missing=None, data_key="fields", load_only=True, description="需要返回的字段, 使用逗号分隔")
+
+    @post_load
+    def load_only_fields(self, data, **kwargs):
+        """将逗号分隔的字段转化为元组, 并验证字段是否存在"""
+        value = data.get("only_fields")
+        if not value:
+            data["only_fields"] = None
+            return data
+
+        only = tuple(dict.fromkeys(name.strip() for name in value.split(self._delimiter) if name.strip()))
+        schema = self._sparse_schema or self.__class__
+        allowed = {name for name, field in schema._declared_fields.items() if not field.load_only}
+        unknown = [name for name in only if name not in allowed]
+        if unknown:
+            raise ValidationError(f"Unknown fields {unknown}", field_name="fields")
+
+        data["only_fields"] = only
+        return data
+
+
 class HeaderSchemaMixin:
 
     """请求头验证器
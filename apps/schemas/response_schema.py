@@ -21,9 +21,39 @@ class BaseResponseSchema(RawBaseSchema):
         return lds
 
 
+class SparseNested(fields.Nested):
+    """根据被序列化对象的 only_fields 属性裁剪嵌套schema的字段, 配合 SparseFieldsMixin 使用
+
+    fields.List(SparseNested(SomeSchema)) 序列化 ListData 时, 每一项只返回 ListData.only_fields 中的字段
+    """
+
+    # 不同字段组合的schema缓存数量
+    max_cached_schemas = 128
+
+    def __init__(self, nested, **kwargs):
+        super().__init__(nested, **kwargs)
+        self._sparse_schemas = {}
+
+    def _serialize(self, nested_obj, attr, obj, **kwargs):
+        only = getattr(obj, "only_fields", None)
+        if not only or nested_obj is None:
+            return super()._serialize(nested_obj, attr, obj, **kwargs)
+
+        key = frozenset(only) & frozenset(self.schema.fields)
+        schema = self._sparse_schemas.get(key)
+        if schema is None:
+            if len(self._sparse_schemas) >= self.max_cached_schemas:
+                self._sparse_schemas.clear()
+            schema = self._sparse_schemas[key] = self.schema.__class__(only=key)
+        return schema.dump(nested_obj, many=self.many)
+
+
 class ListDataSchema(RawBaseSchema):
     total = fields.Int()
     items = fields.List(fields.Dict())
+    next_cursor = fields.String(allow_none=True, description="游标分页时下一页的游标, 为空代表没有下一页")
+    total_strategy = fields.String(allow_none=True, description="total的计数策略, exact/cached/estimated/has_more")
+    has_more = fields.Boolean(allow_none=True, description="计数策略为has_more时, 代表是否存在下一页")
 
 
 class ListResponseSchema(BaseResponseSchema):
@@ -34,7 +64,7 @@ class ListResponseSchema(BaseResponseSchema):
         lds = type(
             "ListData" + item_schema.__class__.__name__,
             (ListDataSchema, ),
-            dict(items=fields.List(fields.Nested(item_schema)), ),
+            dict(items=fields.List(SparseNested(item_schema)), ),
         )
         return type(
             "ListResponse" + item_schema.__class__.__name__,
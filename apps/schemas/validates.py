@@ -5,6 +5,12 @@ from models.utils import check_object_exist
 from utils.exceptions import TipResponse
 
 
+def _check_sync_model(_model: BaseModel):
+    """marshmallow 的验证是同步的, 只能使用 BaseModel(不能使用 AsyncBaseModel)"""
+    if not issubclass(_model, BaseModel):
+        raise TypeError(f"<{_model.__name__}> is not a BaseModel, validators require a sync model")
+
+
 class ResourceValidator(Validator):
     """资源验证器"""
 
@@ -12,6 +18,7 @@ class ResourceValidator(Validator):
         """
         active_only: 如果为true, 保证model下存在active_query属性, 否则设置成为False
         """
+        _check_sync_model(_model)
         self._model = _model
         self.active_only = active_only
 
@@ -23,3 +30,27 @@ class ResourceValidator(Validator):
                 f'<{self._model}> This resource <{value}> does not exist')
 
         return value
+
+
+class ResourceListValidator(Validator):
+    """资源列表验证器, 使用一次查询验证列表中的所有资源
+
+    some_ids = fields.List(fields.Int(), validate=ResourceListValidator(SomeModel))
+    """
+
+    def __init__(self, _model: BaseModel, active_only: bool = False) -> None:
+        """
+        active_only: 如果为true, 保证model下存在active_query属性, 否则设置成为False
+        """
+        _check_sync_model(_model)
+        self._model = _model
+        self.active_only = active_only
+
+    def __call__(self, value):
+        exists = {str(instance.id) for instance in self._model.get_by_id_list(value, self.active_only)}
+        not_exists = [_id for _id in value if str(_id) not in exists]
+        if not_exists:
+            raise ValidationError(
+                f'<{self._model}> These resources <{not_exists}> do not exist')
+
+        return value
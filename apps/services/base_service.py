@@ -1,4 +1,6 @@
 import typing as t
+
+from initialization.sqlalchemy_async_process import async_commit
 from models import commit
 
 
@@ -12,15 +14,26 @@ class BaseService(object):
         return obj
 
     @commit
-    def batch_create(self, request_list: t.List[dict]):
-        """批量创建"""
+    def batch_create(self, request_list: t.List[dict], ingest: bool = False):
+        """批量创建
+
+        ingest: 为True时使用 bulk_ingest 高吞吐写入, 不创建ORM对象, 返回创建的id列表
+        """
+        if ingest:
+            return self._model.bulk_ingest(request_list, return_ids=True)
         objs = self._model.bulk_create(request_list)
         return objs
 
-    def list(self, page: int, per_page: int):
-        count, objs = self._model.get_by_filter(offset=page, limit=per_page)
+    def list(self, page: int, per_page: int, only_fields: t.Optional[t.Tuple[str, ...]] = None):
+        """only_fields: 只查询的字段, 见 SparseFieldsMixin"""
+        count, objs = self._model.get_by_filter(offset=page, limit=per_page, _only=only_fields)
         return count, objs
 
+    def cursor_list(self, after: t.Optional[str], per_page: int, only_fields: t.Optional[t.Tuple[str, ...]] = None):
+        """游标分页"""
+        count, objs, next_cursor = self._model.get_by_cursor(after=after, limit=per_page, _only=only_fields)
+        return count, objs, next_cursor
+
     def get_by_pk(self, pk: int):
         obj = self._model.get_by_id(pk)
         return obj
@@ -34,3 +47,40 @@ class BaseService(object):
     def update(self, pk: int, request: dict):
         obj = self._model.update(pk, **request)
         return obj
+
+
+class AsyncBaseService(object):
+    """异步service, 配合 AsyncBaseModel 在 Flask2 的 async def 视图中使用,
+    视图需要使用 async_session_scope 装饰, 见 initialization.sqlalchemy_async_process
+    """
+
+    _model = None
+
+    @async_commit
+    async def create(self, request: dict):
+        obj = await self._model.create(**request)
+        return obj
+
+    @async_commit
+    async def batch_create(self, request_list: t.List[dict]):
+        objs = await self._model.bulk_create(request_list)
+        return objs
+
+    async def list(self, page: int, per_page: int, only_fields: t.Optional[t.Tuple[str, ...]] = None):
+        """only_fields: 只查询的字段, 见 SparseFieldsMixin"""
+        count, objs = await self._model.get_by_filter(offset=page, limit=per_page, _only=only_fields)
+        return count, objs
+
+    async def get_by_pk(self, pk: int):
+        obj = await self._model.get_by_id(pk)
+        return obj
+
+    @async_commit
+    async def delete(self, pk: int):
+        obj = await self._model.delete(pk)
+        return obj
+
+    @async_commit
+    async def update(self, pk: int, request: dict):
+        obj = await self._model.update(pk, **request)
+        return obj
@@ -0,0 +1,51 @@
+"""
+游标分页工具
+
+游标是一个不透明的字符串, 内部为 json 序列化后的值列表, 经过 urlsafe base64 编码.
+datetime/date/Decimal 等 json 不支持的类型会被打上标记, 解码时还原.
+"""
+import base64
+import datetime
+import json
+from decimal import Decimal
+from typing import Any, List, Sequence
+
+
+def _default(obj: Any):
+    if isinstance(obj, datetime.datetime):
+        return {"__dt__": obj.isoformat()}
+    if isinstance(obj, datetime.date):
+        return {"__d__": obj.isoformat()}
+    if isinstance(obj, Decimal):
+        return {"__dec__": str(obj)}
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not cursor serializable")
+
+
+def _object_hook(obj: dict):
+    if "__dt__" in obj:
+        return datetime.datetime.fromisoformat(obj["__dt__"])
+    if "__d__" in obj:
+        return datetime.date.fromisoformat(obj["__d__"])
+    if "__dec__" in obj:
+        return Decimal(obj["__dec__"])
+    return obj
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """将值列表编码为游标字符串"""
+    raw = json.dumps(list(values), default=_default, separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """将游标字符串解码为值列表, 游标不合法时抛出 ValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        values = json.loads(raw, object_hook=_object_hook)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+    if not isinstance(values, list):
+        raise ValueError(f"invalid cursor: {cursor}")
+    return values
@@ -18,6 +18,18 @@ class TipResponse(BaseCustomException):
         super().__init__(msg)
 
 
+class VersionConflict(TipResponse):
+    """
+    @attention: 乐观锁冲突, 记录已经被其他请求修改
+    """
+
+    def __init__(self, msg="数据已被修改, 请刷新后重试", entity: str = None, _id=None, expected_version=None):
+        self.entity = entity
+        self.id = _id
+        self.expected_version = expected_version
+        super().__init__(msg, code=409, status=409)
+
+
 class RedirectResponse(BaseCustomException):
     """
     @attention: 重定向响应
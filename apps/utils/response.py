@@ -3,8 +3,8 @@
 - status  保持真实有效的 status_code
 - message 请求成功
 """
-from dataclasses import asdict, dataclass
-from typing import Any, Dict, List
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
 
 
 @dataclass
@@ -33,16 +33,32 @@ class BaseResponse(Base):
 class ListData(Base):
     total: int
     items: List[Dict]
+    next_cursor: Optional[str] = None
+    total_strategy: Optional[str] = None
+    has_more: Optional[bool] = None
+    # 稀疏字段集, 不为空时 items 只返回这些字段, 见 SparseFieldsMixin
+    only_fields: Optional[Tuple[str, ...]] = None
 
     __annotations__ = {
         "total": int,
         "items": List[Dict],
+        "next_cursor": Optional[str],
+        "total_strategy": Optional[str],
+        "has_more": Optional[bool],
+        "only_fields": Optional[Tuple[str, ...]],
     }
 
+    def __post_init__(self):
+        # total 为 BaseModel.get_by_filter 返回的 Count 时, 自动带上计数策略
+        if self.total_strategy is None:
+            self.total_strategy = getattr(self.total, "strategy", None)
+        if self.has_more is None:
+            self.has_more = getattr(self.total, "has_more", None)
+
 
 @dataclass
 class ListResponse(BaseResponse):
-    data: ListData = ListData(0, [])
+    data: ListData = field(default_factory=lambda: ListData(0, []))
 
     __annotations__ = {
         "data": ListData,
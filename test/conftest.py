@@ -0,0 +1,122 @@
+"""
+测试配置: 主库、从库与分片都使用临时目录中的sqlite文件, 需要在导入apps之前设置环境变量
+
+从库与主库是两个独立的文件, 没有复制, 可以用来模拟复制延迟
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "apps")
+sys.path.insert(0, APPS_DIR)
+
+TMP_DIR = tempfile.mkdtemp(prefix="flask-template-test-")
+SHARD_COUNT = 3
+
+os.environ.setdefault("GLOBAL_CONF_PATH", os.path.join(TMP_DIR, "global.conf"))
+os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(TMP_DIR, 'primary.db')}"
+os.environ["USE_DB_POOL"] = "false"
+os.environ["SQL_MONITOR"] = "false"
+os.environ["REPLICA_DATABASE_URIS"] = f"sqlite:///{os.path.join(TMP_DIR, 'replica.db')}"
+os.environ["SHARD_DATABASE_URIS"] = ",".join(
+    f"sqlite:///{os.path.join(TMP_DIR, f'shard{i}.db')}" for i in range(SHARD_COUNT))
+
+
+@pytest.fixture(scope="session")
+def app():
+    from initialization import create_app
+
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def db_session(app):
+    """每个用例结束时回滚主库与分片, 并移除session"""
+    from initialization.sharding_process import shard_sessions
+    from initialization.sqlalchemy_process import db
+
+    yield db.session
+    db.session.rollback()
+    db.session.remove()
+    # SQLAlchemy>=1.4 中没有开启事务的主库session回滚时不会触发 after_rollback, 分片session需要单独移除
+    for scoped in shard_sessions:
+        scoped.remove()
+
+
+@pytest.fixture
+def engine_events(app):
+    """上面关闭了 SQL_MONITOR, 这里只注册sql监控的引擎事件"""
+    from initialization import sql_monitor_process as monitor
+
+    listeners = [("before_cursor_execute", monitor._before_cursor_execute),
+                 ("after_cursor_execute", monitor._after_cursor_execute), ("handle_error", monitor._handle_error)]
+    for name, fn in listeners:
+        event.listen(Engine, name, fn)
+    yield monitor
+    for name, fn in listeners:
+        event.remove(Engine, name, fn)
+
+
+def create_tables(*entities):
+    """在主库与从库上创建entity的表"""
+    from initialization.sqlalchemy_process import REPLICA_BIND_PREFIX, db
+
+    binds = [None] + [key for key in db.get_app().config["SQLALCHEMY_BINDS"] if key.startswith(REPLICA_BIND_PREFIX)]
+    for bind in binds:
+        for entity in entities:
+            entity.__table__.create(db.get_engine(bind=bind), checkfirst=True)
+
+
+def replica_engine():
+    from initialization.sqlalchemy_process import REPLICA_BIND_PREFIX, db
+
+    return db.get_engine(bind=f"{REPLICA_BIND_PREFIX}0")
+
+
+class FakeRedis(object):
+    """内存中的redis, 只实现了实体缓存与计数缓存用到的命令, 不处理过期时间"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value)
+        return True
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+@pytest.fixture
+def fake_redis(app, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setitem(app.extensions, "redis_client", redis)
+    return redis
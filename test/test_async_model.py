@@ -0,0 +1,186 @@
+"""
+AsyncBaseModel 在 aiosqlite 上的测试
+"""
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, String
+
+from conftest import TMP_DIR
+
+
+@pytest.fixture(scope="module")
+def models(app):
+    from configs import sysconf
+    from entities.base import IsDelBaseEntity, PkBaseEntity
+    from initialization import sqlalchemy_async_process
+    from models.async_base import AsyncBaseModel
+
+    sysconf.USE_ASYNC_DB = True
+    sysconf.ASYNC_DATABASE_URI = f"sqlite+aiosqlite:///{os.path.join(TMP_DIR, 'async.db')}"
+    sqlalchemy_async_process.init_async_db(app)
+
+    class AsyncNode(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_async_node"
+
+        name = Column(String(32))
+        parent_id = Column(Integer, ForeignKey("test_async_node.id"))
+
+    class AsyncLeaf(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_async_leaf"
+
+        node_id = Column(Integer, ForeignKey("test_async_node.id"))
+
+    class AsyncNodeModel(AsyncBaseModel[AsyncNode]):
+        _like_filter_keys = ["name"]
+        _children = ["AsyncNode.parent_id", "AsyncLeaf.node_id"]
+
+    class AsyncLeafModel(AsyncBaseModel[AsyncLeaf]):
+        pass
+
+    async def create_tables():
+        async with sqlalchemy_async_process.async_engine.begin() as conn:
+            for entity in (AsyncNode, AsyncLeaf):
+                await conn.run_sync(entity.__table__.create)
+
+    asyncio.run(create_tables())
+    return AsyncNodeModel, AsyncLeafModel
+
+
+def run(coro_fn):
+    """在新的事件循环中执行, 结束时关闭session(未提交的修改被回滚)"""
+    from initialization.sqlalchemy_async_process import async_session_scope
+
+    return asyncio.run(async_session_scope(coro_fn)())
+
+
+async def _create_tree(node_model, leaf_model):
+    """root -> a -> b -> c, 每个节点下一个叶子"""
+    parent_id, nodes = None, []
+    for name in ("root", "a", "b", "c"):
+        node = await node_model.create(name=name, parent_id=parent_id)
+        await leaf_model.create(node_id=node.id)
+        parent_id = node.id
+        nodes.append(node)
+    return nodes
+
+
+def test_query_methods(models):
+    node_model, leaf_model = models
+
+    async def case():
+        await _create_tree(node_model, leaf_model)
+        assert [node.name for node in await node_model.get_all()] == ["c", "b", "a", "root"]
+        count, nodes = await node_model.get_by_filter(name="o", order_by_desc=False)
+        assert count == 1 and nodes[0].name == "root"
+        node = await node_model.get_by_id(nodes[0].id)
+        assert node.name == "root"
+        assert (await node_model.update(node.id, name="top")).name == "top"
+
+    run(case)
+
+
+def test_self_referencing_children_delete(models):
+    node_model, leaf_model = models
+
+    async def case():
+        nodes = await _create_tree(node_model, leaf_model)
+        report = await node_model.bulk_delete_by_filter(dry_run=True, name="a")
+        assert report == {"test_async_node": 3, "test_async_leaf": 3}
+
+        await node_model.delete(nodes[1].id)
+        assert [node.name for node in await node_model.get_all()] == ["root"]
+        assert len(await leaf_model.get_all()) == 1
+
+        await node_model.bulk_delete([nodes[0].id], force_delete=True)
+        assert await node_model.get_all(active_only=False) == []
+        assert await leaf_model.get_all(active_only=False) == []
+
+    run(case)
+
+
+def test_sync_methods_are_not_inherited(models):
+    from models.base import BaseModel, ModelMixin
+
+    node_model, _ = models
+    assert issubclass(node_model, ModelMixin) and not issubclass(node_model, BaseModel)
+    for name in ("load", "iter_by_filter", "get_by_cursor", "aggregate", "bulk_update", "bulk_upsert", "update_by_id",
+                 "archive_deleted"):
+        assert not hasattr(node_model, name)
+
+
+def test_sync_only_features_are_rejected(models):
+    from schemas.validates import ResourceListValidator, ResourceValidator
+
+    node_model, leaf_model = models
+    with pytest.raises(TypeError):
+        ResourceValidator(node_model)
+    with pytest.raises(TypeError):
+        ResourceListValidator(leaf_model)
+
+    from entities.base import PkBaseEntity
+    from models.async_base import AsyncBaseModel
+
+    class AsyncCached(PkBaseEntity):
+        __tablename__ = "test_async_cached"
+
+    with pytest.raises(AttributeError):
+
+        class AsyncCachedModel(AsyncBaseModel[AsyncCached]):
+            _cache_ttl = 60
+
+
+@pytest.fixture(scope="module")
+def versioned_model(models):
+    from entities.base import PkBaseEntity, VersionBaseEntity
+    from initialization import sqlalchemy_async_process
+    from models.async_base import AsyncBaseModel
+
+    class AsyncDoc(PkBaseEntity, VersionBaseEntity):
+        __tablename__ = "test_async_doc"
+
+        title = Column(String(32))
+
+    class AsyncDocModel(AsyncBaseModel[AsyncDoc]):
+        pass
+
+    async def create_table():
+        async with sqlalchemy_async_process.async_engine.begin() as conn:
+            await conn.run_sync(AsyncDoc.__table__.create)
+
+    asyncio.run(create_table())
+    return AsyncDocModel
+
+
+def test_update_bumps_version(versioned_model):
+    from utils.exceptions import VersionConflict
+
+    async def case():
+        doc = await versioned_model.create(title="a")
+        assert doc.version == 1
+
+        doc = await versioned_model.update(doc.id, title="b")
+        assert (doc.title, doc.version) == ("b", 2)
+        # version 不能被直接覆盖
+        assert (await versioned_model.update(doc.id, version=10)).version == 2
+
+        doc = await versioned_model.update(doc.id, expected_version=2, title="c")
+        assert (doc.title, doc.version) == ("c", 3)
+        with pytest.raises(VersionConflict):
+            await versioned_model.update(doc.id, expected_version=2, title="d")
+        assert await versioned_model.update(doc.id + 100, expected_version=1, title="d") is None
+        assert (await versioned_model.get_by_id(doc.id, active_only=False)).title == "c"
+
+    run(case)
+
+
+def test_expected_version_requires_version_column(models):
+    node_model, _ = models
+
+    async def case():
+        node = await node_model.create(name="n")
+        with pytest.raises(RuntimeError):
+            await node_model.update(node.id, expected_version=1, name="m")
+
+    run(case)
@@ -0,0 +1,705 @@
+"""
+BaseModel 在sqlite主库上的测试
+"""
+from functools import partial
+
+import pytest
+from sqlalchemy import Column, Integer, String
+
+from conftest import create_tables, replica_engine
+
+
+@pytest.fixture(scope="module")
+def item_model(app):
+    from entities.base import IsDelBaseEntity, PkBaseEntity, TimeBaseEntity
+    from models.base import BaseModel
+
+    class BaseItem(PkBaseEntity, TimeBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_base_item"
+
+        code = Column(String(32), unique=True)
+        name = Column(String(32))
+        amount = Column(Integer, default=0)
+
+    class BaseItemModel(BaseModel[BaseItem]):
+        _filter_keys = ["id", "code", "amount"]
+        _like_filter_keys = ["name"]
+
+    create_tables(BaseItem)
+    return BaseItemModel
+
+
+@pytest.fixture(scope="module")
+def cached_model(app):
+    from entities.base import IsDelBaseEntity, PkBaseEntity
+    from models.base import BaseModel
+
+    class CachedItem(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_cached_item"
+
+        name = Column(String(32))
+
+    class CachedItemModel(BaseModel[CachedItem]):
+        _cache_ttl = 60
+
+    create_tables(CachedItem)
+    return CachedItemModel
+
+
+@pytest.fixture
+def committed(app):
+    """在主库或者从库上直接提交的记录, 用例结束时删除: committed(engine, table, **row)"""
+    rows = []
+
+    def insert(engine, table, **row):
+        with engine.begin() as conn:
+            conn.execute(table.insert(), row)
+        rows.append((engine, table, row["id"]))
+
+    yield insert
+    for engine, table, _id in rows:
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.id == _id))
+
+
+def _ids_by_code(model, session):
+    return dict(session.query(model._entity.code, model._entity.id))
+
+
+def test_bulk_ingest_returns_auto_ids(item_model, db_session):
+    ids = item_model.bulk_ingest([dict(code=f"a{i}") for i in range(5)], chunk_size=2, return_ids=True)
+    assert ids == [_ids_by_code(item_model, db_session)[f"a{i}"] for i in range(5)]
+
+
+def test_bulk_ingest_with_explicit_ids(item_model, db_session):
+    """同一块中混合指定的id与自增id, 返回值与表中的记录一致"""
+    entity_list = [dict(code="e0"), dict(id=500, code="e1"), dict(code="e2"), dict(id=7, code="e3"), dict(code="e4")]
+    ids = item_model.bulk_ingest(entity_list, return_ids=True)
+
+    assert ids[1] == 500 and ids[3] == 7
+    assert ids == [_ids_by_code(item_model, db_session)[entity["code"]] for entity in entity_list]
+    assert len(set(ids)) == len(ids)
+
+
+def test_reads_use_replica_until_write(item_model, committed, db_session):
+    table = item_model._entity.__table__
+    committed(replica_engine(), table, id=900, code="r900", name="replica")
+
+    count, items = item_model.get_by_filter(code="r900")
+    assert count == 1 and items[0].name == "replica"
+
+    # 写入之后当前session固定使用主库, 读到自己的写入
+    item_model.create(code="p900", name="primary")
+    assert item_model.get_by_filter(code="r900") == (0, [])
+    assert item_model.get_by_filter(code="p900")[0] == 1
+
+
+def test_sticky_primary_after_commit(item_model, committed, db_session):
+    from models.base import safe_commit
+
+    committed(replica_engine(), item_model._entity.__table__, id=901, code="r901", name="replica")
+    with safe_commit():
+        item = item_model.create(code="p901", name="primary")
+    # 提交之后当前session(请求)仍然使用主库, 复制延迟时也能读到刚提交的数据
+    assert item_model.get_by_filter(code="p901")[0] == 1
+    assert item_model.get_by_filter(code="r901")[0] == 0
+    item_model._entity.query.filter_by(id=item.id).delete()
+    db_session.commit()
+
+
+def test_cache_miss_reads_primary(cached_model, committed, fake_redis, db_session):
+    table = cached_model._entity.__table__
+    committed(db_session.get_bind(), table, id=1, name="new")
+    # 从库还是旧数据
+    committed(replica_engine(), table, id=1, name="old")
+
+    assert cached_model.get_by_id(1).name == "new"
+    assert '"name": "new"' in fake_redis.get(cached_model._entity_cache.key(1))
+    db_session.remove()
+
+    # 缓存命中时不查询数据库
+    with db_session.get_bind().begin() as conn:
+        conn.execute(table.update().values(name="changed"))
+    assert cached_model.get_by_id_list([1])[0].name == "new"
+    # 未命中的不存在的id写入负缓存
+    assert cached_model.get_by_id(2) is None
+    assert fake_redis.get(cached_model._entity_cache.key(2)) == "-"
+
+
+def test_cache_invalidated_after_commit_and_rollback(cached_model, committed, fake_redis, db_session):
+    from models.base import safe_commit
+
+    committed(db_session.get_bind(), cached_model._entity.__table__, id=5, name="v1")
+    key = cached_model._entity_cache.key(5)
+    assert cached_model.get_by_id(5).name == "v1" and key in fake_redis.data
+    db_session.remove()
+
+    # 事务中不读取也不删除缓存, 读到自己的写入
+    cached_model.update(5, name="v2")
+    assert cached_model.get_by_id(5).name == "v2" and '"v1"' in fake_redis.get(key)
+    # 回滚之后失效, 不会留下未提交的数据
+    db_session.rollback()
+    assert key not in fake_redis.data
+    assert cached_model.get_by_id(5).name == "v1" and '"v1"' in fake_redis.get(key)
+    db_session.remove()
+
+    with safe_commit():
+        cached_model.update(5, name="v3")
+        assert '"v1"' in fake_redis.get(key)
+    assert key not in fake_redis.data
+    db_session.remove()
+    assert cached_model.get_by_id(5).name == "v3"
+
+
+def test_filter_conditions(item_model, db_session):
+    item_model.bulk_ingest([dict(code=f"f{i}", name=f"name{i}", amount=i) for i in range(5)])
+
+    def codes(**kwargs):
+        return sorted(item.code for item in item_model.get_all_by_filter(**kwargs))
+
+    assert codes(code="f1") == ["f1"]
+    assert codes(amount=[0, 3, 9]) == ["f0", "f3"]
+    assert codes(amount=(2, 3), _range_filter_keys=["amount"]) == ["f2", "f3"]
+    assert codes(name="me1|me4", amount=[1, 2, 4]) == ["f1", "f4"]
+    assert codes(code=None, name="name") == [f"f{i}" for i in range(5)]
+
+
+def test_get_by_cursor_pages_and_counts(item_model, fake_redis, db_session):
+    item_model.bulk_ingest([dict(code=f"c{i}", amount=i % 3) for i in range(7)])
+
+    seen, after = [], None
+    while True:
+        count, items, after = item_model.get_by_cursor(order_by="amount", after=after, limit=3, require_count=True)
+        assert count == 7 and count.strategy == "exact"
+        seen.extend(item.code for item in items)
+        if after is None:
+            break
+    assert sorted(seen) == [f"c{i}" for i in range(7)] and len(seen) == 7
+
+    count, items, after = item_model.get_by_cursor(limit=5, require_count=True, count_strategy="has_more")
+    assert (count, count.strategy, count.has_more) == (5, "has_more", True)
+    count, _, _ = item_model.get_by_cursor(limit=5, require_count=True, count_strategy="cached", concurrent_count=True)
+    assert (count, count.strategy) == (7, "cached")
+
+
+@pytest.mark.parametrize("values", [
+    ["amount", "1", 3],
+    ["amount", 1, "3 OR 1=1"],
+    ["amount", True, 3],
+    ["amount", None, 3],
+    ["amount", {"x": 1}, 3],
+    ["id", 2.5],
+])
+def test_get_by_cursor_rejects_tampered_values(item_model, db_session, values):
+    from utils.cursor_tools import encode_cursor
+    from utils.exceptions import TipResponse
+
+    with pytest.raises(TipResponse):
+        item_model.get_by_cursor(order_by=values[0], after=encode_cursor(values))
+
+
+def test_deferred_flush_assigns_ids_on_flush(item_model, monkeypatch, db_session):
+    from models.base import deferred_flush
+
+    changed = []
+    monkeypatch.setattr(item_model, "_on_changed", classmethod(lambda cls, ids, op: changed.append((ids, op))))
+    with deferred_flush() as sess:
+        item = item_model.create(code="d0")
+        items = item_model.bulk_create([dict(code="d1"), dict(code="d2")])
+        # flush之前没有id, 也不会通知变更
+        assert item.id is None and changed == []
+
+        sess.flush()
+        assert item.id is not None and all(entity.id for entity in items)
+        assert changed == [([item.id], "create"), ([entity.id for entity in items], "create")]
+
+        # 查询之前自动flush
+        item_model.create(code="d3")
+        assert item_model.get_by_filter(code="d3")[0] == 1
+    assert [op for _, op in changed] == ["create"] * 3
+    assert _ids_by_code(item_model, db_session).keys() >= {"d0", "d1", "d2", "d3"}
+
+
+def test_bulk_upsert_counts(item_model, db_session):
+    report = item_model.bulk_upsert([dict(code="u0", amount=1), dict(code="u1", amount=1)], ["code"])
+    assert report == {"inserted": 2, "updated": 0, "unchanged": 0}
+
+    report = item_model.bulk_upsert([dict(code="u0", amount=2), dict(code="u2", amount=2)], ["code"])
+    assert report == {"inserted": 1, "updated": 1, "unchanged": 0}
+
+    # 只有冲突字段时没有需要更新的字段, 已有的行保持不变
+    report = item_model.bulk_upsert([dict(code="u1"), dict(code="u3")], ["code"])
+    assert report == {"inserted": 1, "updated": 0, "unchanged": 1}
+    report = item_model.bulk_upsert([dict(code="u2", amount=5)], ["code"], update_columns=[])
+    assert report == {"inserted": 0, "updated": 0, "unchanged": 1}
+
+    amounts = dict(db_session.query(item_model._entity.code, item_model._entity.amount))
+    assert {code: amounts[code] for code in ("u0", "u1", "u2", "u3")} == {"u0": 2, "u1": 1, "u2": 2, "u3": 0}
+
+
+def test_cached_count_falls_back_when_redis_is_down(item_model, app, monkeypatch, db_session):
+    from redis.exceptions import ConnectionError
+
+    from models import base
+
+    class DownRedis(object):
+
+        def __getattr__(self, name):
+
+            def command(*args, **kwargs):
+                raise ConnectionError("redis is down")
+
+            return command
+
+    warnings = []
+    monkeypatch.setitem(app.extensions, "redis_client", DownRedis())
+    monkeypatch.setattr(base, "_count_cache_warned_at", None)
+    monkeypatch.setattr(base.logger, "warning", warnings.append)
+    monkeypatch.setattr(base.logger, "exception", warnings.append)
+
+    item_model.bulk_ingest([dict(code=f"k{i}", amount=9) for i in range(3)])
+    for _ in range(3):
+        count, _ = item_model.get_by_filter(amount=9, count_strategy="cached")
+        assert (count, count.strategy) == (3, "cached")
+    # 只记录一次警告
+    assert len(warnings) == 1
+
+
+def test_concurrent_count_in_request(item_model, committed, engine_events, app, db_session):
+    import threading
+
+    from sqlalchemy import event
+
+    # 读取路由到从库
+    engine = replica_engine()
+    for i in range(3):
+        committed(engine, item_model._entity.__table__, id=950 + i, code=f"q{i}", amount=7,
+                  is_deleted=False)
+
+    count_threads = []
+
+    def record_count_thread(conn, cursor, statement, *args):
+        if "count(" in statement.lower():
+            count_threads.append(threading.current_thread().name)
+
+    event.listen(engine, "before_cursor_execute", record_count_thread)
+    try:
+        with app.test_request_context():
+            # 请求中已经执行过查询(如查询当前用户), 事务已经开启
+            assert item_model.get_by_id(950).code == "q0"
+            count, items = item_model.get_by_filter(amount=7, concurrent_count=True)
+            stats = engine_events.get_sql_stats()
+    finally:
+        event.remove(engine, "before_cursor_execute", record_count_thread)
+
+    assert count == 3 and len(items) == 3
+    assert len(count_threads) == 1 and count_threads[0] != threading.current_thread().name
+    # 计数线程的sql计入请求的统计
+    assert stats.count == 3 and any("count(" in shape.lower() for shape in stats.fingerprints)
+
+
+def test_batch_loader_coalesces_get_by_id(item_model, app, db_session):
+    from sqlalchemy import event
+
+    ids = item_model.bulk_ingest([dict(code=f"l{i}") for i in range(3)], return_ids=True)
+    selects = []
+
+    def record_select(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_select)
+    try:
+        with app.test_request_context():
+            deferred_list = [item_model.load(_id) for _id in ids + [10 ** 6]]
+            assert selects == []
+            assert [deferred.get() and deferred.get().code for deferred in deferred_list] == ["l0", "l1", "l2", None]
+            assert len(selects) == 1
+
+            # 之后的获取使用请求内的缓存
+            assert item_model.get_by_id(ids[1]).code == "l1"
+            assert [item.code for item in item_model.get_by_id_list(ids[::-1])] == ["l2", "l1", "l0"]
+            assert item_model.get_by_id(10 ** 6) is None
+            assert len(selects) == 1
+
+            # 变更之后清除对应id的缓存
+            item_model.update(ids[0], name="changed")
+            selects.clear()
+            assert item_model.get_by_id(ids[0]).name == "changed"
+            assert len(selects) == 1
+        # 请求之外不缓存
+        selects.clear()
+        item_model.get_by_id(ids[2])
+        item_model.get_by_id(ids[2])
+        assert len(selects) == 2
+    finally:
+        event.remove(engine, "before_cursor_execute", record_select)
+
+
+def test_bulk_update_by_case(item_model, db_session):
+    from sqlalchemy import event
+
+    ids = item_model.bulk_ingest([dict(code=f"b{i}", name="old", amount=0) for i in range(4)], return_ids=True)
+    loaded = item_model.get_by_id(ids[0])
+    updates = []
+
+    def record_update(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("UPDATE"):
+            updates.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_update)
+    try:
+        affected = item_model.bulk_update([
+            dict(id=ids[0], amount=1),
+            dict(id=ids[1], amount=2),
+            dict(id=ids[2], amount=3, name="new"),
+            dict(id=ids[3], amount=4),
+            dict(id=ids[1], amount=5),  # 同一个id以最后一次为准
+        ], set_based=True, chunk_size=2)
+    finally:
+        event.remove(engine, "before_cursor_execute", record_update)
+
+    # 字段相同的行分为一组, 每组按照 chunk_size 分块
+    assert affected == 4 and len(updates) == 3 and all("CASE" in statement for statement in updates)
+    rows = {row.id: (row.name, row.amount) for row in db_session.query(item_model._entity).filter(
+        item_model._entity.id.in_(ids))}
+    assert [rows[_id] for _id in ids] == [("old", 1), ("old", 5), ("new", 3), ("old", 4)]
+    # session 中已经加载的entity被过期, 重新读取更新后的值
+    assert loaded.amount == 1
+
+
+@pytest.fixture(scope="module")
+def cascade_models(app):
+    from entities.base import IsDelBaseEntity, PkBaseEntity
+    from models.base import BaseModel
+
+    class CascadeNode(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_cascade_node"
+
+        name = Column(String(32))
+        parent_id = Column(Integer)
+
+    class CascadeLeaf(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_cascade_leaf"
+
+        node_id = Column(Integer)
+
+    class CascadeTag(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_cascade_tag"
+
+        leaf_id = Column(Integer)
+
+    class CascadeNodeModel(BaseModel[CascadeNode]):
+        _like_filter_keys = ["name"]
+        _children = ["CascadeNode.parent_id", "CascadeLeaf.node_id"]
+
+    class CascadeLeafModel(BaseModel[CascadeLeaf]):
+        _children = ["CascadeTag.leaf_id"]
+
+    class CascadeTagModel(BaseModel[CascadeTag]):
+        pass
+
+    create_tables(CascadeNode, CascadeLeaf, CascadeTag)
+    return CascadeNodeModel, CascadeLeafModel, CascadeTagModel
+
+
+def test_cascade_delete(cascade_models, db_session):
+    node_model, leaf_model, tag_model = cascade_models
+
+    # root -> a -> b -> c, 每个节点下一个叶子, 每个叶子下两个标签
+    parent_id, node_ids = None, []
+    for name in ("root", "a", "b", "c"):
+        parent_id = node_model.create(name=name, parent_id=parent_id).id
+        leaf = leaf_model.create(node_id=parent_id)
+        tag_model.bulk_ingest([dict(leaf_id=leaf.id), dict(leaf_id=leaf.id)])
+        node_ids.append(parent_id)
+
+    def active(model):
+        return len(model.get_all_by_filter())
+
+    expected = {"test_cascade_node": 3, "test_cascade_leaf": 3, "test_cascade_tag": 6}
+    assert node_model.bulk_delete_by_filter(dry_run=True, name="a") == expected
+    assert (active(node_model), active(leaf_model), active(tag_model)) == (4, 4, 8)
+
+    assert node_model.bulk_delete_by_filter(name="a") == expected
+    assert (active(node_model), active(leaf_model), active(tag_model)) == (1, 1, 2)
+    # 软删除的记录不会再被删除
+    assert node_model.bulk_delete_by_filter(dry_run=True, name="a") == dict.fromkeys(expected, 0)
+
+    node_model.bulk_delete([node_ids[0]], force_delete=True)
+    assert [model._entity.query.count() for model in cascade_models] == [0, 0, 0]
+
+
+def test_archive_and_purge(app, committed, fake_redis, db_session):
+    from datetime import datetime, timedelta
+
+    from entities.base import IsDelBaseEntity, PkBaseEntity, TimeBaseEntity
+    from models.base import BaseModel
+
+    class ArchivedItem(PkBaseEntity, TimeBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_archived_item"
+
+        name = Column(String(32))
+
+    class ArchivedItemModel(BaseModel[ArchivedItem]):
+        _archive_retention_days = 30
+        _cache_ttl = 60
+
+    create_tables(ArchivedItem)
+    engine, table = db_session.get_bind(), ArchivedItem.__table__
+    old, recent = datetime.now() - timedelta(days=31), datetime.now() - timedelta(days=1)
+    for _id, is_deleted, update_time in [(1, True, old), (2, False, old), (3, True, recent), (4, True, old),
+                                         (5, True, old)]:
+        committed(engine, table, id=_id, name=f"n{_id}", is_deleted=is_deleted, update_time=update_time)
+    fake_redis.set(ArchivedItemModel._entity_cache.key(1), "cached")
+
+    # 只归档软删除并且超过保留天数的记录
+    assert ArchivedItemModel.archive_deleted(batch_size=2, sleep_ms=0) == 3
+    assert sorted(row.id for row in ArchivedItem.query) == [2, 3]
+    archive = ArchivedItemModel._archive_table
+    with engine.connect() as conn:
+        assert sorted(row.id for row in conn.execute(archive.select())) == [1, 4, 5]
+    # 归档的记录从实体缓存中失效
+    assert fake_redis.get(ArchivedItemModel._entity_cache.key(1)) is None
+    assert ArchivedItemModel.archive_deleted() == 0
+
+    assert ArchivedItemModel.purge_archive(batch_size=2, sleep_ms=0) == 0
+    with engine.begin() as conn:
+        conn.execute(archive.update().where(archive.c.id != 5).values(archived_at=old))
+    assert ArchivedItemModel.purge_archive(days=30, batch_size=2, sleep_ms=0) == 2
+    with engine.connect() as conn:
+        assert [row.id for row in conn.execute(archive.select())] == [5]
+    assert ArchivedItemModel.purge_archive(days=0, sleep_ms=0) == 1
+
+
+def test_iter_by_filter(item_model, db_session):
+    item_model.bulk_ingest([dict(code=f"i{i}", amount=11) for i in range(5)])
+
+    batches = list(item_model.iter_by_filter(amount=11, batch_size=2, as_batches=True))
+    assert [[item.code for item in batch] for batch in batches] == [["i0", "i1"], ["i2", "i3"], ["i4"]]
+    # 处理完的批次从session中移除
+    assert all(item not in db_session for batch in batches for item in batch)
+
+    items = list(item_model.iter_by_filter(amount=11, order_by_desc=True, batch_size=2, expunge=False))
+    assert [item.code for item in items] == [f"i{i}" for i in range(4, -1, -1)]
+    assert all(item in db_session for item in items)
+
+
+def test_fulltext_filter(app):
+    from sqlalchemy.dialects import mysql
+
+    from entities.base import PkBaseEntity
+    from models.base import BaseModel
+
+    class Article(PkBaseEntity):
+        __tablename__ = "test_fulltext_article"
+
+        title = Column(String(64))
+        body = Column(String(255))
+
+    class ArticleModel(BaseModel[Article]):
+        _like_filter_keys = ["title", "body"]
+        _fulltext_filter_keys = ["title"]
+
+    def compile_filter(**kwargs):
+        return str(ArticleModel._build_filter(**kwargs).compile(dialect=mysql.dialect()))
+
+    assert [index.name for index in ArticleModel._fulltext_indexes] == ["ft_test_fulltext_article_title"]
+    assert "MATCH (test_fulltext_article.title) AGAINST" in compile_filter(title="数据|库表")
+    params = ArticleModel._build_filter(title='数据|"库表').compile(dialect=mysql.dialect()).params
+    assert list(params.values()) == ['"数据" " 库表"']
+    # 短于 ngram_token_size 的词无法命中全文索引, 退回like
+    assert "LIKE" in compile_filter(title="数据|库") and "MATCH" not in compile_filter(title="数据|库")
+    assert "MATCH" not in compile_filter(body="数据")
+
+    with pytest.raises(AttributeError):
+
+        class BadArticleModel(BaseModel[Article]):
+            _fulltext_filter_keys = ["title"]
+
+
+def test_get_many2many_filter(app, db_session):
+    from sqlalchemy import event
+
+    from entities.base import IsDelBaseEntity, PkBaseEntity
+    from models.base import BaseModel, MiddleBaseModel
+
+    class M2mTag(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_m2m_tag"
+
+        name = Column(String(32))
+
+    class M2mUserTag(PkBaseEntity):
+        __tablename__ = "test_m2m_user_tag"
+
+        user_id = Column(Integer)
+        tag_id = Column(Integer)
+
+    class M2mTagModel(BaseModel[M2mTag]):
+        _like_filter_keys = ["name"]
+
+    class M2mUserTagModel(MiddleBaseModel, BaseModel[M2mUserTag]):
+        pass
+
+    create_tables(M2mTag, M2mUserTag)
+    tag_ids = M2mTagModel.bulk_ingest([dict(name=name) for name in ("red", "green", "blue", "redish")],
+                                      return_ids=True)
+    M2mUserTagModel.bulk_ingest([dict(user_id=1, tag_id=tag_ids[i]) for i in (0, 1, 3)] +
+                                [dict(user_id=2, tag_id=tag_ids[2])])
+    M2mTagModel.delete(tag_ids[1])
+
+    selects = []
+
+    def record_select(conn, cursor, statement, *args):
+        selects.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_select)
+    try:
+        count, tags = M2mUserTagModel.get_many2many_filter(M2mTagModel, "user_id", "tag_id", user_id=1,
+                                                           order_by_desc=False)
+    finally:
+        event.remove(engine, "before_cursor_execute", record_select)
+    # 中间表以子查询的形式嵌入, 只需要分页与计数两条语句
+    assert len(selects) == 2
+    assert (count, [tag.name for tag in tags]) == (2, ["red", "redish"])
+
+    count, tags = M2mUserTagModel.get_many2many_filter(M2mTagModel, "user_id", "tag_id", user_id=1, name="ish")
+    assert (count, [tag.name for tag in tags]) == (1, ["redish"])
+    count, tags = M2mUserTagModel.get_many2many_filter(M2mTagModel, "user_id", "tag_id", user_id=1, limit=1,
+                                                       offset=1, order_by_desc=False)
+    assert (count, [tag.name for tag in tags]) == (2, ["redish"])
+
+
+def test_get_by_filter_only_fields(item_model, db_session):
+    from sqlalchemy import event
+
+    item_model.bulk_ingest([dict(code="s0", name="sparse", amount=12)])
+    selects = []
+
+    def record_select(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_select)
+    try:
+        _, items = item_model.get_by_filter(amount=12, require_count=False, _only=("name", "not_a_column"))
+    finally:
+        event.remove(engine, "before_cursor_execute", record_select)
+
+    # 只查询传入的字段与主键, 不是数据库字段的名称被忽略
+    columns = selects[0].split("FROM")[0]
+    assert "test_base_item.name" in columns and "test_base_item.id" in columns
+    assert "test_base_item.code" not in columns and "test_base_item.amount" not in columns
+    assert items[0].name == "sparse"
+
+
+@pytest.fixture(scope="module")
+def post_model(app):
+    from sqlalchemy import ForeignKey
+    from sqlalchemy.orm import relationship
+
+    from entities.base import IsDelBaseEntity, PkBaseEntity
+    from models.base import BaseModel
+
+    class LoadCompany(PkBaseEntity):
+        __tablename__ = "test_load_company"
+
+        name = Column(String(32))
+
+    class LoadAuthor(PkBaseEntity):
+        __tablename__ = "test_load_author"
+
+        name = Column(String(32))
+        company_id = Column(Integer, ForeignKey("test_load_company.id"))
+        company = relationship(LoadCompany)
+
+    class LoadPost(PkBaseEntity, IsDelBaseEntity):
+        __tablename__ = "test_load_post"
+
+        title = Column(String(32))
+        author_id = Column(Integer, ForeignKey("test_load_author.id"))
+        author = relationship(LoadAuthor)
+        comments = relationship("LoadComment")
+
+    class LoadComment(PkBaseEntity):
+        __tablename__ = "test_load_comment"
+
+        post_id = Column(Integer, ForeignKey("test_load_post.id"))
+
+    class LoadPostModel(BaseModel[LoadPost]):
+        _load_options = {"comments": "selectin", "author": "joined", "author.company": "selectin"}
+
+    create_tables(LoadCompany, LoadAuthor, LoadPost, LoadComment)
+    return LoadPostModel
+
+
+def test_eager_load_options(post_model, db_session):
+    from sqlalchemy import event
+    from sqlalchemy.exc import InvalidRequestError
+
+    entities = post_model._entity.__mapper__.relationships
+    company = entities["author"].mapper.relationships["company"].mapper.class_(name="c")
+    for i in range(3):
+        author = entities["author"].mapper.class_(name=f"a{i}", company=company)
+        comments = [entities["comments"].mapper.class_() for _ in range(2)]
+        db_session.add(post_model._entity(title=f"p{i}", author=author, comments=comments))
+    db_session.flush()
+    db_session.expunge_all()
+
+    selects = []
+
+    def record_select(conn, cursor, statement, *args):
+        selects.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_select)
+    try:
+        posts = post_model.get_all_by_filter()
+        assert [(len(post.comments), post.author.company.name) for post in posts] == [(2, "c")] * 3
+        # 主表(连接作者), 评论, 公司各一条语句, 与记录数无关
+        assert len(selects) == 3
+        db_session.expunge_all()
+
+        _, posts = post_model.get_by_filter(require_count=False, _load={"comments": "raise"})
+        with pytest.raises(InvalidRequestError):
+            posts[0].comments
+    finally:
+        event.remove(engine, "before_cursor_execute", record_select)
+
+    with pytest.raises(AttributeError):
+        post_model.get_all_by_filter(_load={"author.unknown": "selectin"})
+    with pytest.raises(ValueError):
+        post_model.get_all_by_filter(_load={"author": "eager"})
+
+
+def test_aggregate(item_model, db_session):
+    from datetime import datetime
+
+    rows = [("x", 1, datetime(2021, 3, 1, 10)), ("x", 2, datetime(2021, 3, 7, 23)), ("y", 5, datetime(2021, 3, 8)),
+            ("y", 5, datetime(2021, 4, 2)), ("z", 7, datetime(2021, 4, 3))]
+    item_model.bulk_ingest([dict(code=f"g{i}", name=name, amount=amount, create_time=create_time)
+                            for i, (name, amount, create_time) in enumerate(rows)])
+    aggregate = partial(item_model.aggregate, name="x|y|z")
+
+    metrics = {"cnt": "count", "total": ("sum", "amount"), "kinds": ("count_distinct", "amount")}
+    assert aggregate(group_by=["name"], metrics=metrics) == [
+        dict(name="x", cnt=2, total=3, kinds=2), dict(name="y", cnt=2, total=10, kinds=1),
+        dict(name="z", cnt=1, total=7, kinds=1)]
+    # top N
+    assert aggregate(group_by=["name"], metrics={"total": ("sum", "amount")}, order_by="total", order_by_desc=True,
+                     limit=2) == [dict(name="y", total=10), dict(name="z", total=7)]
+
+    assert aggregate(bucket="week") == [dict(bucket="2021-03-01", count=2), dict(bucket="2021-03-08", count=1),
+                                        dict(bucket="2021-03-29", count=2)]
+    assert aggregate(bucket="month", group_by=["name"], metrics={"max": ("max", "amount")}) == [
+        dict(bucket="2021-03", name="x", max=2), dict(bucket="2021-03", name="y", max=5),
+        dict(bucket="2021-04", name="y", max=5), dict(bucket="2021-04", name="z", max=7)]
+
+    for kwargs in (dict(group_by=["name"], metrics={"name": "count"}), dict(metrics={"total": "sum"}),
+                   dict(metrics={"total": ("median", "amount")}), dict(order_by="amount")):
+        with pytest.raises(ValueError):
+            aggregate(**kwargs)
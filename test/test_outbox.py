@@ -0,0 +1,59 @@
+"""
+outbox 写入与发布的测试
+"""
+import pytest
+from sqlalchemy import Column, String
+
+from conftest import create_tables
+
+
+@pytest.fixture(scope="module")
+def outbox_model(app):
+    from entities.base import PkBaseEntity
+    from entities.entities import OutboxEntity
+    from initialization.sqlalchemy_process import db
+    from models.base import BaseModel
+
+    class OutboxItem(PkBaseEntity):
+        __tablename__ = "test_outbox_item"
+
+        name = Column(String(32))
+
+    class OutboxItemModel(BaseModel[OutboxItem]):
+        _outbox = True
+
+    create_tables(OutboxEntity, OutboxItem)
+    yield OutboxItemModel
+    with db.engine.begin() as conn:
+        conn.execute(OutboxItem.__table__.delete())
+
+
+def test_publisher_is_abstract(app):
+    from models.outbox import StreamPublisher
+
+    with pytest.raises(TypeError):
+        StreamPublisher()
+
+
+def test_record_relay_publish(outbox_model, db_session):
+    from models.base import safe_commit
+    from models.outbox import MemoryStreamPublisher, relay_outbox, stream_name
+
+    with safe_commit():
+        item_id = outbox_model.create(name="a").id
+        outbox_model.update(item_id, name="b")
+    # 回滚的变更不会发布
+    outbox_model.create(name="rollback")
+    db_session.rollback()
+    with safe_commit():
+        outbox_model.delete(item_id, force_delete=True)
+
+    publisher = MemoryStreamPublisher()
+    assert relay_outbox(publisher, batch_size=2) == 3
+    messages = publisher.streams[stream_name(outbox_model._entity.__tablename__)]
+    assert [(message["id"], message["op"]) for message in messages] == [
+        (str(item_id), "create"), (str(item_id), "update"), (str(item_id), "delete")]
+    assert [int(message["outbox_id"]) for message in messages] == sorted(int(m["outbox_id"]) for m in messages)
+
+    # 发布之后删除
+    assert relay_outbox(publisher) == 0
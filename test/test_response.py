@@ -0,0 +1,52 @@
+"""
+响应结构测试
+"""
+
+
+def test_list_response_default_data_is_not_shared(app):
+    from utils.response import ListResponse
+
+    first, second = ListResponse(), ListResponse()
+    first.data.items.append({"id": 1})
+    assert second.data.items == []
+    assert second.asdict()["data"]["total"] == 0
+
+
+def test_list_data_takes_strategy_from_count(app):
+    from models.base import Count
+    from utils.response import ListData
+
+    data = ListData(Count(11, "has_more", True), [], next_cursor="abc")
+    assert (data.total, data.total_strategy, data.has_more, data.next_cursor) == (11, "has_more", True, "abc")
+
+
+def test_sparse_fields_from_query_to_response(app):
+    import pytest
+    from marshmallow import ValidationError, fields
+
+    from schemas.base_schema import PageMixin, RawBaseSchema, SparseFieldsMixin
+    from schemas.response_schema import ListResponseSchema
+    from utils.response import ListData, ListResponse
+
+    class ItemSchema(RawBaseSchema):
+        id = fields.Int()
+        name = fields.Str()
+        amount = fields.Int()
+        secret = fields.Str(load_only=True)
+
+    class ItemQuerySchema(RawBaseSchema, PageMixin, SparseFieldsMixin):
+        _sparse_schema = ItemSchema
+
+    query_schema = ItemQuerySchema()
+    assert query_schema.load({})["only_fields"] is None
+    assert query_schema.load({"fields": " name,id,,name "})["only_fields"] == ("name", "id")
+    for value in ("name,unknown", "secret"):
+        with pytest.raises(ValidationError):
+            query_schema.load({"fields": value})
+
+    items = [dict(id=1, name="a", amount=3), dict(id=2, name="b", amount=4)]
+    response_schema = ListResponseSchema.set_item_data(ItemSchema())()
+    sparse = response_schema.dump(ListResponse(data=ListData(2, items, only_fields=("name", "id"))))
+    assert sparse["data"]["items"] == [dict(id=1, name="a"), dict(id=2, name="b")]
+    full = response_schema.dump(ListResponse(data=ListData(2, items)))
+    assert full["data"]["items"] == items
@@ -0,0 +1,223 @@
+"""
+ShardedBaseModel 在多个sqlite分片上的路由测试
+"""
+import pytest
+from sqlalchemy import Column, Integer, String
+
+from conftest import SHARD_COUNT
+
+
+@pytest.fixture(scope="module")
+def order_model(app):
+    from entities.base import IsDelBaseEntity, PkBaseEntity, VersionBaseEntity
+    from models.sharding import ShardedBaseModel
+
+    class ShardOrder(PkBaseEntity, IsDelBaseEntity, VersionBaseEntity):
+        __tablename__ = "test_shard_order"
+
+        tenant_id = Column(Integer, nullable=False)
+        order_no = Column(String(32), unique=True)
+        amount = Column(Integer, default=0)
+
+    class ShardOrderModel(ShardedBaseModel[ShardOrder]):
+        _shard_key = "tenant_id"
+        _filter_keys = ["id", "tenant_id", "amount"]
+        _range_filter_keys = ["version"]
+        _like_filter_keys = ["order_no"]
+
+    ShardOrderModel.create_shard_tables()
+    return ShardOrderModel
+
+
+@pytest.fixture
+def orders(order_model, db_session):
+    """每个分片上两个订单, 各个分片的自增id相同: 分片i上的订单为 (id=1, tenant_id=i), (id=2, tenant_id=i+3)"""
+    entity_list = [
+        dict(tenant_id=tenant, order_no=f"no-{tenant}", amount=tenant * 10)
+        for tenant in range(2 * SHARD_COUNT)
+    ]
+    return order_model.bulk_create(entity_list)
+
+
+def _rows(model, shard):
+    from initialization.sharding_process import get_shard_session
+
+    query = get_shard_session(shard).query(model._entity).order_by(model._entity.id)
+    return [(row.id, row.tenant_id, row.amount, row.is_deleted) for row in query.populate_existing()]
+
+
+def test_create_routes_by_shard_key(order_model, orders):
+    assert order_model.shard_for(4) == 1
+    for shard in range(SHARD_COUNT):
+        assert [row[1] for row in _rows(order_model, shard)] == [shard, shard + SHARD_COUNT]
+
+    with pytest.raises(ValueError):
+        order_model.create(order_no="no-none")
+
+
+def test_get_by_filter_scatter_and_route(order_model, orders):
+    count, result = order_model.get_by_filter(order_by="amount", order_by_desc=False, limit=4, offset=1)
+    assert count == 2 * SHARD_COUNT
+    assert [order.tenant_id for order in result] == [1, 2, 3, 4]
+
+    count, result = order_model.get_by_filter(tenant_id=[1, 4], _filter_keys=["tenant_id"])
+    assert count == 2 and {order.tenant_id for order in result} == {1, 4}
+
+
+def test_shards_for_filter_only_routes_equality(order_model):
+    assert order_model._shards_for_filter({"tenant_id": 4}) == [1]
+    assert order_model._shards_for_filter({"tenant_id": [0, 4]}) == [0, 1]
+    # 分片键作为范围或者模糊条件时不能路由
+    ranged = {"tenant_id": (1, 2), "_range_filter_keys": ["tenant_id"]}
+    assert order_model._shards_for_filter(ranged) == list(range(SHARD_COUNT))
+    liked = {"tenant_id": "12", "_like_filter_keys": ["tenant_id"]}
+    assert order_model._shards_for_filter(liked) == list(range(SHARD_COUNT))
+
+
+def test_range_filter_on_shard_key_scans_all_shards(order_model, orders):
+    count, result = order_model.get_by_filter(tenant_id=(1, 4), _range_filter_keys=["tenant_id"])
+    assert count == 4 and sorted(order.tenant_id for order in result) == [1, 2, 3, 4]
+
+
+def test_update_on_owning_shard(order_model, orders):
+    entity = order_model.update(2, shard_value=4, amount=100)
+    assert (entity.tenant_id, entity.amount) == (4, 100)
+    assert _rows(order_model, 1) == [(1, 1, 10, False), (2, 4, 100, False)]
+    assert _rows(order_model, 0)[1] == (2, 3, 30, False)
+
+
+def test_update_without_shard_value(order_model, orders):
+    # 每个分片都有id为2的记录, 无法定位
+    with pytest.raises(ValueError, match="shard_value is required"):
+        order_model.update(2, amount=100)
+
+    order_model.delete(1, force_delete=True, shard_value=0)
+    order_model.delete(1, force_delete=True, shard_value=2)
+    entity = order_model.update(1, amount=100)
+    assert (entity.tenant_id, entity.amount) == (1, 100)
+    assert order_model.update(99, amount=100) is None
+
+
+def test_update_rejects_moving_shard(order_model, orders):
+    with pytest.raises(ValueError, match="moves the row"):
+        order_model.update(2, shard_value=4, tenant_id=5)
+    assert order_model.update(2, shard_value=4, tenant_id=7).tenant_id == 7
+
+
+def test_update_with_expected_version(order_model, orders):
+    from utils.exceptions import VersionConflict
+
+    entity = order_model.update(2, expected_version=1, shard_value=4, amount=100)
+    assert (entity.amount, entity.version) == (100, 2)
+    with pytest.raises(VersionConflict):
+        order_model.update(2, expected_version=1, shard_value=4, amount=200)
+
+
+def test_update_by_id(order_model, orders):
+    assert order_model.update_by_id(2, shard_value=5, amount=100) == 1
+    entity = order_model.update_by_id(2, _reload=True, shard_value=5, amount=200)
+    assert (entity.tenant_id, entity.amount, entity.version) == (5, 200, 3)
+    assert _rows(order_model, 2)[1] == (2, 5, 200, False)
+    assert _rows(order_model, 1)[1] == (2, 4, 40, False)
+
+
+def test_delete_and_bulk_delete(order_model, orders):
+    order_model.delete(2, shard_value=4)
+    assert _rows(order_model, 1) == [(1, 1, 10, False), (2, 4, 40, True)]
+    assert [row[3] for row in _rows(order_model, 0)] == [False, False]
+
+    order_model.bulk_delete([1, 2], force_delete=True, shard_value=2)
+    assert _rows(order_model, 2) == []
+    assert len(_rows(order_model, 0)) == 2
+
+
+def test_bulk_delete_by_filter(order_model, orders):
+    report = order_model.bulk_delete_by_filter(dry_run=True, amount=[10, 20, 40])
+    assert report == {"test_shard_order": 3}
+    report = order_model.bulk_delete_by_filter(tenant_id=[1, 4], _filter_keys=["tenant_id"])
+    assert report == {"test_shard_order": 2}
+    assert [row[3] for row in _rows(order_model, 1)] == [True, True]
+
+
+def test_bulk_update(order_model, orders):
+    with pytest.raises(ValueError, match="shard_value is required"):
+        order_model.bulk_update([dict(id=1, amount=1, version=1)])
+
+    order_model.bulk_update([dict(id=1, amount=1, version=1), dict(id=2, amount=2, version=1)], shard_value=4)
+    assert _rows(order_model, 1) == [(1, 1, 1, False), (2, 4, 2, False)]
+
+    assert order_model.bulk_update([dict(id=1, amount=3)], set_based=True, shard_value=0) == 1
+    assert _rows(order_model, 0)[0] == (1, 0, 3, False)
+    assert _rows(order_model, 2)[0] == (1, 2, 20, False)
+
+
+def test_bulk_upsert(order_model, orders):
+    report = order_model.bulk_upsert([
+        dict(tenant_id=4, order_no="no-4", amount=400),
+        dict(tenant_id=7, order_no="no-7", amount=700),
+    ], conflict_keys=["order_no"])
+    assert report == {"inserted": 1, "updated": 1, "unchanged": 0}
+    assert _rows(order_model, 1) == [(1, 1, 10, False), (2, 4, 400, False), (3, 7, 700, False)]
+
+    with pytest.raises(ValueError):
+        order_model.bulk_upsert([dict(order_no="no-8", amount=800)], conflict_keys=["order_no"])
+
+
+def test_unsupported_methods(order_model):
+    from models.base import BaseModel, ModelMixin
+
+    assert issubclass(order_model, ModelMixin) and not issubclass(order_model, BaseModel)
+    for name in ("load", "iter_by_filter", "get_by_cursor", "aggregate", "bulk_ingest", "archive_deleted"):
+        assert not hasattr(order_model, name)
+
+    with pytest.raises(NotImplementedError, match="count_strategy"):
+        order_model.get_by_filter(count_strategy="estimated")
+    with pytest.raises(NotImplementedError, match="concurrent_count"):
+        order_model.get_by_filter(concurrent_count=True)
+    with pytest.raises(NotImplementedError, match="_load"):
+        order_model.get_all_by_filter(_load={"items": "selectin"})
+
+
+def test_shard_flush_error_rolls_back_primary(order_model, orders, db_session):
+    from sqlalchemy.exc import IntegrityError
+
+    from models.base import safe_commit
+
+    with db_session.get_bind().connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS test_shard_marker (id INTEGER PRIMARY KEY)")
+
+    # 分片0上已经存在 no-3, 修改返回的entity之后随提交flush, 在主库提交之前失败
+    with pytest.raises(IntegrityError):
+        with safe_commit():
+            db_session.execute("INSERT INTO test_shard_marker (id) VALUES (1)")
+            order_model.get_by_id(1, shard_value=0).order_no = "no-3"
+
+    assert db_session.execute("SELECT COUNT(*) FROM test_shard_marker").scalar() == 0
+    assert _rows(order_model, 0) == []
+
+
+def test_unsupported_attributes(app):
+    from entities.base import PkBaseEntity
+    from models.sharding import ShardedBaseModel
+
+    class ShardItem(PkBaseEntity):
+        __tablename__ = "test_shard_item"
+
+        tenant_id = Column(Integer)
+
+    with pytest.raises(AttributeError):
+
+        class NoShardKeyModel(ShardedBaseModel[ShardItem]):
+            pass
+
+    with pytest.raises(AttributeError):
+
+        class CachedShardItemModel(ShardedBaseModel[ShardItem]):
+            _shard_key = "tenant_id"
+            _cache_ttl = 60
+
+    with pytest.raises(AttributeError):
+
+        class EagerShardItemModel(ShardedBaseModel[ShardItem]):
+            _shard_key = "tenant_id"
+            _load_options = {"items": "selectin"}
@@ -0,0 +1,15 @@
+"""
+请求级别的sql监控测试
+"""
+import pytest
+from sqlalchemy.exc import OperationalError
+
+
+def test_failed_statement_pops_start_time(engine_events, db_session):
+    with db_session.get_bind().connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute("SELECT * FROM table_does_not_exist")
+        assert conn.info.get(engine_events._START_TIMES) == []
+
+        conn.execute("SELECT 1")
+        assert conn.info.get(engine_events._START_TIMES) == []